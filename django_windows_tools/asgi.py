@@ -0,0 +1,176 @@
+# encoding: utf-8
+
+# ASGI applications hosted by the FastCGI bridge
+#
+# Copyright (c) 2012 Openance SARL
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+'''
+Adapter running an ASGI application behind the WSGI interface of the
+winfcgi FastCGI bridge (see the FCGI_ASGI setting).
+
+This module requires Python 3.5 or newer.
+'''
+import asyncio
+from collections import deque
+from http.client import responses
+
+
+def encode_param(value):
+    '''
+    Returns the bytes of a FastCGI parameter. The bridge decodes them as
+    UTF-8, so this gives back the bytes sent by the web server.
+    '''
+    return value.encode('utf-8', 'replace')
+
+
+class ASGIRequest(object):
+    '''
+    A request handled by an ASGI application through ASGIBridge.
+
+    Iterating over it runs the event loop until the application sends the
+    next chunk of the response body.
+    '''
+
+    readSize = 65536
+
+    def __init__(self, bridge, environ, start_response):
+        self.bridge = bridge
+        self.environ = environ
+        self.start_response = start_response
+        self.chunks = deque()
+        self.complete = False
+        self.remaining = int(environ.get('CONTENT_LENGTH') or 0)
+        self.bodyRead = False
+        self.ready = asyncio.Event()
+        self.finished = asyncio.Event()
+        self.task = bridge.loop.create_task(bridge.application(bridge.scope(environ), self.receive, self.send))
+
+    async def receive(self):
+        if not self.bodyRead:
+            data = b''
+            if self.remaining > 0:
+                data = self.environ['wsgi.input'].read(min(self.remaining, self.readSize))
+                self.remaining = self.remaining - len(data) if data else 0
+            self.bodyRead = self.remaining == 0
+            return {'type': 'http.request', 'body': data, 'more_body': not self.bodyRead}
+        # the response has been sent when the client (IIS) goes away
+        await self.finished.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(self, message):
+        if message['type'] == 'http.response.start':
+            status = message['status']
+            self.start_response('%d %s' % (status, responses.get(status, 'Unknown')), [
+                (name.decode('latin-1'), value.decode('latin-1')) for name, value in message.get('headers', ())])
+        elif message['type'] == 'http.response.body':
+            body = message.get('body', b'')
+            if body:
+                self.chunks.append(body)
+            if not message.get('more_body', False):
+                self.complete = True
+            self.ready.set()
+
+    async def _next(self):
+        waiter = asyncio.ensure_future(self.ready.wait())
+        await asyncio.wait((waiter, self.task), return_when=asyncio.FIRST_COMPLETED)
+        waiter.cancel()
+        self.ready.clear()
+
+    def __iter__(self):
+        loop = self.bridge.loop
+        try:
+            while True:
+                while self.chunks:
+                    yield self.chunks.popleft()
+                if self.complete:
+                    break
+                if self.task.done():
+                    self.task.result()  # raises the exception of the application
+                    raise RuntimeError('ASGI application returned without completing the response')
+                loop.run_until_complete(self._next())
+        except (Exception, GeneratorExit):
+            raise
+        except BaseException:
+            # interrupted by the soft timeout of winfcgi (RequestTimeout): the
+            # application is not waited for
+            self.bridge.cancel()
+            raise
+        finally:
+            # let the application clean up (request_finished signal, ...)
+            self.finished.set()
+            if not self.task.done():
+                loop.run_until_complete(self.task)
+
+
+class ASGIBridge(object):
+    '''
+    Runs an ASGI application (HTTP protocol only) as the WSGI application of
+    FCGIServer, on an event loop kept for the life of the process. The WSGI
+    environ of the request is translated into an ASGI scope, the input
+    stream into http.request events and the http.response events into the
+    WSGI response.
+    '''
+
+    def __init__(self, application):
+        self.application = application
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def cancel(self):
+        '''Cancels the tasks left on the event loop by an interrupted request.'''
+        all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks
+        tasks = [task for task in all_tasks(self.loop) if not task.done()]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+
+    def scope(self, environ):
+        headers = []
+        for name, value in environ.items():
+            if name.startswith('HTTP_'):
+                headers.append((encode_param(name[5:].replace('_', '-').lower()), encode_param(value)))
+            elif name in ('CONTENT_TYPE', 'CONTENT_LENGTH') and value:
+                headers.append((encode_param(name.replace('_', '-').lower()), encode_param(value)))
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0', 'spec_version': '2.3'},
+            'http_version': environ.get('SERVER_PROTOCOL', 'HTTP/1.1').partition('/')[2] or '1.1',
+            'method': environ['REQUEST_METHOD'],
+            'scheme': environ.get('wsgi.url_scheme', 'http'),
+            'path': environ['PATH_INFO'],
+            'raw_path': encode_param(environ.get('REQUEST_URI', environ['PATH_INFO']).split('?', 1)[0]),
+            'query_string': encode_param(environ.get('QUERY_STRING', '')),
+            'root_path': environ.get('SCRIPT_NAME', ''),
+            'headers': headers,
+            'server': (environ.get('SERVER_NAME', 'localhost'), int(environ.get('SERVER_PORT') or 80)),
+            'extensions': {'fcgi.environ': environ},
+        }
+        if environ.get('REMOTE_ADDR'):
+            scope['client'] = (environ['REMOTE_ADDR'], int(environ.get('REMOTE_PORT') or 0))
+        return scope
+
+    def __call__(self, environ, start_response):
+        return ASGIRequest(self, environ, start_response)
@@ -0,0 +1,89 @@
+# encoding: utf-8
+
+# Django cache backend shared by the processes of a host
+#
+# Copyright (c) 2012 Openance SARL
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+'''
+Django cache backend storing its values in a memory-mapped file.
+
+All the processes of the host (the winfcgi workers started by IIS, the
+processes of the Windows Service) using the same location share the cached
+values. Configure it with: ::
+
+    CACHES = {
+        'default': {
+            'BACKEND': 'django_windows_tools.cache.SharedMemoryCache',
+            'LOCATION': r'D:\sites\mydjangoapp\cache.bin',
+            'OPTIONS': {'SIZE': 64 * 1024 * 1024, 'MAX_VALUE_SIZE': 1024 * 1024},
+        }
+    }
+'''
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+
+from django_windows_tools.sharedmem import SharedCache
+
+
+class SharedMemoryCache(BaseCache):
+    def __init__(self, location, params):
+        super(SharedMemoryCache, self).__init__(params)
+        options = params.get('OPTIONS', {})
+        self._cache = SharedCache(location,
+                                  size=options.get('SIZE', 64 * 1024 * 1024),
+                                  max_chunk=options.get('MAX_VALUE_SIZE', 1024 * 1024))
+
+    def _key(self, key, version):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return key.encode('utf-8')
+
+    def _expires(self, timeout):
+        expires = self.get_backend_timeout(timeout)
+        return expires if expires is not None else 0
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        return self._cache.add(self._key(key, version), pickled, self._expires(timeout))
+
+    def get(self, key, default=None, version=None):
+        pickled = self._cache.get(self._key(key, version))
+        if pickled is None:
+            return default
+        return pickle.loads(pickled)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        self._cache.set(self._key(key, version), pickled, self._expires(timeout))
+
+    def delete(self, key, version=None):
+        return self._cache.delete(self._key(key, version))
+
+    def clear(self):
+        self._cache.clear()
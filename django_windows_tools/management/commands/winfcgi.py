@@ -31,19 +31,36 @@
 
 __author__ = 'Allan Saddi <allan@saddi.com>, Ruslan Keba <ruslan@helicontech.com>, Antoine Martin <antoine@openance.com>'
 
-import msvcrt
 import struct
 import os
 import os.path
 import logging
 import sys
 import datetime
+import time
+import re
+import gc
+import random
+import math
+import mmap
+import hashlib
+import mimetypes
+import threading
+import traceback
+import json
+import csv
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from io import BytesIO
+from email.utils import parsedate_tz, mktime_tz, formatdate
 from optparse import OptionParser
 
 if sys.version_info >= (3,):
     long_int = int
     bytes_type = bytes
     import urllib.parse as url_parse
+    import queue
+    from io import StringIO
 
     def char_to_int(value):
         return int(value)
@@ -57,6 +74,8 @@ else:
     long_int = long
     bytes_type = str
     import urllib as url_parse
+    import Queue as queue
+    from StringIO import StringIO
 
     def char_to_int(value):
         return ord(value)
@@ -68,8 +87,11 @@ else:
         return content
 
 from django.core.management.base import BaseCommand
+from django.core.exceptions import ImproperlyConfigured
 from django.conf import settings
 
+from django_windows_tools.sharedmem import SharedCache, Scoreboard, TokenBuckets
+
 
 # Constants from the spec.
 
@@ -134,6 +156,67 @@ FCGI_DEBUG = getattr(settings, 'FCGI_DEBUG', settings.DEBUG)
 FCGI_LOG = getattr(settings, 'FCGI_LOG', FCGI_DEBUG)
 FCGI_LOG_PATH = getattr(settings, 'FCGI_LOG_PATH', os.path.dirname(os.path.abspath(sys.argv[0])))
 
+# Optional response cache, e.g. {'MAX_SIZE': 32 * 1024 * 1024, 'VARY': ('Host', 'Cookie')}
+# With a 'LOCATION' (file path), the cache is shared by all the processes of the host.
+FCGI_RESPONSE_CACHE = getattr(settings, 'FCGI_RESPONSE_CACHE', None)
+
+# Optional static files served by the bridge itself, e.g. {'MAX_AGE': 3600}.
+# 'PATHS' maps URL prefixes to directories and defaults to {STATIC_URL: STATIC_ROOT}.
+FCGI_STATIC_FILES = getattr(settings, 'FCGI_STATIC_FILES', None)
+
+# Optional ETag generation and conditional GET handling, e.g. {'MAX_SIZE': 1024 * 1024}
+FCGI_CONDITIONAL_GET = getattr(settings, 'FCGI_CONDITIONAL_GET', None)
+
+# Optional batching of the small chunks of streamed responses, e.g. {'MAX_SIZE': 8192, 'MAX_DELAY': 0.1}
+FCGI_STREAM_BATCHING = getattr(settings, 'FCGI_STREAM_BATCHING', None)
+
+# Optional coalescing of identical concurrent GET requests across the processes
+# of the host, e.g. {'LOCATION': r'D:\sites\app\flights.bin', 'PATHS': (r'^/$',)}
+FCGI_COALESCING = getattr(settings, 'FCGI_COALESCING', None)
+
+# Optional capture of the FastCGI records for replay, e.g. {'RATE': 0.01, 'MAX_SIZE': 100 * 1024 * 1024}
+FCGI_CAPTURE = getattr(settings, 'FCGI_CAPTURE', None)
+
+# Optional resident memory limit (in bytes) after which the process exits between two requests,
+# e.g. {'SOFT_LIMIT': 512 * 1024 * 1024, 'CHECK_EVERY': 10}
+FCGI_MEMORY_LIMIT = getattr(settings, 'FCGI_MEMORY_LIMIT', None)
+
+# Optional garbage collection scheduling, e.g. {'FREEZE': True, 'IDLE_THRESHOLD': 700}
+FCGI_GC = getattr(settings, 'FCGI_GC', None)
+
+# Optional profiling of a sample of the requests, e.g. {'EVERY': 100, 'PATTERN': r'^/api/'}
+FCGI_PROFILE = getattr(settings, 'FCGI_PROFILE', None)
+
+# Stack reports of slow requests, e.g. {'THRESHOLD': 30, 'INTERVAL': 10}
+FCGI_SLOW_REQUESTS = getattr(settings, 'FCGI_SLOW_REQUESTS', None)
+
+# Seconds after which a request is interrupted with a 504 response
+FCGI_SOFT_TIMEOUT = getattr(settings, 'FCGI_SOFT_TIMEOUT', None)
+
+# Recycling of the process by itself, e.g. {'MAX_REQUESTS': 9000, 'JITTER': 0.1}
+FCGI_RECYCLE = getattr(settings, 'FCGI_RECYCLE', None)
+
+# Access log written by the bridge, e.g. {'FORMAT': 'json', 'MAX_BYTES': 10 * 1024 * 1024}
+FCGI_ACCESS_LOG = getattr(settings, 'FCGI_ACCESS_LOG', None)
+
+# Timelines of a sample of the requests, e.g. {'RATE': 0.001}
+FCGI_TRACE = getattr(settings, 'FCGI_TRACE', None)
+
+# Host-wide table of the process states, e.g. {'LOCATION': r'D:\sites\myapp\scoreboard.bin'}
+FCGI_SCOREBOARD = getattr(settings, 'FCGI_SCOREBOARD', None)
+
+# Host-wide rate limiting of the clients, e.g. {'LOCATION': r'D:\sites\myapp\ratelimit.bin', 'RATE': 10}
+FCGI_RATE_LIMIT = getattr(settings, 'FCGI_RATE_LIMIT', None)
+
+# Run the ASGI application of Django instead of the WSGI one
+FCGI_ASGI = getattr(settings, 'FCGI_ASGI', False)
+
+# FastCGI authorizer role, e.g. {'CALLABLE': 'myapp.auth.authorize', 'TTL': 60}
+FCGI_AUTHORIZER_ROLE = getattr(settings, 'FCGI_AUTHORIZER_ROLE', None)
+
+# Read the records from the web server in a background thread, e.g. {'MAX_RECORDS': 1024}
+FCGI_READ_AHEAD = getattr(settings, 'FCGI_READ_AHEAD', None)
+
 
 class InputStream(object):
     """
@@ -141,12 +224,18 @@ class InputStream(object):
     FCGI_DATA). Supports the minimum methods required by WSGI spec.
     """
 
+    __slots__ = ('_conn', '_shrinkThreshold', '_buf', '_bufList', '_pos', '_avail', '_eof')
+
     def __init__(self, conn):
         self._conn = conn
 
         # See Server.
         self._shrinkThreshold = conn.server.inputStreamShrinkThreshold
 
+        self.reset()
+
+    def reset(self):
+        """Empties the stream so that it can be used for another request."""
         self._buf = b''
         self._bufList = []
         self._pos = 0  # Current read position.
@@ -260,11 +349,17 @@ class OutputStream(object):
     to the server. Buffering should be done in a higher level!
     """
 
+    __slots__ = ('_conn', '_req', '_type', '_buffered', '_bufList', 'dataWritten', 'closed')
+
     def __init__(self, conn, req, type, buffered=False):
         self._conn = conn
         self._req = req
         self._type = type
         self._buffered = buffered
+        self.reset()
+
+    def reset(self):
+        """Reopens the stream so that it can be used for another request."""
         self._bufList = []  # Used if buffered is True
         self.dataWritten = False
         self.closed = False
@@ -278,6 +373,8 @@ class OutputStream(object):
             rec.contentLength = to_write
             rec.contentData = data[:to_write]
             self._conn.writeRecord(rec)
+            # only once sent: a RequestTimeout may interrupt the request before
+            self.dataWritten = True
 
             data = data[to_write:]
             length -= to_write
@@ -288,9 +385,8 @@ class OutputStream(object):
         if not data:
             return
 
-        self.dataWritten = True
-
         if self._buffered:
+            self.dataWritten = True
             self._bufList.append(data)
         else:
             self._write(data)
@@ -324,6 +420,8 @@ class TeeOutputStream(object):
     written data to all streams.
     """
 
+    __slots__ = ('_streamList',)
+
     def __init__(self, streamList):
         self._streamList = streamList
 
@@ -524,14 +622,16 @@ class Record(object):
                 FCGI_HEADER_NAMES[FCGI_MAXTYPE]
             )
 
-        self._sendall(stream, header)
-
+        # a single write per record: one system call on the pipe, and a
+        # record cannot be cut in half by a RequestTimeout
+        data = [header]
         if self.contentLength:
             if FCGI_DEBUG: logging.debug('send CONTENT')
-            self._sendall(stream, self.contentData)
+            data.append(self.contentData)
         if self.paddingLength:
             if FCGI_DEBUG: logging.debug('send PADDING')
-            self._sendall(stream, b'\x00' * self.paddingLength)
+            data.append(b'\x00' * self.paddingLength)
+        self._sendall(stream, b''.join(data))
 
 
 class Request(object):
@@ -542,25 +642,82 @@ class Request(object):
     between your handler and the fcgi module. The methods should not
     be called by your handler. However, server, params, stdin, stdout,
     stderr, and data are free for your handler's use.
+
+    The stderr and data streams are only created when they are used.
+    Connections keep finished requests in a pool and reset them for the
+    next ones, so that their streams are allocated once.
     """
 
+    __slots__ = ('_conn', '_inputStreamClass', '_stderr', '_data', '_errors', 'server', 'params',
+                 'stdin', 'stdout', 'requestId', 'role', 'flags', 'aborted')
+
     def __init__(self, conn, inputStreamClass):
         self._conn = conn
+        self._inputStreamClass = inputStreamClass
 
         self.server = conn.server
         self.params = {}
         self.stdin = inputStreamClass(conn)
         self.stdout = OutputStream(conn, self, FCGI_STDOUT)
-        self.stderr = OutputStream(conn, self, FCGI_STDERR)
-        self.data = inputStreamClass(conn)
+        self._stderr = None
+        self._data = None
+        self._errors = None
+
+    @property
+    def stderr(self):
+        if self._stderr is None:
+            self._stderr = OutputStream(self._conn, self, FCGI_STDERR)
+        return self._stderr
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self._inputStreamClass(self._conn)
+        return self._data
+
+    @property
+    def errors(self):
+        """The wsgi.errors stream, copying to sys.stderr and stderr."""
+        if self._errors is None:
+            # TODO - sys.stderr appears to be None here?? (on Windows/IIS)
+            self._errors = TeeOutputStream((sys.stderr, self.stderr))
+        return self._errors
+
+    def reset(self):
+        """Prepares the request and its streams to be used for another request."""
+        self.params = {}
+        self.stdin.reset()
+        self.stdout.reset()
+        if self._stderr is not None:
+            self._stderr.reset()
+        if self._data is not None:
+            self._data.reset()
 
     def run(self):
         """Runs the handler, flushes the streams, and ends the request."""
 
+        timeout = self.server.soft_timeout
         try:
-            protocolStatus, appStatus = self.server.handler(self)
+            if timeout is not None:
+                timeout.arm()
+            try:
+                protocolStatus, appStatus = self.server.handler(self)
+            finally:
+                if timeout is not None:
+                    timeout.disarm()
+        except RequestTimeout:
+            # may have been raised in the finally clause above
+            timeout.disarm()
+            logging.error('request timeout: %s %s interrupted after %g s' % (
+                self.params.get('REQUEST_METHOD', ''), self.params.get('PATH_INFO', ''), timeout.timeout))
+            self.server.request_error(self, 'timeout after %g s' % timeout.timeout)
+            self.stderr.flush()
+            if not self.stdout.dataWritten:
+                self.server.timeout_error(self)
+            protocolStatus, appStatus = FCGI_REQUEST_COMPLETE, 0
         except Exception as instance:
             logging.exception(instance)  # just in case there's another error reporting the exception
+            self.server.request_error(self, '%s: %s' % (instance.__class__.__name__, instance))
             # TODO: this appears to cause FCGI timeouts sometimes.  is it an exception loop?
             self.stderr.flush()
             if not self.stdout.dataWritten:
@@ -577,7 +734,354 @@ class Request(object):
 
     def _flush(self):
         self.stdout.flush()
-        self.stderr.flush()
+        if self._stderr is not None:
+            self._stderr.flush()
+
+
+CAPTURE_MAGIC = b'FCGICAP1'
+CAPTURE_IN = 0
+CAPTURE_OUT = 1
+
+# timestamp, direction, record type, request id, content length, captured length
+FCGI_CaptureEntry = struct.Struct('<dBBHHH')
+
+
+class TrafficCapture(object):
+    """
+    Writes the records exchanged with the web server to a binary file that
+    the winfcgi_replay command can feed back to the application.
+
+    The file starts with CAPTURE_MAGIC, followed for each record by a
+    FCGI_CaptureEntry and the captured content. Requests are sampled with
+    the given rate when they begin. The content of outgoing records is
+    only kept if captureOutput is True (their length always is). Capture
+    stops once the file reaches maxSize bytes.
+
+    The parameters named in scrub (e.g. HTTP_COOKIE) are removed from the
+    captured FCGI_PARAMS records so that the file holds no credentials.
+    """
+
+    def __init__(self, path, rate=1.0, maxSize=100 * 1024 * 1024, captureOutput=False, scrub=()):
+        self.path = path
+        self.rate = rate
+        self.maxSize = maxSize
+        self.captureOutput = captureOutput
+        self.scrub = frozenset(scrub)
+        self._file = open(path, 'wb')
+        self._file.write(CAPTURE_MAGIC)
+        self._size = len(CAPTURE_MAGIC)
+        self._sampled = set()
+        self.full = False
+
+    def _write(self, direction, rec, content, contentLength=None):
+        if contentLength is None:
+            contentLength = rec.contentLength
+        entry = FCGI_CaptureEntry.pack(time.time(), direction, rec.type, rec.requestId, contentLength,
+                                       len(content))
+        self._file.write(entry)
+        self._file.write(content)
+        self._size += len(entry) + len(content)
+
+    def recordIn(self, rec):
+        if rec.type == FCGI_BEGIN_REQUEST:
+            if self._size >= self.maxSize:
+                if not self.full:
+                    self.full = True
+                    self._file.flush()
+                    logging.info('traffic capture: %s is full' % self.path)
+                return
+            if random.random() >= self.rate:
+                return
+            self._sampled.add(rec.requestId)
+        elif rec.requestId not in self._sampled:
+            return
+        content = make_bytes(rec.contentData)
+        if rec.type == FCGI_PARAMS and self.scrub:
+            content = self._scrubParams(content)
+            self._write(CAPTURE_IN, rec, content, len(content))
+        else:
+            self._write(CAPTURE_IN, rec, content)
+
+    def _scrubParams(self, content):
+        """Returns the encoded pairs of content without the scrubbed ones."""
+        kept = []
+        pos = 0
+        while pos < len(content):
+            start = pos
+            pos, (name, value) = decode_pair(content, pos)
+            if name not in self.scrub:
+                kept.append(content[start:pos])
+        return b''.join(kept)
+
+    def recordOut(self, rec):
+        if rec.requestId not in self._sampled:
+            return
+        self._write(CAPTURE_OUT, rec, make_bytes(rec.contentData) if self.captureOutput else b'')
+        if rec.type == FCGI_END_REQUEST:
+            self._sampled.discard(rec.requestId)
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def read_capture(f):
+    """
+    Reads a file written by TrafficCapture.
+
+    Yields (timestamp, direction, type, requestId, contentLength, content) tuples.
+    """
+    if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+        raise ValueError('Not a FastCGI capture file')
+    while True:
+        entry = f.read(FCGI_CaptureEntry.size)
+        if len(entry) < FCGI_CaptureEntry.size:
+            break
+        timestamp, direction, type, requestId, contentLength, capturedLength = FCGI_CaptureEntry.unpack(entry)
+        content = f.read(capturedLength)
+        if len(content) < capturedLength:
+            break
+        yield timestamp, direction, type, requestId, contentLength, content
+
+
+def make_capture(options):
+    """Creates a TrafficCapture from a FCGI_CAPTURE settings dictionary."""
+    if not options:
+        return None
+    if options is True:
+        options = {}
+    path = os.path.join(options.get('PATH', FCGI_LOG_PATH), 'fcgi_capture_%s_%d.bin' % (
+        datetime.datetime.now().strftime('%y%m%d_%H%M%S'), os.getpid()))
+    return TrafficCapture(path, rate=options.get('RATE', 1.0), maxSize=options.get('MAX_SIZE', 100 * 1024 * 1024),
+                          captureOutput=options.get('OUTPUT', False),
+                          scrub=options.get('SCRUB', ('HTTP_COOKIE', 'HTTP_AUTHORIZATION')))
+
+
+class AccessLog(object):
+    """
+    Writes a line per request with its method, path, status, the number of
+    bytes received and sent, the time to the first byte of the response and
+    the total time (in milliseconds, from the FCGI_BEGIN_REQUEST record) and
+    the process id.
+
+    Lines are written as JSON objects or CSV rows. They are buffered and
+    appended to the file once bufferSize bytes are pending or flushInterval
+    seconds after the previous write. The file is rotated when it would
+    grow over maxBytes, keeping backupCount older files (.1 being the most
+    recent).
+    """
+
+    FIELDS = ('time', 'pid', 'method', 'path', 'status', 'bytes_in', 'bytes_out', 'ttfb_ms', 'total_ms')
+
+    def __init__(self, filename, format='json', bufferSize=64 * 1024, flushInterval=5,
+                 maxBytes=10 * 1024 * 1024, backupCount=5):
+        self.filename = filename
+        self.format = format
+        self.bufferSize = bufferSize
+        self.flushInterval = flushInterval
+        self.maxBytes = maxBytes
+        self.backupCount = backupCount
+        self.pid = os.getpid()
+        self._lines = []
+        self._pending = 0
+        self._flushed = time.time()
+        self._start = self._firstByte = None
+        self._status = None
+        self._bytesIn = self._bytesOut = 0
+
+    def recordIn(self, rec):
+        if rec.type == FCGI_BEGIN_REQUEST:
+            self._start = time.time()
+            self._firstByte = self._status = None
+            self._bytesIn = self._bytesOut = 0
+        elif rec.type == FCGI_STDIN:
+            self._bytesIn += rec.contentLength
+
+    def recordOut(self, rec):
+        if rec.type == FCGI_STDOUT and rec.contentLength:
+            if self._firstByte is None:
+                self._firstByte = time.time()
+                head = bytes(rec.contentData[:11])
+                if head.startswith(b'Status: '):
+                    self._status = int(head[8:11])
+            self._bytesOut += rec.contentLength
+
+    def endRequest(self, environ):
+        now = time.time()
+        if self._start is None:
+            return
+        values = (
+            datetime.datetime.fromtimestamp(self._start).isoformat(), self.pid,
+            environ.get('REQUEST_METHOD', ''), environ.get('PATH_INFO', ''),
+            self._status if self._status is not None else 200 if self._firstByte is not None else None,
+            self._bytesIn, self._bytesOut,
+            round((self._firstByte - self._start) * 1000, 3) if self._firstByte is not None else None,
+            round((now - self._start) * 1000, 3),
+        )
+        self._start = None
+        if self.format == 'csv':
+            line = StringIO()
+            csv.writer(line, lineterminator='\n').writerow(values)
+            line = line.getvalue()
+        else:
+            line = json.dumps(dict(zip(self.FIELDS, values)), separators=(',', ':')) + '\n'
+        self._lines.append(line)
+        self._pending += len(line)
+        if self._pending >= self.bufferSize or now - self._flushed >= self.flushInterval:
+            self.flush()
+
+    def _rotate(self):
+        for i in range(self.backupCount - 1, 0, -1):
+            source = '%s.%d' % (self.filename, i)
+            if os.path.exists(source):
+                target = '%s.%d' % (self.filename, i + 1)
+                if os.path.exists(target):
+                    os.remove(target)
+                os.rename(source, target)
+        target = self.filename + '.1'
+        if os.path.exists(target):
+            os.remove(target)
+        if self.backupCount:
+            os.rename(self.filename, target)
+        else:
+            os.remove(self.filename)
+
+    def flush(self):
+        """Appends the pending lines to the file."""
+        self._flushed = time.time()
+        if not self._lines:
+            return
+        data = ''.join(self._lines)
+        self._lines = []
+        self._pending = 0
+        try:
+            try:
+                size = os.path.getsize(self.filename)
+            except OSError:
+                size = 0
+            if size and self.maxBytes and size + len(data) > self.maxBytes:
+                self._rotate()
+                size = 0
+            with open(self.filename, 'a') as f:
+                if not size and self.format == 'csv':
+                    f.write(','.join(self.FIELDS) + '\n')
+                f.write(data)
+        except (IOError, OSError) as e:
+            logging.error('Could not write the access log: %s' % e)
+
+
+def make_access_log(options):
+    """Creates an AccessLog from a FCGI_ACCESS_LOG settings dictionary."""
+    if not options:
+        return None
+    if options is True:
+        options = {}
+    format = options.get('FORMAT', 'json')
+    filename = options.get('FILENAME') or os.path.join(FCGI_LOG_PATH, 'fcgi_access_%s_%d.%s' % (
+        datetime.datetime.now().strftime('%y%m%d_%H%M%S'), os.getpid(), 'csv' if format == 'csv' else 'jsonl'))
+    return AccessLog(filename, format=format, bufferSize=options.get('BUFFER_SIZE', 64 * 1024),
+                     flushInterval=options.get('FLUSH_INTERVAL', 5),
+                     maxBytes=options.get('MAX_BYTES', 10 * 1024 * 1024),
+                     backupCount=options.get('BACKUP_COUNT', 5))
+
+
+class Trace(object):
+    """
+    Timeline of a request, made of Chrome trace-event complete events.
+
+    Available to the application as environ['fcgi.trace'] for sampled
+    requests. Middleware can add spans with:
+
+        trace = request.environ.get('fcgi.trace')
+        if trace is not None:
+            with trace.span('authentication'):
+                ...
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.start = clock()
+        self.events = []
+        self.pid = os.getpid()
+        self.tid = threading.current_thread().ident
+
+    def add(self, name, start, end=None, category='fcgi', args=None):
+        """Adds a span from start to end (clock values, end defaulting to now)."""
+        if end is None:
+            end = self.clock()
+        event = {'name': name, 'cat': category, 'ph': 'X', 'pid': self.pid, 'tid': self.tid,
+                 'ts': round(start * 1000000, 3), 'dur': round((end - start) * 1000000, 3)}
+        if args:
+            event['args'] = args
+        self.events.append(event)
+
+    @contextmanager
+    def span(self, name, category='app', **args):
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.add(name, start, category=category, args=args)
+
+
+class RequestTracer(object):
+    """
+    Records the timeline of a sample of the requests (the reading of the
+    records, the decoding of the parameters, the buffering of the input,
+    the WSGI application call, the writing of the response records and
+    the end of the request) and writes each of them to a file in the
+    Chrome trace-event format, that can be loaded in chrome://tracing or
+    Perfetto.
+
+    Requests are sampled with the given rate when they begin. At most
+    maxFiles files named fcgi_trace_<pid>_<n>.json are written in the path
+    directory.
+    """
+
+    def __init__(self, path, rate=0.01, maxFiles=100):
+        self.path = path
+        self.rate = rate
+        self.maxFiles = maxFiles
+        self.clock = getattr(time, 'perf_counter', time.time)
+        self.current = None
+        self.written = 0
+
+    def recordIn(self, rec, start):
+        if rec.type == FCGI_BEGIN_REQUEST and self.written < self.maxFiles and random.random() < self.rate:
+            self.current = Trace(self.clock)
+            self.current.start = start
+        self.span('read %s' % FCGI_HEADER_NAMES[min(rec.type, FCGI_MAXTYPE)], start,
+                  bytes=rec.contentLength)
+
+    def span(self, name, start, **args):
+        """Adds a span to the current trace, if the current request is sampled."""
+        if self.current is not None:
+            self.current.add(name, start, args=args)
+
+    def endRequest(self, environ):
+        trace, self.current = self.current, None
+        if trace is None:
+            return
+        trace.add('request', trace.start, args={
+            'method': environ.get('REQUEST_METHOD', ''), 'path': environ.get('PATH_INFO', ''),
+            'query': environ.get('QUERY_STRING', '')})
+        self.written += 1
+        filename = os.path.join(self.path, 'fcgi_trace_%d_%d.json' % (os.getpid(), self.written))
+        try:
+            with open(filename, 'w') as f:
+                json.dump({'traceEvents': trace.events, 'displayTimeUnit': 'ms'}, f)
+        except (IOError, OSError) as e:
+            logging.error('Could not write the request trace: %s' % e)
+
+
+def make_tracer(options):
+    """Creates a RequestTracer from a FCGI_TRACE settings dictionary."""
+    if not options:
+        return None
+    if options is True:
+        options = {}
+    return RequestTracer(options.get('PATH', FCGI_LOG_PATH), rate=options.get('RATE', 0.01),
+                         maxFiles=options.get('MAX_FILES', 100))
 
 
 class Connection(object):
@@ -591,14 +1095,22 @@ class Connection(object):
 
     _multiplexed = False
     _inputStreamClass = InputStream
+    _requestPoolSize = 4
 
     def __init__(self, stdin, stdout, server):
         self._stdin = stdin
         self._stdout = stdout
         self.server = server
+        self._capture = server.capture
+        self._accessLog = server.access_log
+        self._tracer = server.tracer
+        # The records of a streamed response may be flushed by another thread
+        self._writeLock = threading.Lock()
 
         # Active Requests for this Connection, mapped by request ID.
         self._requests = {}
+        # Finished Requests, reused for the next ones.
+        self._requestPool = []
 
     def run(self):
         """Begin processing data from the socket."""
@@ -624,8 +1136,16 @@ class Connection(object):
         if not self._keepGoing:
             return
 
-        rec = Record()
-        rec.read(self._stdin)
+        if self._tracer is not None:
+            start = self._tracer.clock()
+        rec = self._readRecord()
+        if self._tracer is not None:
+            self._tracer.recordIn(rec, start)
+        self._processRecord(rec)
+
+    def _processRecord(self, rec):
+        """Processes a Record read from the socket."""
+        self._observeRecord(rec)
 
         if rec.type == FCGI_GET_VALUES:
             self._do_get_values(rec)
@@ -645,11 +1165,34 @@ class Connection(object):
             # Need to complain about this.
             pass
 
+    def _observeRecord(self, rec):
+        """Passes a Record read from the socket to the traffic capture and the access log."""
+        if self._capture is not None:
+            self._capture.recordIn(rec)
+        if self._accessLog is not None:
+            self._accessLog.recordIn(rec)
+
+    def _readRecord(self):
+        """Reads the next Record from the socket."""
+        rec = Record()
+        rec.read(self._stdin)
+        return rec
+
     def writeRecord(self, rec):
         """
         Write a Record to the socket.
         """
-        rec.write(self._stdout)
+        with self._writeLock:
+            if self._capture is not None:
+                self._capture.recordOut(rec)
+            if self._accessLog is not None:
+                self._accessLog.recordOut(rec)
+            if self._tracer is not None:
+                start = self._tracer.clock()
+                rec.write(self._stdout)
+                self._tracer.span('write %s' % FCGI_HEADER_NAMES[rec.type], start, bytes=rec.contentLength)
+            else:
+                rec.write(self._stdout)
 
     def end_request(self, req, appStatus=long_int('0'), protocolStatus=FCGI_REQUEST_COMPLETE, remove=True):
         """
@@ -660,6 +1203,8 @@ class Connection(object):
         the connection, the socket is closed, thereby ending this
         Connection (run() returns).
         """
+        if self._tracer is not None:
+            start = self._tracer.clock()
 
         # write empty packet to stdin
         rec = Record(FCGI_STDOUT, req.requestId)
@@ -684,6 +1229,9 @@ class Connection(object):
             if FCGI_DEBUG: logging.debug('end_request: set _keepGoing = False')
             self._keepGoing = False
 
+        if self._tracer is not None:
+            self._tracer.span('end_request', start)
+
     def _do_get_values(self, inrec):
         """Handle an FCGI_GET_VALUES request from the web server."""
 
@@ -703,13 +1251,17 @@ class Connection(object):
         """Handle an FCGI_BEGIN_REQUEST from the web server."""
         role, flags = struct.unpack(FCGI_BeginRequestBody, inrec.contentData)
 
-        req = self.server.request_class(self, self._inputStreamClass)
+        if self._requestPool:
+            req = self._requestPool.pop()
+        else:
+            req = self.server.request_class(self, self._inputStreamClass)
         req.requestId, req.role, req.flags = inrec.requestId, role, flags
         req.aborted = False
 
         if not self._multiplexed and self._requests:
             # Can't multiplex requests.
             self.end_request(req, long_int(0), FCGI_CANT_MPX_CONN, remove=False)
+            self._release_request(req)
         else:
             self._requests[inrec.requestId] = req
 
@@ -726,7 +1278,20 @@ class Connection(object):
     def _start_request(self, req):
         """Run the request."""
         # Not multiplexed, so run it inline.
+        self.server.before_request(self, req)
         req.run()
+        self.server.after_request(self, req)
+        self._release_request(req)
+
+    def _release_request(self, req):
+        """Puts a finished request back in the pool."""
+        if len(self._requestPool) < self._requestPoolSize:
+            req.reset()
+            self._requestPool.append(req)
+
+    def stop(self):
+        """Stops processing input once the current request is over (run() returns)."""
+        self._keepGoing = False
 
     def _do_params(self, inrec):
         """
@@ -738,10 +1303,14 @@ class Connection(object):
         req = self._requests.get(inrec.requestId)
         if req is not None:
             if inrec.contentLength:
+                if self._tracer is not None:
+                    start = self._tracer.clock()
                 pos = 0
                 while pos < inrec.contentLength:
                     pos, (name, value) = decode_pair(inrec.contentData, pos)
                     req.params[name] = value
+                if self._tracer is not None:
+                    self._tracer.span('decode params', start)
 
     def _do_stdin(self, inrec):
         """Handle the FCGI_STDIN stream."""
@@ -749,7 +1318,11 @@ class Connection(object):
 
         if inrec.contentLength:
             if req is not None:
+                if self._tracer is not None:
+                    start = self._tracer.clock()
                 req.stdin.add_data(inrec.contentData)
+                if self._tracer is not None:
+                    self._tracer.span('buffer stdin', start, bytes=inrec.contentLength)
         else:
             self._start_request(req)
 
@@ -767,6 +1340,1678 @@ class Connection(object):
         self.writeRecord(outrec)
 
 
+class StreamedInputStream(InputStream):
+    """
+    An InputStream fed by the records queued for its request by a
+    ReadAheadConnection, as the application reads it.
+    """
+
+    __slots__ = ('queue',)
+
+    def reset(self):
+        InputStream.reset(self)
+        self.queue = None
+
+    def _nextRecord(self):
+        tracer = self._conn._tracer
+        if tracer is not None:
+            start = tracer.clock()
+        while True:
+            try:
+                # with a timeout, so that a soft timeout can interrupt the wait
+                rec = self.queue.get(timeout=1.0)
+                break
+            except queue.Empty:
+                pass
+        if isinstance(rec, BaseException):
+            raise rec
+        if tracer is not None:
+            tracer.recordIn(rec, start)
+        return rec
+
+    def _waitForData(self):
+        if self.queue is None:
+            InputStream._waitForData(self)
+            return
+        self._conn._processRecord(self._nextRecord())
+
+    def drain(self):
+        """
+        Waits for the rest of the body, which the application did not read.
+        Its records only go through the capture and the access log.
+        """
+        while self.queue is not None and not self._eof:
+            rec = self._nextRecord()
+            self._conn._observeRecord(rec)
+            if not rec.contentLength:
+                self._eof = True
+
+
+class ReadAheadConnection(Connection):
+    """
+    A Connection reading the records sent by the web server in a background
+    thread.
+
+    A request starts as soon as its parameters are received: its body is
+    put in a queue of its own by the background thread, and the
+    application reads it from there while the web server is still sending
+    it, instead of waiting for the whole body to be buffered. The other
+    records go through another queue to the main thread. Each queue holds
+    at most maxRecords records (64 KB each at most).
+
+    The request ends once its whole body has been received, so that the
+    capture and the access log see all its records, as with Connection.
+    """
+
+    _inputStreamClass = StreamedInputStream
+    maxRecords = 1024
+
+    def __init__(self, stdin, stdout, server):
+        Connection.__init__(self, stdin, stdout, server)
+        self._queue = queue.Queue(self.maxRecords)
+        self._reader = None
+
+    def _readAhead(self):
+        inputs = {}
+        while True:
+            rec = Record()
+            try:
+                rec.read(self._stdin)
+            except BaseException as e:
+                # raised in the main thread when it reaches this point
+                for input in inputs.values():
+                    input.put(e)
+                self._queue.put(e)
+                return
+            if rec.type == FCGI_BEGIN_REQUEST:
+                rec.input = inputs[rec.requestId] = queue.Queue(self.maxRecords)
+                rec.input.closed = False
+            elif rec.type == FCGI_STDIN and rec.requestId in inputs:
+                input = inputs[rec.requestId]
+                if not rec.contentLength:
+                    del inputs[rec.requestId]
+                if input.closed:
+                    self._queue.put(rec)
+                    continue
+                input.put(rec)
+                if input.closed:
+                    # closed while the record was queued
+                    self._forwardInput(input)
+                continue
+            self._queue.put(rec)
+
+    def _forwardInput(self, input):
+        """Hands the records of a closed request queue to the main thread."""
+        try:
+            while True:
+                self._queue.put(input.get_nowait())
+        except queue.Empty:
+            pass
+
+    def _readRecord(self):
+        if self._reader is None:
+            self._reader = threading.Thread(target=self._readAhead, name='winfcgi-read-ahead')
+            self._reader.daemon = True
+            self._reader.start()
+        rec = self._queue.get()
+        if isinstance(rec, BaseException):
+            raise rec
+        return rec
+
+    def _do_begin_request(self, inrec):
+        Connection._do_begin_request(self, inrec)
+        req = self._requests.get(inrec.requestId)
+        if req is not None:
+            req.stdin.queue = inrec.input
+        else:
+            self._closeInput(inrec.input)
+
+    def _do_params(self, inrec):
+        Connection._do_params(self, inrec)
+        req = self._requests.get(inrec.requestId)
+        if req is not None and not inrec.contentLength:
+            self._start_request(req)
+
+    def _do_stdin(self, inrec):
+        req = self._requests.get(inrec.requestId)
+        if req is not None:
+            if self._tracer is not None:
+                start = self._tracer.clock()
+            req.stdin.add_data(inrec.contentData)
+            if self._tracer is not None:
+                self._tracer.span('buffer stdin', start, bytes=inrec.contentLength)
+
+    def _start_request(self, req):
+        input = req.stdin.queue
+        try:
+            Connection._start_request(self, req)
+        finally:
+            self._closeInput(input)
+
+    def end_request(self, req, appStatus=long_int('0'), protocolStatus=FCGI_REQUEST_COMPLETE, remove=True):
+        req.stdin.drain()
+        Connection.end_request(self, req, appStatus, protocolStatus, remove)
+
+    def _closeInput(self, input):
+        """Drops the queued body records of a request that has not run or did not end."""
+        input.closed = True
+        try:
+            while True:
+                rec = input.get_nowait()
+                if not isinstance(rec, BaseException):
+                    self._observeRecord(rec)
+        except queue.Empty:
+            pass
+
+
+def make_connection_class(options):
+    """Returns the Connection class to use according to a FCGI_READ_AHEAD setting."""
+    if not options:
+        return None
+    if options is True:
+        options = {}
+    return type('ReadAheadConnection', (ReadAheadConnection,),
+                {'maxRecords': options.get('MAX_RECORDS', ReadAheadConnection.maxRecords)})
+
+
+def encode_response_head(status, headers):
+    """
+    Encodes the CGI status line and the response headers.
+
+    The encoded bytes, terminated by an empty line, are returned.
+    """
+    s = 'Status: %s\r\n' % status
+    for header in headers:
+        s += '%s: %s\r\n' % header
+    s += '\r\n'
+    return s.encode(FCGI_CONTENT_ENCODING)
+
+
+def decode_response_head(head):
+    """
+    Decodes bytes encoded by encode_response_head.
+
+    The status and the list of headers are returned.
+    """
+    lines = head.decode(FCGI_CONTENT_ENCODING).split('\r\n')
+    status = lines[0][len('Status: '):]
+    headers = [tuple(line.split(': ', 1)) for line in lines[1:] if line]
+    return status, headers
+
+
+def header_environ_name(header):
+    """Returns the WSGI environ key of a request header (Accept-Encoding -> HTTP_ACCEPT_ENCODING)."""
+    return 'HTTP_' + header.upper().replace('-', '_')
+
+
+def get_header(headers, name, default=None):
+    """Returns the value of the first response header matching name (case insensitive)."""
+    name = name.lower()
+    for header, value in headers:
+        if header.lower() == name:
+            return value
+    return default
+
+
+def parse_cache_control(value):
+    """
+    Parses a Cache-Control header value.
+
+    A dictionary mapping lower cased directives to their value (or True
+    for directives without value) is returned.
+    """
+    directives = {}
+    if value:
+        for part in value.split(','):
+            name, sep, arg = part.strip().partition('=')
+            if name:
+                directives[name.lower()] = arg.strip('" ') if sep else True
+    return directives
+
+
+def request_key(environ, varyKeys):
+    """
+    Returns the key identifying the response to a GET or HEAD request:
+    PATH_INFO, QUERY_STRING and the values of the varyKeys environ entries.
+    None is returned for other requests and authenticated ones.
+    """
+    if environ.get('REQUEST_METHOD', 'GET') not in ('GET', 'HEAD'):
+        return None
+    if 'HTTP_AUTHORIZATION' in environ:
+        return None
+    return (environ.get('PATH_INFO', ''), environ.get('QUERY_STRING', '')) + \
+           tuple(environ.get(name, '') for name in varyKeys)
+
+
+def varies_only_on(headers, varyNames):
+    """Returns True if the Vary header of a response only names headers of varyNames (lower cased)."""
+    for name in get_header(headers, 'Vary', '').split(','):
+        name = name.strip().lower()
+        if name and name not in varyNames:
+            return False
+    return True
+
+
+def etag_matches(ifNoneMatch, etag):
+    """Returns True if an If-None-Match header value matches etag (weak comparison)."""
+    if not ifNoneMatch or not etag:
+        return False
+    etags = [value.strip() for value in ifNoneMatch.split(',')]
+    if '*' in etags:
+        return True
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    return etag in etags or 'W/' + etag in etags
+
+
+class ResponseRecorder(object):
+    """
+    Keeps a copy of the response body written by the application.
+
+    Recording stops (and the copy is dropped) as soon as the body grows
+    over limit bytes.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+        self.overflow = False
+        self._chunks = []
+
+    def add(self, data):
+        if self.overflow:
+            return
+        self.size += len(data)
+        if self.size > self.limit:
+            self.overflow = True
+            self._chunks = []
+        else:
+            self._chunks.append(data)
+
+    def getvalue(self):
+        return b''.join(self._chunks)
+
+
+class ResponseBuffer(object):
+    """
+    Holds back the response body until it is complete.
+
+    hold() returns False once the body grows over limit bytes. The held
+    back data must then be sent with release() and the response streamed.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+        self.active = True
+        self._chunks = []
+
+    def hold(self, data):
+        self._chunks.append(data)
+        self.size += len(data)
+        if self.size > self.limit:
+            self.active = False
+        return self.active
+
+    def release(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+# Headers kept in 304 responses
+NOT_MODIFIED_HEADERS = ('cache-control', 'content-location', 'date', 'etag', 'expires', 'last-modified', 'vary',
+                        'set-cookie')
+
+
+class ConditionalGet(object):
+    """
+    Adds a strong ETag (a hash of the body) to the 200 responses to GET
+    and HEAD requests whose body fits in maxSize bytes, and answers with
+    a 304 when it matches the If-None-Match header of the request, so
+    that unchanged bodies are not sent again.
+
+    notModified and bytesSaved count the 304 responses sent and the body
+    bytes they avoided sending.
+    """
+
+    def __init__(self, maxSize=1024 * 1024):
+        self.maxSize = maxSize
+        self.notModified = 0
+        self.bytesSaved = 0
+
+    def etag(self, body):
+        return '"%s"' % hashlib.md5(body).hexdigest()
+
+    def applies(self, environ):
+        return environ['REQUEST_METHOD'] in ('GET', 'HEAD')
+
+    def complete(self, result, headers):
+        """
+        Returns True if the application returned its body at once: a list,
+        a tuple or a Django response that does not stream. Streamed bodies
+        and event streams are never held back to be hashed.
+        """
+        if not isinstance(result, (list, tuple)) and getattr(result, 'streaming', True):
+            return False
+        contentType = get_header(headers, 'Content-Type') or ''
+        return not contentType.lower().startswith('text/event-stream')
+
+    def process(self, environ, status, headers, body):
+        """
+        Adds the ETag to a complete response. The status, headers and body
+        to send are returned.
+        """
+        if not status.startswith('200'):
+            return status, headers, body
+        if get_header(headers, 'ETag') is None:
+            if 'no-store' in parse_cache_control(get_header(headers, 'Cache-Control')):
+                return status, headers, body
+            headers.append(('ETag', self.etag(body)))
+        if not etag_matches(environ.get('HTTP_IF_NONE_MATCH'), get_header(headers, 'ETag')):
+            return status, headers, body
+
+        self.notModified += 1
+        self.bytesSaved += len(body)
+        headers = [(name, value) for name, value in headers if name.lower() in NOT_MODIFIED_HEADERS]
+        return '304 Not Modified', headers, b''
+
+
+def make_conditional_get(options):
+    """Creates a ConditionalGet from a FCGI_CONDITIONAL_GET setting."""
+    if not options:
+        return None
+    if options is True:
+        options = {}
+    return ConditionalGet(maxSize=options.get('MAX_SIZE', 1024 * 1024))
+
+
+class StreamBatch(object):
+    """
+    Coalesces the small chunks of a streamed response.
+
+    The headers and the first chunk are sent right away. The next chunks
+    are held back until maxSize bytes are pending, or sent by the flusher
+    thread of the StreamBatching once the oldest one has waited maxDelay
+    seconds. Event streams are never held back.
+
+    send is the function writing the response; it is called with the
+    lock held, from the thread running the request or the flusher thread.
+    """
+
+    def __init__(self, batching, send):
+        self.batching = batching
+        self.send = send
+        self.size = 0
+        self.deadline = None
+        self.passThrough = None
+        self.closed = False
+        self.error = None
+        self._lock = threading.Lock()
+        self._chunks = []
+
+    def add(self, data, headers):
+        """Sends data, or holds it back."""
+        batching = self.batching
+        with self._lock:
+            if self.error is not None:
+                raise self.error
+            batching.chunks += 1
+            if self.passThrough is None:
+                contentType = get_header(headers, 'Content-Type') or ''
+                self.passThrough = contentType.lower().startswith('text/event-stream')
+                self._send(data)
+            elif self.passThrough:
+                self._send(data)
+            else:
+                self._chunks.append(data)
+                self.size += len(data)
+                if self.size >= batching.maxSize:
+                    self._flush()
+                elif self.deadline is None:
+                    self.deadline = time.time() + batching.maxDelay
+                    batching.schedule(self, self.deadline)
+
+    def flush(self):
+        """Sends the held back chunks."""
+        with self._lock:
+            if self.error is not None:
+                raise self.error
+            if self._chunks:
+                self._flush()
+
+    def expire(self, deadline):
+        """Called by the flusher thread when the delay of the chunks held back since deadline is over."""
+        with self._lock:
+            if self.closed or self.deadline != deadline:
+                return
+            try:
+                self._flush()
+            except Exception as e:
+                # raised in the request thread by the next add() or flush()
+                self.error = e
+
+    def close(self):
+        """Drops the held back chunks once the response is over."""
+        with self._lock:
+            self.closed = True
+            self.deadline = None
+            self._chunks = []
+            self.size = 0
+
+    def _flush(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        self.size = 0
+        self.deadline = None
+        self._send(data)
+
+    def _send(self, data):
+        self.batching.writes += 1
+        self.send(data)
+
+
+class StreamBatching(object):
+    """
+    Creates the StreamBatch of each response and flushes them from a
+    daemon thread when their delay is over.
+
+    chunks and writes count the chunks produced by the applications and
+    the writes they have been coalesced into.
+    """
+
+    def __init__(self, maxSize=8192, maxDelay=0.1):
+        self.maxSize = maxSize
+        self.maxDelay = maxDelay
+        self.chunks = 0
+        self.writes = 0
+        self._condition = threading.Condition()
+        self._pending = []
+        self._thread = None
+
+    def batch(self, send):
+        return StreamBatch(self, send)
+
+    def schedule(self, batch, deadline):
+        """Makes the flusher thread call batch.expire(deadline) at deadline."""
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='fcgi-stream-batching')
+                self._thread.daemon = True
+                self._thread.start()
+            self._pending.append((deadline, batch))
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    now = time.time()
+                    due = [item for item in self._pending if item[0] <= now]
+                    if due:
+                        self._pending = [item for item in self._pending if item[0] > now]
+                        break
+                    self._condition.wait(min(item[0] for item in self._pending) - now if self._pending else None)
+            for deadline, batch in due:
+                batch.expire(deadline)
+
+
+def make_stream_batching(options):
+    """Creates a StreamBatching from a FCGI_STREAM_BATCHING setting."""
+    if not options:
+        return None
+    if options is True:
+        options = {}
+    return StreamBatching(maxSize=options.get('MAX_SIZE', 8192), maxDelay=options.get('MAX_DELAY', 0.1))
+
+
+class CachedResponse(object):
+    """A complete response stored in a ResponseCache."""
+
+    _Header = struct.Struct('<ddI')
+
+    def __init__(self, status, headers, body, stored, expires):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.stored = stored
+        self.expires = expires
+        self.size = len(body) + len(encode_response_head(status, headers))
+
+    def encode(self):
+        """Returns the response encoded as bytes."""
+        head = encode_response_head(self.status, self.headers)
+        return self._Header.pack(self.stored, self.expires, len(head)) + head + self.body
+
+    @classmethod
+    def decode(cls, value):
+        """Returns the CachedResponse encoded in value by encode()."""
+        stored, expires, headLength = cls._Header.unpack_from(value)
+        start = cls._Header.size
+        status, headers = decode_response_head(value[start:start + headLength])
+        return cls(status, headers, value[start + headLength:], stored, expires)
+
+
+class ResponseCache(object):
+    """
+    In-process cache of complete responses for GET and HEAD requests.
+
+    Entries are keyed on PATH_INFO, QUERY_STRING and the values of the
+    configured vary request headers. A response is only stored when it
+    carries an explicit freshness lifetime (Cache-Control s-maxage/max-age
+    or Expires, unless a default timeout is set), does not set cookies and
+    does not vary on a header missing from the configured ones. Least
+    recently used entries are evicted once maxEntries or maxSize (in bytes)
+    is exceeded.
+
+    The cache is published to the application as environ['fcgi.response_cache']
+    so views can call invalidate() or clear() when the underlying data
+    changes. Successful unsafe requests (POST, PUT, ...) invalidate their
+    path automatically.
+    """
+
+    cacheableStatuses = (200, 203, 300, 301, 404, 410)
+
+    def __init__(self, maxSize=32 * 1024 * 1024, maxEntrySize=1024 * 1024,
+                 maxEntries=1000, vary=('Host',), defaultTimeout=0):
+        self.maxSize = maxSize
+        self.maxEntrySize = maxEntrySize
+        self.maxEntries = maxEntries
+        self.defaultTimeout = defaultTimeout
+        self.vary = tuple(vary)
+        self._varyKeys = tuple(header_environ_name(header) for header in self.vary)
+        self._varyNames = set(header.lower() for header in self.vary)
+        self._entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, environ):
+        """Returns the cache key of a request, or None if it cannot be served from the cache."""
+        return request_key(environ, self._varyKeys)
+
+    def get(self, key):
+        """Returns the fresh CachedResponse stored under key, or None."""
+        entry = self._entries.pop(key, None)
+        if entry is not None and entry.expires <= time.time():
+            self.size -= entry.size
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        # reinsert to mark the entry as the most recently used
+        self._entries[key] = entry
+        self.hits += 1
+        return entry
+
+    def lifetime(self, status, headers):
+        """Returns the number of seconds a response may be cached (0 if it is not cacheable)."""
+        if int(status[:3]) not in self.cacheableStatuses:
+            return 0
+        if get_header(headers, 'Set-Cookie') is not None:
+            return 0
+        if not varies_only_on(headers, self._varyNames):
+            return 0
+
+        directives = parse_cache_control(get_header(headers, 'Cache-Control'))
+        if 'no-store' in directives or 'no-cache' in directives or 'private' in directives:
+            return 0
+        for directive in ('s-maxage', 'max-age'):
+            if directive in directives:
+                try:
+                    return max(int(directives[directive]), 0)
+                except ValueError:
+                    return 0
+
+        expires = get_header(headers, 'Expires')
+        if expires is not None:
+            expires = parsedate_tz(expires)
+            if expires is None:
+                return 0
+            date = parsedate_tz(get_header(headers, 'Date', ''))
+            now = mktime_tz(date) if date is not None else time.time()
+            return max(int(mktime_tz(expires) - now), 0)
+
+        return self.defaultTimeout
+
+    def store(self, key, status, headers, body):
+        """Stores a response if it is cacheable. Returns True if it has been stored."""
+        if len(body) > self.maxEntrySize:
+            return False
+        lifetime = self.lifetime(status, headers)
+        if lifetime <= 0:
+            return False
+
+        now = time.time()
+        entry = CachedResponse(status, list(headers), body, now, now + lifetime)
+        self._remove(key)
+        self._entries[key] = entry
+        self.size += entry.size
+        while self._entries and (self.size > self.maxSize or len(self._entries) > self.maxEntries):
+            self._remove(next(iter(self._entries)))
+        return key in self._entries
+
+    def invalidate(self, path):
+        """Removes all the entries stored for path (the PATH_INFO of the requests)."""
+        for key in [key for key in self._entries if key[0] == path]:
+            self._remove(key)
+
+    def clear(self):
+        """Removes all the entries."""
+        self._entries.clear()
+        self.size = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SharedResponseCache(ResponseCache):
+    """
+    ResponseCache keeping its entries in a memory-mapped file (see
+    django_windows_tools.sharedmem.SharedCache) instead of the process
+    memory. All the winfcgi processes of the host using the same location
+    share the entries, so a response rendered by one of them is served by
+    all the others and is held only once in memory.
+    """
+
+    def __init__(self, location, maxSize=32 * 1024 * 1024, maxEntrySize=1024 * 1024,
+                 vary=('Host',), defaultTimeout=0):
+        ResponseCache.__init__(self, maxSize, maxEntrySize, 0, vary, defaultTimeout)
+        # leave room for the key and the headers in the largest chunks
+        self._shared = SharedCache(location, size=maxSize, max_chunk=maxEntrySize + 16384)
+
+    def _encode_key(self, key):
+        return '\x00'.join(key).encode('utf-8')
+
+    def get(self, key):
+        value = self._shared.get(self._encode_key(key))
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return CachedResponse.decode(value)
+
+    def store(self, key, status, headers, body):
+        if len(body) > self.maxEntrySize:
+            return False
+        lifetime = self.lifetime(status, headers)
+        if lifetime <= 0:
+            return False
+        now = time.time()
+        entry = CachedResponse(status, headers, body, now, now + lifetime)
+        return self._shared.set(self._encode_key(key), entry.encode(), entry.expires)
+
+    def invalidate(self, path):
+        self._shared.delete_prefix(path.encode('utf-8') + b'\x00')
+
+    def clear(self):
+        self._shared.clear()
+
+
+def make_response_cache(options):
+    """Creates a ResponseCache from a FCGI_RESPONSE_CACHE settings dictionary."""
+    if not options:
+        return None
+    if options.get('LOCATION'):
+        return SharedResponseCache(
+            options['LOCATION'],
+            maxSize=options.get('MAX_SIZE', 32 * 1024 * 1024),
+            maxEntrySize=options.get('MAX_ENTRY_SIZE', 1024 * 1024),
+            vary=options.get('VARY', ('Host',)),
+            defaultTimeout=options.get('TIMEOUT', 0),
+        )
+    return ResponseCache(
+        maxSize=options.get('MAX_SIZE', 32 * 1024 * 1024),
+        maxEntrySize=options.get('MAX_ENTRY_SIZE', 1024 * 1024),
+        maxEntries=options.get('MAX_ENTRIES', 1000),
+        vary=options.get('VARY', ('Host',)),
+        defaultTimeout=options.get('TIMEOUT', 0),
+    )
+
+
+class Authorizer(object):
+    """
+    Answers the requests of the FCGI_AUTHORIZER role: the web server asks
+    whether a request may proceed before serving it by itself.
+
+    function is called with a Django request built from the parameters
+    (no middleware has run) and returns True to allow the request, False
+    to deny it with a 403 response, or an HttpResponse: a 200 response
+    allows the request (its Variable-* headers are passed to the web
+    server), any other one is sent to the client.
+
+    Decisions are cached for ttl seconds and the least recently used ones
+    are evicted beyond maxEntries. The cache key holds every input of the
+    request the function may use: the KEY_VARIABLES, the value of the
+    cookie (or the whole Cookie header if cookie is None) and the vary
+    request headers.
+    """
+
+    KEY_VARIABLES = ('REQUEST_METHOD', 'HTTP_HOST', 'PATH_INFO', 'QUERY_STRING', 'REMOTE_ADDR',
+                     'HTTP_AUTHORIZATION')
+
+    def __init__(self, function, ttl=60, maxEntries=10000, cookie=None, vary=()):
+        self.function = function
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        self.cookie = cookie
+        self._keyVariables = self.KEY_VARIABLES + tuple(header_environ_name(header) for header in vary)
+        self._decisions = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, environ):
+        cookies = environ.get('HTTP_COOKIE', '')
+        if self.cookie is not None:
+            match = re.search(r'(?:^|;)\s*%s=([^;]*)' % re.escape(self.cookie), cookies)
+            cookies = match.group(1) if match else None
+        return (cookies,) + tuple(environ.get(name) for name in self._keyVariables)
+
+    def decide(self, environ):
+        """Returns the (status, headers, body) answering an authorization request."""
+        from django.core.handlers.wsgi import WSGIRequest
+
+        result = self.function(WSGIRequest(environ))
+        if result is True:
+            return '200 OK', [], b''
+        if not result:
+            return '403 Forbidden', [('Content-Type', 'text/plain')], b'Forbidden'
+        return '%d %s' % (result.status_code, result.reason_phrase), list(result.items()), result.content
+
+    def handle(self, req, environ):
+        key = self.key(environ)
+        now = time.time()
+        decision = self._decisions.pop(key, None)
+        if decision is not None and decision[0] > now:
+            self.hits += 1
+        else:
+            self.misses += 1
+            decision = (now + self.ttl,) + self.decide(environ)
+            while len(self._decisions) >= self.maxEntries:
+                self._decisions.popitem(last=False)
+        self._decisions[key] = decision
+        expires, status, headers, body = decision
+        if status[:3] == '200':
+            # only the variables are meaningful for the web server
+            headers, body = [header for header in headers if header[0].lower().startswith('variable-')], b''
+        req.stdout.write(encode_response_head(status, headers))
+        if body:
+            req.stdout.write(body)
+        req.stdout.flush()
+        return FCGI_REQUEST_COMPLETE, 0
+
+
+def make_authorizer(options):
+    """Creates an Authorizer from a FCGI_AUTHORIZER_ROLE settings dictionary."""
+    if not options:
+        return None
+    function = options['CALLABLE']
+    if not callable(function):
+        try:
+            from django.utils.module_loading import import_string
+        except ImportError:
+            from django.utils.module_loading import import_by_path as import_string
+        function = import_string(function)
+    return Authorizer(function, ttl=options.get('TTL', 60), maxEntries=options.get('MAX_ENTRIES', 10000),
+                      cookie=options.get('COOKIE'), vary=options.get('VARY', ()))
+
+
+class RequestCoalescer(object):
+    """
+    Runs identical concurrent GET requests only once across the winfcgi
+    processes of the host.
+
+    The first process receiving a request takes a lock named after its
+    key (computed like the ResponseCache key) in a memory-mapped file. The
+    processes receiving the same request while the lock is held wait for
+    the response of the first one and send it instead of calling the
+    application. They run the request themselves after timeout seconds,
+    or as soon as the lock is released without a shareable response. Only
+    the 2xx and 3xx responses are shared, except 304 ones that answer the
+    conditional headers of the first request. Responses setting cookies,
+    varying on other headers or larger than maxSize bytes are not shared
+    either.
+
+    paths, when given, is a list of regular expressions restricting the
+    PATH_INFO of the coalesced requests. Requests with cookies are only
+    coalesced when Cookie is in vary.
+    """
+
+    def __init__(self, location, timeout=5, pollInterval=0.01, vary=('Host',), paths=None,
+                 maxSize=1024 * 1024, size=8 * 1024 * 1024):
+        self.timeout = timeout
+        self.pollInterval = pollInterval
+        self.maxSize = maxSize
+        self.vary = tuple(vary)
+        self._varyKeys = tuple(header_environ_name(header) for header in self.vary)
+        self._varyNames = set(header.lower() for header in self.vary)
+        self._paths = [re.compile(path) for path in paths] if paths else None
+        self._shared = SharedCache(location, size=size, max_chunk=maxSize + 16384)
+        self.led = 0
+        self.coalesced = 0
+        self.timeouts = 0
+
+    def key(self, environ):
+        """Returns the key of a request, or None if it is not eligible."""
+        if environ.get('REQUEST_METHOD') != 'GET':
+            return None
+        if 'HTTP_COOKIE' in environ and 'cookie' not in self._varyNames:
+            return None
+        if self._paths is not None and not any(path.search(environ['PATH_INFO']) for path in self._paths):
+            return None
+        key = request_key(environ, self._varyKeys)
+        if key is None:
+            return None
+        return '\x00'.join(key).encode('utf-8')
+
+    def lead(self, key):
+        """Takes the lock of key. Returns False if another process holds it."""
+        if self._shared.add(b'L' + key, str(os.getpid()).encode('ascii'), time.time() + self.timeout):
+            self.led += 1
+            return True
+        return False
+
+    def _result(self, key, since):
+        value = self._shared.get(b'R' + key)
+        if value is not None:
+            entry = CachedResponse.decode(value)
+            if entry.stored >= since:
+                return entry
+        return None
+
+    def wait(self, key):
+        """Waits for the response of the process holding the lock of key. Returns None if none is shared."""
+        start = time.time()
+        deadline = start + self.timeout
+        while time.time() < deadline:
+            time.sleep(self.pollInterval)
+            entry = self._result(key, start)
+            if entry is None and self._shared.get(b'L' + key) is None:
+                # the lock has been released: last chance for a response
+                entry = self._result(key, start)
+                if entry is None:
+                    return None
+            if entry is not None:
+                self.coalesced += 1
+                return entry
+        self.timeouts += 1
+        return None
+
+    def publish(self, key, status, headers, body):
+        """Shares the response of the request whose lock is held."""
+        if status[:1] not in ('2', '3') or status[:3] == '304':
+            return
+        if len(body) > self.maxSize or get_header(headers, 'Set-Cookie') is not None:
+            return
+        if not varies_only_on(headers, self._varyNames):
+            return
+        now = time.time()
+        entry = CachedResponse(status, headers, body, now, now + self.timeout)
+        self._shared.set(b'R' + key, entry.encode(), entry.expires)
+
+    def release(self, key):
+        """Releases the lock of key."""
+        self._shared.delete(b'L' + key)
+
+
+def make_coalescer(options):
+    """Creates a RequestCoalescer from a FCGI_COALESCING settings dictionary."""
+    if not options:
+        return None
+    return RequestCoalescer(
+        options['LOCATION'],
+        timeout=options.get('TIMEOUT', 5),
+        pollInterval=options.get('POLL_INTERVAL', 0.01),
+        vary=options.get('VARY', ('Host',)),
+        paths=options.get('PATHS'),
+        maxSize=options.get('MAX_SIZE', 1024 * 1024),
+        size=options.get('SIZE', 8 * 1024 * 1024),
+    )
+
+
+def get_rss():
+    """Returns the resident memory (working set) of the current process in bytes, or None if unknown."""
+    try:
+        import win32api
+        import win32process
+        return win32process.GetProcessMemoryInfo(win32api.GetCurrentProcess())['WorkingSetSize']
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return None
+
+
+class RateLimiter(object):
+    """
+    Limits the rate of the requests of each client across the winfcgi
+    processes of the host, with token buckets kept in a memory-mapped file.
+
+    Clients are identified by the key environ variable (REMOTE_ADDR by
+    default, which is also used for the requests without key). Each of them can make burst requests at once, and rate
+    requests per second afterwards. Other requests are answered with a
+    429 response without calling the application. paths, when given, is a
+    list of regular expressions restricting the PATH_INFO of the limited
+    requests.
+
+    Headers like HTTP_X_FORWARDED_FOR are sent by the clients: they are
+    only a safe key behind a proxy that overwrites them.
+    """
+
+    def __init__(self, location, rate=10, burst=20, key='REMOTE_ADDR', paths=None, entries=65536):
+        self.rate = rate
+        self.burst = burst
+        self.key = key
+        self._paths = [re.compile(path) for path in paths] if paths else None
+        self._buckets = TokenBuckets(location, entries=entries)
+        self.limited = 0
+
+    def check(self, environ):
+        """Returns 0 if the request can run, or else the number of seconds the client should wait."""
+        client = environ.get(self.key) or environ.get('REMOTE_ADDR')
+        if not client:
+            return 0
+        if self._paths is not None and not any(path.search(environ['PATH_INFO']) for path in self._paths):
+            return 0
+        wait = self._buckets.take(client.encode('utf-8'), self.rate, self.burst)
+        if wait:
+            self.limited += 1
+        return wait
+
+    def handle(self, req, environ):
+        """Answers the request with a 429 if the client is over the limit. Returns True if it has been answered."""
+        wait = self.check(environ)
+        if not wait:
+            return False
+        if FCGI_DEBUG: logging.debug('rate limit: %s %s' % (environ.get(self.key), environ['PATH_INFO']))
+        body = b'Too Many Requests'
+        req.stdout.write(encode_response_head('429 Too Many Requests', [
+            ('Content-Type', 'text/plain'), ('Content-Length', str(len(body))),
+            ('Retry-After', str(int(math.ceil(wait))))]))
+        if environ['REQUEST_METHOD'] != 'HEAD':
+            req.stdout.write(body)
+        req.stdout.flush()
+        return True
+
+
+def make_rate_limiter(options):
+    """Creates a RateLimiter from a FCGI_RATE_LIMIT settings dictionary."""
+    if not options:
+        return None
+    if not options.get('RATE', 10) > 0:
+        raise ImproperlyConfigured('FCGI_RATE_LIMIT RATE must be a positive number of requests per second')
+    return RateLimiter(options['LOCATION'], rate=options.get('RATE', 10), burst=options.get('BURST', 20),
+                       key=options.get('KEY', 'REMOTE_ADDR'), paths=options.get('PATHS'),
+                       entries=options.get('ENTRIES', 65536))
+
+
+class MemoryWatchdog(object):
+    """
+    Checks the resident memory of the process every checkEvery requests.
+
+    IIS only recycles the processes after a number of requests or some idle
+    time, so a process leaking or fragmenting memory can grow for a long
+    time. Once softLimit bytes are exceeded, the server finishes the
+    current request and exits so that IIS starts a fresh process for the
+    next one. A sample of the memory is kept every sampleEvery requests and
+    logged as the growth curve of the process.
+    """
+
+    def __init__(self, softLimit, checkEvery=1, sampleEvery=100, history=50):
+        self.softLimit = softLimit
+        self.checkEvery = checkEvery
+        self.sampleEvery = sampleEvery
+        self.samples = deque(maxlen=history)
+
+    def check(self, requests):
+        """Returns True if the process must exit after requests requests."""
+        if requests % self.checkEvery and requests % self.sampleEvery and requests != 1:
+            return False
+        rss = get_rss()
+        if rss is None:
+            return False
+        if requests == 1 or requests % self.sampleEvery == 0:
+            self.samples.append((requests, rss))
+        if rss <= self.softLimit:
+            return False
+
+        self.samples.append((requests, rss))
+        logging.warning('memory watchdog: %d bytes used after %d requests (soft limit %d), exiting' % (
+            rss, requests, self.softLimit))
+        logging.warning('memory watchdog: growth (requests: MB) %s' % ', '.join(
+            '%d: %.1f' % (count, size / 1048576.0) for count, size in self.samples))
+        return True
+
+
+def make_memory_watchdog(options):
+    """Creates a MemoryWatchdog from a FCGI_MEMORY_LIMIT setting (a dictionary or a number of bytes)."""
+    if not options:
+        return None
+    if not isinstance(options, dict):
+        options = {'SOFT_LIMIT': options}
+    return MemoryWatchdog(options['SOFT_LIMIT'], checkEvery=options.get('CHECK_EVERY', 1),
+                          sampleEvery=options.get('SAMPLE_EVERY', 100))
+
+
+class Recycler(object):
+    """
+    Makes the process exit by itself after a number of requests or an
+    uptime, before IIS recycles it.
+
+    Each limit is lowered by a random fraction (up to jitter) drawn when
+    the process starts, so that processes started together do not retire
+    together. When location (a memory-mapped file) is given, at most one
+    process of the host retires every stagger seconds; the others postpone
+    their exit until they find the slot free.
+
+    The warmup paths are requested through the application once the first
+    request of the process has been answered, so that the views, templates
+    and caches they use are loaded before the following requests. They are
+    not requested before the first request: IIS only starts a process when
+    a request is waiting for it.
+    """
+
+    def __init__(self, maxRequests=None, maxUptime=None, jitter=0.1, location=None, stagger=30,
+                 warmup=(), warmupHost='localhost'):
+        spread = 1 - random.uniform(0, jitter)
+        self.requestLimit = int(maxRequests * spread) if maxRequests else None
+        self.uptimeLimit = maxUptime * spread if maxUptime else None
+        self.stagger = stagger
+        self.warmup = warmup
+        self.warmupHost = warmupHost
+        self.started = time.time()
+        self._shared = SharedCache(location, size=1024 * 1024, max_chunk=1024) if location else None
+
+    def check(self, requests):
+        """Returns True if the process should exit once the current request is over."""
+        uptime = time.time() - self.started
+        if not ((self.requestLimit and requests >= self.requestLimit) or
+                (self.uptimeLimit and uptime >= self.uptimeLimit)):
+            return False
+        if self._shared is not None and \
+                not self._shared.add(b'recycling', str(os.getpid()).encode('ascii'), time.time() + self.stagger):
+            # another process is retiring
+            return False
+        logging.info('recycling: exiting after %d requests and %d s' % (requests, uptime))
+        return True
+
+    def warm(self, server):
+        """Runs the warm up requests through the application of server."""
+        for path in self.warmup:
+            path, _, query = path.partition('?')
+            environ = dict(server.environ)
+            environ.update({
+                'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': query, 'SCRIPT_NAME': '',
+                'SERVER_NAME': self.warmupHost, 'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1',
+                'HTTP_HOST': self.warmupHost, 'REMOTE_ADDR': '127.0.0.1',
+                'wsgi.version': (1, 0), 'wsgi.url_scheme': 'http', 'wsgi.input': BytesIO(),
+                'wsgi.errors': sys.stderr, 'wsgi.multithread': False, 'wsgi.multiprocess': False,
+                'wsgi.run_once': False,
+            })
+            response = []
+            start = time.time()
+            try:
+                result = server.application(environ, lambda status, headers, exc_info=None: response.append(status))
+                try:
+                    for data in result:
+                        pass
+                finally:
+                    if hasattr(result, 'close'):
+                        result.close()
+            except Exception as e:
+                logging.exception(e)
+            logging.info('recycling: warm up of %s: %s in %.1f ms' % (
+                path, response[0] if response else 'failed', (time.time() - start) * 1000))
+
+
+def make_recycler(options):
+    """Creates a Recycler from a FCGI_RECYCLE settings dictionary."""
+    if not options:
+        return None
+    return Recycler(maxRequests=options.get('MAX_REQUESTS'), maxUptime=options.get('MAX_UPTIME'),
+                    jitter=options.get('JITTER', 0.1), location=options.get('LOCATION'),
+                    stagger=options.get('STAGGER', 30), warmup=options.get('WARMUP', ()),
+                    warmupHost=options.get('WARMUP_HOST', 'localhost'))
+
+
+class WorkerStatus(object):
+    """
+    Publishes the state of the process in a slot of a Scoreboard shared by
+    all the processes of the host: idle or busy, the path and start time of
+    the current request, the number of requests served, the resident memory
+    (measured every rssEvery requests) and the last error. The
+    winfcgi_status command displays the scoreboard.
+    """
+
+    def __init__(self, scoreboard, rssEvery=10):
+        self.scoreboard = scoreboard
+        self.rssEvery = rssEvery
+        self.slot = None
+
+    def start(self):
+        self.slot = self.scoreboard.claim()
+        if self.slot is None:
+            logging.warning('scoreboard: no free slot in %s' % self.scoreboard.path)
+        else:
+            self.scoreboard.update(self.slot, rss=get_rss() or 0)
+
+    def beginRequest(self, environ):
+        if self.slot is not None:
+            self.scoreboard.update(self.slot, state=Scoreboard.BUSY, path=environ.get('PATH_INFO', ''),
+                                   request_start=time.time())
+
+    def endRequest(self, requests):
+        if self.slot is not None:
+            if self.rssEvery and requests % self.rssEvery == 0:
+                self.scoreboard.update(self.slot, state=Scoreboard.IDLE, requests=requests, rss=get_rss() or 0)
+            else:
+                self.scoreboard.update(self.slot, state=Scoreboard.IDLE, requests=requests)
+
+    def error(self, message):
+        if self.slot is not None:
+            self.scoreboard.update(self.slot, error='%s %s' % (datetime.datetime.now().strftime('%H:%M:%S'), message))
+
+    def stop(self):
+        if self.slot is not None:
+            self.scoreboard.release(self.slot)
+            self.slot = None
+
+
+def make_worker_status(options):
+    """Creates a WorkerStatus from a FCGI_SCOREBOARD settings dictionary."""
+    if not options:
+        return None
+    return WorkerStatus(Scoreboard(options['LOCATION'], slots=options.get('SLOTS', 64)),
+                        rssEvery=options.get('RSS_EVERY', 10))
+
+
+class GCPolicy(object):
+    """
+    Moves the cyclic garbage collections out of the requests.
+
+    While a request runs, the generation 0 threshold is raised to
+    requestThreshold so that collections only happen for requests
+    allocating a lot. Once the response has been sent, the collections
+    the interpreter would have done (according to the normal thresholds,
+    idleThreshold for generation 0) are run before reading the next
+    request.
+
+    With freeze (Python 3.7+), the objects alive after the first
+    freezeAfter requests (the warmed up Django modules, URLconf, templates,
+    ...) are moved to the permanent generation and never scanned again.
+    """
+
+    def __init__(self, freeze=True, freezeAfter=1, idleThreshold=700, requestThreshold=100000):
+        self.freeze = freeze and hasattr(gc, 'freeze')
+        self.freezeAfter = freezeAfter
+        self.idleThreshold = idleThreshold
+        self.requestThreshold = requestThreshold
+        self.thresholds = gc.get_threshold()
+        self.collections = 0
+        self.collectTime = 0.0
+
+    def beginRequest(self):
+        gc.set_threshold(self.requestThreshold, self.thresholds[1], self.thresholds[2])
+
+    def endRequest(self, requests):
+        # no automatic collection until the next request begins
+        gc.set_threshold(0)
+        count0, count1, count2 = gc.get_count()
+        if self.freeze and requests == self.freezeAfter:
+            start = time.time()
+            gc.collect()
+            gc.freeze()
+            logging.info('gc: %d objects frozen in %.1f ms' % (gc.get_freeze_count(), (time.time() - start) * 1000))
+        elif count0 >= self.idleThreshold:
+            if count2 >= self.thresholds[2] and count1 >= self.thresholds[1]:
+                generation = 2
+            elif count1 >= self.thresholds[1]:
+                generation = 1
+            else:
+                generation = 0
+            start = time.time()
+            gc.collect(generation)
+            elapsed = time.time() - start
+            self.collections += 1
+            self.collectTime += elapsed
+            if FCGI_DEBUG: logging.debug('gc: generation %d collected in %.1f ms' % (generation, elapsed * 1000))
+
+
+def make_gc_policy(options):
+    """Creates a GCPolicy from a FCGI_GC settings dictionary."""
+    if not options:
+        return None
+    if options is True:
+        options = {}
+    return GCPolicy(freeze=options.get('FREEZE', True), freezeAfter=options.get('FREEZE_AFTER', 1),
+                    idleThreshold=options.get('IDLE_THRESHOLD', 700),
+                    requestThreshold=options.get('REQUEST_THRESHOLD', 100000))
+
+
+class RequestProfiler(object):
+    """
+    Profiles one request out of every with cProfile, as well as the
+    requests whose PATH_INFO matches pattern.
+
+    The statistics are aggregated per view (the name of the resolved URL
+    pattern, or PATH_INFO if it cannot be resolved) and dumped every
+    dumpInterval seconds and when the process exits, in files named
+    fcgi_profile_<pid>_<view>.pstats in the path directory. Those files
+    can be loaded and merged with pstats.Stats.
+    """
+
+    def __init__(self, path, every=100, pattern=None, dumpInterval=300):
+        self.path = path
+        self.every = every
+        self.pattern = re.compile(pattern) if pattern else None
+        self.dumpInterval = dumpInterval
+        self._stats = {}
+        self._count = 0
+        self._profile = None
+        self._lastDump = time.time()
+
+    def beginRequest(self, environ):
+        self._count += 1
+        if (self.every and self._count % self.every == 0) or \
+                (self.pattern is not None and self.pattern.search(environ.get('PATH_INFO', ''))):
+            import cProfile
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+    def endRequest(self, environ):
+        if self._profile is None:
+            return
+        profile, self._profile = self._profile, None
+        profile.disable()
+
+        import pstats
+        key = self.key(environ)
+        if key in self._stats:
+            self._stats[key].add(profile)
+        else:
+            self._stats[key] = pstats.Stats(profile)
+        if time.time() - self._lastDump >= self.dumpInterval:
+            self.dump()
+
+    def key(self, environ):
+        """Returns the name under which the profile of a request is aggregated."""
+        path = environ.get('PATH_INFO', '')
+        try:
+            try:
+                from django.urls import resolve, Resolver404
+            except ImportError:
+                from django.core.urlresolvers import resolve, Resolver404
+            return resolve(path).view_name or path
+        except Exception:
+            return path
+
+    def dump(self):
+        """Writes the aggregated statistics."""
+        self._lastDump = time.time()
+        for key, stats in self._stats.items():
+            name = re.sub(r'[^A-Za-z0-9_.-]+', '_', key).strip('_') or 'root'
+            try:
+                stats.dump_stats(os.path.join(self.path, 'fcgi_profile_%d_%s.pstats' % (os.getpid(), name)))
+            except (IOError, OSError) as e:
+                logging.error('Could not dump the profile of %s: %s' % (key, e))
+
+
+def make_profiler(options):
+    """Creates a RequestProfiler from a FCGI_PROFILE settings dictionary."""
+    if not options:
+        return None
+    if options is True:
+        options = {}
+    return RequestProfiler(options.get('PATH', FCGI_LOG_PATH), every=options.get('EVERY', 100),
+                           pattern=options.get('PATTERN'), dumpInterval=options.get('DUMP_INTERVAL', 300))
+
+
+class StackTracer(object):
+    """
+    Reports where slow requests are stuck.
+
+    A daemon thread watches the running request. Once it has been running
+    for threshold seconds, the stack of the thread running it is appended
+    every interval seconds to fcgi_slow_<pid>.log in the path directory,
+    along with the request line, a summary of its parameters and the
+    elapsed time. The file is written as the request runs, so that the
+    reports survive the process being killed by IIS.
+    """
+
+    SUMMARY_PARAMS = ('REQUEST_METHOD', 'PATH_INFO', 'QUERY_STRING', 'HTTP_HOST', 'REMOTE_ADDR',
+                      'CONTENT_TYPE', 'CONTENT_LENGTH', 'HTTP_USER_AGENT')
+
+    def __init__(self, path, threshold=30, interval=10, maxValueLength=200):
+        self.filename = os.path.join(path, 'fcgi_slow_%d.log' % os.getpid())
+        self.threshold = threshold
+        self.interval = interval
+        self.maxValueLength = maxValueLength
+        self.reports = 0
+        self._current = None
+        self._thread = None
+        self._wake = threading.Event()
+
+    def beginRequest(self, environ):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._watch, name='winfcgi-stack-tracer')
+            self._thread.daemon = True
+            self._thread.start()
+        summary = [(name, environ[name][:self.maxValueLength]) for name in self.SUMMARY_PARAMS if environ.get(name)]
+        self._current = (threading.current_thread().ident, time.time(), summary)
+
+    def endRequest(self):
+        self._current = None
+
+    def _watch(self):
+        tick = min(self.threshold, self.interval) / 4.0
+        reported = None
+        while True:
+            self._wake.wait(tick)
+            current = self._current
+            if current is None:
+                continue
+            ident, start, summary = current
+            now = time.time()
+            if now - start < self.threshold:
+                continue
+            if reported is not None and reported[0] is current and now - reported[1] < self.interval:
+                continue
+            reported = (current, now)
+            frame = sys._current_frames().get(ident)
+            if frame is not None and self._current is current:
+                self.report(now - start, summary, frame)
+
+    def report(self, elapsed, summary, frame):
+        """Appends the stack of frame to the report file."""
+        lines = ['%s pid %d: request running for %.1f s' % (datetime.datetime.now().isoformat(), os.getpid(), elapsed)]
+        lines += ['  %s=%s' % item for item in summary]
+        lines += ['    %s:%d in %s: %s' % (filename, lineno, name, line or '')
+                  for filename, lineno, name, line in traceback.extract_stack(frame)]
+        self.reports += 1
+        logging.warning('slow request: %s %s running for %.1f s' % (
+            dict(summary).get('REQUEST_METHOD', ''), dict(summary).get('PATH_INFO', ''), elapsed))
+        try:
+            f = open(self.filename, 'a')
+            try:
+                f.write('\n'.join(lines) + '\n\n')
+            finally:
+                f.close()
+        except (IOError, OSError) as e:
+            logging.error('Could not write the slow request report: %s' % e)
+
+
+def make_stack_tracer(options):
+    """Creates a StackTracer from a FCGI_SLOW_REQUESTS settings dictionary."""
+    if not options:
+        return None
+    if options is True:
+        options = {}
+    return StackTracer(options.get('PATH', FCGI_LOG_PATH), threshold=options.get('THRESHOLD', 30),
+                       interval=options.get('INTERVAL', 10))
+
+
+class RequestTimeout(BaseException):
+    """
+    Raised in the thread running a request that passed its soft timeout.
+
+    It does not derive from Exception so that Django does not turn it into
+    a 500 response.
+    """
+
+
+class SoftTimeout(object):
+    """
+    Interrupts the requests running for more than timeout seconds.
+
+    A daemon thread raises RequestTimeout asynchronously in the thread
+    running the request once its deadline is passed. The request is then
+    answered with a 504 response (if nothing has been sent yet) and the
+    process goes on with the next one, instead of being killed by IIS
+    once its requestTimeout is reached. The exception is only delivered
+    when the interpreter runs Python code: a request blocked in a system
+    or database call is interrupted when the call returns.
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.timeouts = 0
+        self._current = None
+        self._fired = False
+        self._lock = threading.Lock()
+        self._thread = None
+        self._wake = threading.Event()
+
+    def _setAsyncExc(self, ident, exception):
+        import ctypes
+        threadId = ctypes.c_ulong(ident) if sys.version_info >= (3, 7) else ctypes.c_long(ident)
+        # None is passed as NULL, which cancels a pending exception
+        return ctypes.pythonapi.PyThreadState_SetAsyncExc(
+            threadId, ctypes.py_object(exception) if exception is not None else None)
+
+    def arm(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._watch, name='winfcgi-soft-timeout')
+            self._thread.daemon = True
+            self._thread.start()
+        self._current = (threading.current_thread().ident, time.time() + self.timeout)
+
+    def disarm(self):
+        with self._lock:
+            current, self._current = self._current, None
+            if self._fired:
+                # cancel the exception if it has not been delivered yet
+                self._fired = False
+                if current is not None:
+                    self._setAsyncExc(current[0], None)
+
+    def _watch(self):
+        tick = min(1.0, self.timeout / 4.0)
+        while True:
+            self._wake.wait(tick)
+            current = self._current
+            if current is None or time.time() < current[1]:
+                continue
+            with self._lock:
+                if self._current is current and not self._fired:
+                    self._fired = True
+                    self.timeouts += 1
+                    self._setAsyncExc(current[0], RequestTimeout)
+
+
+def make_soft_timeout(options):
+    """Creates a SoftTimeout from a FCGI_SOFT_TIMEOUT setting (a dictionary or a number of seconds)."""
+    if not options:
+        return None
+    if not isinstance(options, dict):
+        options = {'TIMEOUT': options}
+    return SoftTimeout(options['TIMEOUT'])
+
+
+class StaticFile(object):
+    """Metadata of a file served by StaticFiles."""
+
+    def __init__(self, path, stat, checked):
+        self.path = path
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.checked = checked
+        self.etag = '"%x-%x"' % (int(self.mtime * 1000000), self.size)
+        self.lastModified = formatdate(self.mtime, usegmt=True)
+        self.contentType = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+
+class StaticFiles(object):
+    """
+    Serves files under configured URL prefixes without calling the WSGI
+    application.
+
+    The metadata of served files is kept in memory and checked again on
+    disk at most every checkInterval seconds. Responses carry ETag and
+    Last-Modified headers and conditional requests are answered with 304.
+    Bodies are sent from a memory map of the file. Requests for missing
+    files are passed to the application.
+    """
+
+    def __init__(self, paths, maxAge=None, checkInterval=2):
+        # longest prefixes first
+        self.paths = sorted(((prefix, os.path.abspath(root)) for prefix, root in paths.items()),
+                            key=lambda path: -len(path[0]))
+        self.maxAge = maxAge
+        self.checkInterval = checkInterval
+        self._index = {}
+
+    def lookup(self, pathInfo):
+        """Returns the StaticFile for pathInfo, or None if it is not a served file."""
+        now = time.time()
+        info = self._index.get(pathInfo)
+        if info is not None and now - info.checked < self.checkInterval:
+            return info
+
+        for prefix, root in self.paths:
+            if pathInfo.startswith(prefix):
+                path = os.path.normpath(os.path.join(root, pathInfo[len(prefix):]))
+                break
+        else:
+            return None
+
+        self._index.pop(pathInfo, None)
+        if not path.startswith(root + os.sep):
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if not os.path.isfile(path):
+            return None
+        info = StaticFile(path, stat, now)
+        self._index[pathInfo] = info
+        return info
+
+    def isModified(self, info, environ):
+        """Returns False if the conditional headers of the request match info."""
+        ifNoneMatch = environ.get('HTTP_IF_NONE_MATCH')
+        if ifNoneMatch is not None:
+            return not etag_matches(ifNoneMatch, info.etag)
+        ifModifiedSince = environ.get('HTTP_IF_MODIFIED_SINCE')
+        if ifModifiedSince is not None:
+            date = parsedate_tz(ifModifiedSince.split(';')[0])
+            if date is not None and int(info.mtime) <= mktime_tz(date):
+                return False
+        return True
+
+    def handle(self, req, environ):
+        """Answers the request if it targets a static file. Returns True if it has been answered."""
+        if environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+            return False
+        info = self.lookup(environ['PATH_INFO'])
+        if info is None:
+            return False
+
+        headers = [('ETag', info.etag), ('Last-Modified', info.lastModified)]
+        if self.maxAge is not None:
+            headers.append(('Cache-Control', 'max-age=%d' % self.maxAge))
+
+        if not self.isModified(info, environ):
+            req.stdout.write(encode_response_head('304 Not Modified', headers))
+            return True
+
+        headers += [('Content-Type', info.contentType), ('Content-Length', str(info.size))]
+        try:
+            f = open(info.path, 'rb')
+        except IOError:
+            self._index.pop(environ['PATH_INFO'], None)
+            return False
+        try:
+            req.stdout.write(encode_response_head('200 OK', headers))
+            if environ['REQUEST_METHOD'] == 'GET' and info.size:
+                body = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    view = memoryview(body)
+                    req.stdout.write(view)
+                    view.release()
+                finally:
+                    body.close()
+            req.stdout.flush()
+        finally:
+            f.close()
+        return True
+
+
+def make_static_files(options):
+    """Creates StaticFiles from a FCGI_STATIC_FILES settings dictionary."""
+    if not options:
+        return None
+    if options is True:
+        options = {}
+    paths = options.get('PATHS')
+    if paths is None:
+        paths = {}
+        if getattr(settings, 'STATIC_ROOT', None) and getattr(settings, 'STATIC_URL', '').startswith('/'):
+            paths[settings.STATIC_URL] = settings.STATIC_ROOT
+    if not paths:
+        return None
+    return StaticFiles(paths, maxAge=options.get('MAX_AGE'), checkInterval=options.get('CHECK_INTERVAL', 2))
+
+
+def relocate(options, location):
+    """
+    Returns a copy of the settings dictionary of a host-wide store with its
+    LOCATION file moved to the location directory.
+    """
+    if not location or not isinstance(options, dict) or not options.get('LOCATION'):
+        return options
+    return dict(options, LOCATION=os.path.join(location, os.path.basename(options['LOCATION'])))
+
+
+def get_server_options(capture=True, location=None):
+    """
+    Returns the FCGIServer keyword arguments configured in the Django settings.
+
+    The traffic capture, the access log and the scoreboard are left out if
+    capture is False. If location is given, the files shared by the processes
+    of the host (response cache, coalescing, rate limiting and recycling) are
+    kept in this directory instead of their LOCATION, so that the server does
+    not change the state of the production processes.
+    """
+    return dict(
+        response_cache=make_response_cache(relocate(FCGI_RESPONSE_CACHE, location)),
+        static_files=make_static_files(FCGI_STATIC_FILES),
+        conditional_get=make_conditional_get(FCGI_CONDITIONAL_GET),
+        stream_batching=make_stream_batching(FCGI_STREAM_BATCHING),
+        coalescer=make_coalescer(relocate(FCGI_COALESCING, location)),
+        capture=make_capture(FCGI_CAPTURE) if capture else None,
+        memory_watchdog=make_memory_watchdog(FCGI_MEMORY_LIMIT),
+        gc_policy=make_gc_policy(FCGI_GC),
+        profiler=make_profiler(FCGI_PROFILE),
+        stack_tracer=make_stack_tracer(FCGI_SLOW_REQUESTS),
+        soft_timeout=make_soft_timeout(FCGI_SOFT_TIMEOUT),
+        recycler=make_recycler(relocate(FCGI_RECYCLE, location)),
+        access_log=make_access_log(FCGI_ACCESS_LOG) if capture else None,
+        tracer=make_tracer(FCGI_TRACE),
+        worker_status=make_worker_status(FCGI_SCOREBOARD) if capture else None,
+        rate_limiter=make_rate_limiter(relocate(FCGI_RATE_LIMIT, location)),
+        authorizer=make_authorizer(FCGI_AUTHORIZER_ROLE),
+        connection_class=make_connection_class(FCGI_READ_AHEAD),
+    )
+
+
+def get_application():
+    """Returns the Django application run by the bridge: the WSGI one, or the ASGI one if FCGI_ASGI is set."""
+    if FCGI_ASGI:
+        from django.core.asgi import get_asgi_application
+        from django_windows_tools.asgi import ASGIBridge
+        return ASGIBridge(get_asgi_application())
+    from django.core.handlers.wsgi import WSGIHandler
+    return WSGIHandler()
+
+
 class FCGIServer(object):
     request_class = Request
     maxwrite = 8192
@@ -775,7 +3020,12 @@ class FCGIServer(object):
     def __init__(self, application, environ=None,
                  multithreaded=False, multiprocess=False,
                  debug=False, roles=(FCGI_RESPONDER,),
-                 app_root=None):
+                 app_root=None, response_cache=None, static_files=None,
+                 conditional_get=None, coalescer=None, capture=None,
+                 memory_watchdog=None, gc_policy=None, profiler=None,
+                 stack_tracer=None, soft_timeout=None, recycler=None, access_log=None,
+                 tracer=None, worker_status=None, rate_limiter=None, authorizer=None,
+                 connection_class=None, stream_batching=None):
         if environ is None:
             environ = {}
 
@@ -785,7 +3035,7 @@ class FCGIServer(object):
         self.multiprocess = multiprocess
         self.debug = debug
         self.roles = roles
-        self._connectionClass = Connection
+        self._connectionClass = connection_class or Connection
         self.capability = {
             # If threads aren't available, these are pretty much correct.
             FCGI_MAX_CONNS: 1,
@@ -793,18 +3043,124 @@ class FCGIServer(object):
             FCGI_MPXS_CONNS: 0
         }
         self.app_root = app_root
+        self.response_cache = response_cache
+        self.static_files = static_files
+        self.conditional_get = conditional_get
+        self.stream_batching = stream_batching
+        self.coalescer = coalescer
+        self.capture = capture
+        self.memory_watchdog = memory_watchdog
+        self.gc_policy = gc_policy
+        self.profiler = profiler
+        self.stack_tracer = stack_tracer
+        self.soft_timeout = soft_timeout
+        self.recycler = recycler
+        self.access_log = access_log
+        self.tracer = tracer
+        self.worker_status = worker_status
+        self.rate_limiter = rate_limiter
+        self.authorizer = authorizer
+        if authorizer is not None and FCGI_AUTHORIZER not in self.roles:
+            self.roles = tuple(self.roles) + (FCGI_AUTHORIZER,)
+        self.requestCount = 0
 
     def run(self):
+        import msvcrt
         msvcrt.setmode(sys.stdin.fileno(), os.O_BINARY)
         stdin = os.fdopen(sys.stdin.fileno(), 'rb', 0)
         stdout = os.fdopen(sys.stdout.fileno(), 'wb', 0)
 
-        conn = Connection(stdin, stdout, self)
+        conn = self._connectionClass(stdin, stdout, self)
+        if self.worker_status is not None:
+            self.worker_status.start()
         try:
             conn.run()
         except Exception as e:
             logging.exception(e)
             raise
+        finally:
+            self._log_stats()
+            if self.capture is not None:
+                self.capture.close()
+            if self.access_log is not None:
+                self.access_log.flush()
+            if self.worker_status is not None:
+                self.worker_status.stop()
+            if self.profiler is not None:
+                self.profiler.dump()
+
+    def before_request(self, conn, req):
+        """Called by the Connection when a request is about to run."""
+        if self.gc_policy is not None:
+            self.gc_policy.beginRequest()
+        if self.worker_status is not None:
+            self.worker_status.beginRequest(req.params)
+
+    def request_started(self, environ):
+        """
+        Called by the handler once the environ of the request is complete:
+        PATH_INFO is decoded and does not include app_root.
+        """
+        if self.profiler is not None:
+            self.profiler.beginRequest(environ)
+        if self.stack_tracer is not None:
+            self.stack_tracer.beginRequest(environ)
+
+    def after_request(self, conn, req):
+        """Called by the Connection once a request is over, before reading the next one."""
+        self.requestCount += 1
+        if self.access_log is not None:
+            self.access_log.endRequest(req.params)
+        if self.tracer is not None:
+            self.tracer.endRequest(req.params)
+        if self.worker_status is not None:
+            self.worker_status.endRequest(self.requestCount)
+        if self.stack_tracer is not None:
+            self.stack_tracer.endRequest()
+        if self.profiler is not None:
+            self.profiler.endRequest(req.params)
+        if self.recycler is not None and self.requestCount == 1:
+            # IIS only starts a process for a waiting request: warming up
+            # before reading it would delay that request
+            self.recycler.warm(self)
+        if self.gc_policy is not None:
+            self.gc_policy.endRequest(self.requestCount)
+        if self.memory_watchdog is not None and self.memory_watchdog.check(self.requestCount):
+            conn.stop()
+        elif self.recycler is not None and self.recycler.check(self.requestCount):
+            conn.stop()
+
+    def request_error(self, req, message):
+        """Called by Request when the handler failed."""
+        if self.worker_status is not None:
+            self.worker_status.error('%s %s' % (req.params.get('PATH_INFO', ''), message))
+
+    def _log_stats(self):
+        """Logs the counters of the optional server features."""
+        if self.response_cache is not None:
+            logging.info('response cache: %d hits, %d misses' % (self.response_cache.hits,
+                                                                 self.response_cache.misses))
+        if self.conditional_get is not None:
+            logging.info('conditional get: %d not modified responses, %d bytes saved' % (
+                self.conditional_get.notModified, self.conditional_get.bytesSaved))
+        if self.stream_batching is not None:
+            logging.info('stream batching: %d chunks sent in %d writes' % (self.stream_batching.chunks,
+                                                                          self.stream_batching.writes))
+        if self.coalescer is not None:
+            logging.info('coalescing: %d requests run, %d coalesced, %d timeouts' % (
+                self.coalescer.led, self.coalescer.coalesced, self.coalescer.timeouts))
+        if self.authorizer is not None:
+            logging.info('authorizer: %d cached decisions, %d computed' % (self.authorizer.hits,
+                                                                          self.authorizer.misses))
+        if self.rate_limiter is not None:
+            logging.info('rate limit: %d requests rejected' % self.rate_limiter.limited)
+        if self.soft_timeout is not None and self.soft_timeout.timeouts:
+            logging.info('soft timeout: %d requests interrupted' % self.soft_timeout.timeouts)
+        if self.stack_tracer is not None and self.stack_tracer.reports:
+            logging.info('slow requests: %d stack reports' % self.stack_tracer.reports)
+        if self.gc_policy is not None:
+            logging.info('gc: %d collections between requests, %.1f ms' % (
+                self.gc_policy.collections, self.gc_policy.collectTime * 1000))
 
     def handler(self, req):
         """Special handler for WSGI."""
@@ -817,9 +3173,7 @@ class FCGIServer(object):
 
         environ['wsgi.version'] = (1, 0)
         environ['wsgi.input'] = req.stdin
-        # TODO - sys.stderr appears to be None here?? (on Windows/IIS)
-        stderr = TeeOutputStream((sys.stderr, req.stderr))
-        environ['wsgi.errors'] = stderr
+        environ['wsgi.errors'] = req.errors
         environ['wsgi.multithread'] = False
         environ['wsgi.multiprocess'] = False
         environ['wsgi.run_once'] = False
@@ -830,6 +3184,54 @@ class FCGIServer(object):
             environ['wsgi.url_scheme'] = 'http'
 
         self._sanitizeEnv(environ)
+        self.request_started(environ)
+
+        if req.role == FCGI_AUTHORIZER:
+            return self.authorizer.handle(req, environ)
+
+        tracer = self.tracer
+        if tracer is not None and tracer.current is None:
+            tracer = None
+        if tracer is not None:
+            environ['fcgi.trace'] = tracer.current
+
+        if self.rate_limiter is not None and self.rate_limiter.handle(req, environ):
+            return FCGI_REQUEST_COMPLETE, 0
+
+        if self.static_files is not None and self.static_files.handle(req, environ):
+            return FCGI_REQUEST_COMPLETE, 0
+
+        cache = self.response_cache
+        cache_key = None
+        recorder = None
+        if cache is not None:
+            environ['fcgi.response_cache'] = cache
+            cache_key = cache.key(environ)
+            if cache_key is not None:
+                entry = cache.get(cache_key)
+                if entry is not None:
+                    self._send_cached(req, environ, entry)
+                    return FCGI_REQUEST_COMPLETE, 0
+                if environ['REQUEST_METHOD'] == 'GET':
+                    recorder = ResponseRecorder(cache.maxEntrySize)
+
+        coalescer = self.coalescer
+        flight = None
+        if coalescer is not None:
+            flight = coalescer.key(environ)
+            if flight is not None and not coalescer.lead(flight):
+                entry = coalescer.wait(flight)
+                if entry is not None:
+                    self._send_cached(req, environ, entry)
+                    return FCGI_REQUEST_COMPLETE, 0
+                flight = None
+            if flight is not None and (recorder is None or recorder.limit < coalescer.maxSize):
+                recorder = ResponseRecorder(coalescer.maxSize)
+
+        conditional = self.conditional_get
+        buffer = None
+        if conditional is not None and conditional.applies(environ):
+            buffer = ResponseBuffer(conditional.maxSize)
 
         headers_set = []
         headers_sent = []
@@ -839,6 +3241,22 @@ class FCGIServer(object):
             assert type(data) is bytes_type, 'write() argument must be bytes'
             assert headers_set, 'write() before start_response()'
 
+            if recorder is not None:
+                recorder.add(data)
+            if buffer is not None and buffer.active:
+                if buffer.hold(data):
+                    return
+                # too large to be buffered: stream it
+                data = buffer.release()
+            stream(data)
+
+        def stream(data):
+            if batch is not None:
+                batch.add(data, headers_set[1])
+            else:
+                send(data)
+
+        def send(data):
             if not headers_sent:
                 status, responseHeaders = headers_sent[:] = headers_set
                 found = False
@@ -853,15 +3271,13 @@ class FCGIServer(object):
                                                     str(len(data))))
                     except:
                         pass
-                s = 'Status: %s\r\n' % status
-                for header in responseHeaders:
-                    s += '%s: %s\r\n' % header
-                s += '\r\n'
-                req.stdout.write(s.encode(FCGI_CONTENT_ENCODING))
+                req.stdout.write(encode_response_head(status, responseHeaders))
 
             req.stdout.write(data)
             req.stdout.flush()
 
+        batch = self.stream_batching.batch(send) if self.stream_batching is not None else None
+
         def start_response(status, response_headers, exc_info=None):
             if exc_info:
                 try:
@@ -890,13 +3306,39 @@ class FCGIServer(object):
 
         try:
             try:
+                if tracer is not None:
+                    start = tracer.clock()
                 result = self.application(environ, start_response)
+                if tracer is not None:
+                    tracer.span('application', start)
+                    start = tracer.clock()
+                if buffer is not None and buffer.active and \
+                        not conditional.complete(result, headers_set[1] if headers_set else ()):
+                    buffer.active = False
+                    data = buffer.release()
+                    if data:
+                        stream(data)
                 try:
                     for data in result:
                         if data:
                             write(make_bytes(data))
-                    if not headers_sent:
-                        write(b'')  # in case body was empty
+                    if tracer is not None:
+                        tracer.span('response', start)
+                    if buffer is not None and buffer.active and headers_set:
+                        body = buffer.release()
+                        if get_header(headers_set[1], 'Content-Length') is None:
+                            headers_set[1].append(('Content-Length', str(len(body))))
+                        status, responseHeaders, body = conditional.process(
+                            environ, headers_set[0], headers_set[1], body)
+                        headers_sent[:] = [status, responseHeaders]
+                        self._send_response(req, status, responseHeaders, body)
+                    else:
+                        if batch is not None:
+                            batch.flush()
+                        if not headers_sent:
+                            send(b'')  # in case body was empty
+                    if flight is not None and not recorder.overflow:
+                        coalescer.publish(flight, headers_set[0], headers_set[1], recorder.getvalue())
                 finally:
                     # if hasattr(result, 'close'):
                     #    result.close()
@@ -907,10 +3349,42 @@ class FCGIServer(object):
             except:
                 raise
         finally:
-            pass
+            if batch is not None:
+                batch.close()
+            if flight is not None:
+                coalescer.release(flight)
+
+        if cache is not None and headers_sent:
+            status, responseHeaders = headers_sent
+            if status[:3] == '304':
+                # keep the complete response generated by the application
+                status, responseHeaders = headers_set
+            if recorder is not None and not recorder.overflow:
+                cache.store(cache_key, status, responseHeaders, recorder.getvalue())
+            elif int(status[:3]) < 400 and \
+                    environ['REQUEST_METHOD'] not in ('GET', 'HEAD', 'OPTIONS', 'TRACE'):
+                cache.invalidate(environ['PATH_INFO'])
 
         return FCGI_REQUEST_COMPLETE, 0
 
+    def _send_response(self, req, status, headers, body=b''):
+        """Sends a complete response generated by the server itself."""
+        req.stdout.write(encode_response_head(status, headers))
+        if body:
+            req.stdout.write(body)
+        req.stdout.flush()
+
+    def _send_cached(self, req, environ, entry):
+        """Answers a request with a stored response."""
+        if FCGI_DEBUG: logging.debug('stored response sent: %s' % environ['PATH_INFO'])
+        status, headers, body = entry.status, entry.headers + [('Age', str(int(time.time() - entry.stored)))], \
+                                entry.body
+        if self.conditional_get is not None:
+            status, headers, body = self.conditional_get.process(environ, status, headers, body)
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            body = b''
+        self._send_response(req, status, headers, body)
+
     def _sanitizeEnv(self, environ):
         """Ensure certain values are present, if required by WSGI."""
 
@@ -982,6 +3456,20 @@ class FCGIServer(object):
                              b'Content-Type: text/html\r\n\r\n' +
                              errorpage)
 
+    def timeout_error(self, req):
+        """Called by Request when the handler has been interrupted by the soft timeout."""
+        errorpage = b"""<!DOCTYPE HTML PUBLIC "-//IETF//DTD HTML 2.0//EN">
+<html><head>
+<title>Gateway Timeout</title>
+</head><body>
+<h1>Gateway Timeout</h1>
+<p>The application took too long to answer the request.</p>
+</body></html>
+"""
+        req.stdout.write(b'Status: 504 Gateway Timeout\r\n' +
+                         b'Content-Type: text/html\r\n\r\n' +
+                         errorpage)
+
 
 def example_application(environ, start_response):
     '''example wsgi app which outputs wsgi environment'''
@@ -1030,13 +3518,13 @@ def run_django_app(django_settings_module, django_root):
     if FCGI_DEBUG: logging.info('DJANGO_SETTINGS_MODULE set to %s' % settings_module)
 
     try:
-        from django.core.handlers.wsgi import WSGIHandler
+        application = get_application()
     except ImportError:
         if FCGI_DEBUG: logging.error(
             'Could not import django.core.handlers.wsgi module. Check that django is installed and in PYTHONPATH.')
         raise
 
-    FCGIServer(WSGIHandler(), app_root=django_root).run()
+    FCGIServer(application, app_root=django_root, **get_server_options()).run()
 
 
 class Command(BaseCommand):
@@ -1053,13 +3541,13 @@ class Command(BaseCommand):
                 format='%(asctime)s [%(levelname)-5s] %(message)s',
                 level=logging.DEBUG)
         try:
-            from django.core.handlers.wsgi import WSGIHandler
+            application = get_application()
         except ImportError:
             if FCGI_DEBUG: logging.error(
                 'Could not import django.core.handlers.wsgi module. Check that django is installed and in PYTHONPATH.')
             raise
 
-        FCGIServer(WSGIHandler(), app_root=django_root, debug=settings.DEBUG).run()
+        FCGIServer(application, app_root=django_root, debug=settings.DEBUG, **get_server_options()).run()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,188 @@
+# encoding: utf-8
+
+# Replay of the FastCGI traffic captured by the winfcgi command
+#
+# Copyright (c) 2012 Openance SARL
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+from __future__ import print_function
+
+import io
+import time
+import shutil
+import struct
+import tempfile
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+
+from django_windows_tools.management.commands.winfcgi import FCGIServer, Connection, Record, \
+    read_capture, get_server_options, get_application, CAPTURE_IN, FCGI_BEGIN_REQUEST, FCGI_END_REQUEST, FCGI_STDOUT, \
+    FCGI_Header, FCGI_HEADER_LEN
+
+__author__ = 'Antoine Martin <antoine@openance.com>'
+
+
+class Session(object):
+    """The records of a captured request."""
+
+    def __init__(self, start):
+        self.start = start
+        self.end = None
+        self.input = io.BytesIO()
+        self.bytesOut = 0
+
+    def duration(self):
+        return self.end - self.start if self.end is not None else None
+
+
+def read_sessions(path):
+    '''Returns the list of the complete requests of a capture file, in order.'''
+    sessions = []
+    current = {}
+    with open(path, 'rb') as f:
+        for timestamp, direction, type, requestId, contentLength, content in read_capture(f):
+            if direction == CAPTURE_IN:
+                if type == FCGI_BEGIN_REQUEST:
+                    current[requestId] = Session(timestamp)
+                session = current.get(requestId)
+                if session is not None:
+                    rec = Record(type, requestId)
+                    rec.contentData = content
+                    rec.contentLength = contentLength
+                    rec.write(session.input)
+            else:
+                session = current.get(requestId)
+                if session is None:
+                    continue
+                if type == FCGI_STDOUT:
+                    session.bytesOut += contentLength
+                elif type == FCGI_END_REQUEST:
+                    session.end = timestamp
+                    sessions.append(current.pop(requestId))
+    return sessions
+
+
+def response_status(output):
+    '''Returns the status code of the response written in output (FastCGI records).'''
+    pos = 0
+    while pos + FCGI_HEADER_LEN <= len(output):
+        version, type, requestId, contentLength, paddingLength = \
+            struct.unpack(FCGI_Header, output[pos:pos + FCGI_HEADER_LEN])
+        pos += FCGI_HEADER_LEN
+        if type == FCGI_STDOUT and contentLength:
+            content = output[pos:pos + contentLength]
+            if content.startswith(b'Status: '):
+                return content[8:11].decode('ascii')
+            return '200'
+        pos += contentLength + paddingLength
+    return '---'
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+class Command(BaseCommand):
+    args = 'capture_file'
+    help = '''Replays the requests of a capture file written by the winfcgi command.
+
+    The captured requests are fed to the Django application in process, through
+    the same FastCGI bridge as the winfcgi command (configured with the same
+    settings), at the original pace multiplied by the speed factor. The original
+    and replayed response times are then compared. Unless --shared-stores is
+    given, the host-wide stores (response cache, coalescing, rate limiting) are
+    replaced by temporary ones.
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument('capture', help='Capture file written by winfcgi (see FCGI_CAPTURE)')
+        parser.add_argument(
+            '--speed',
+            dest='speed',
+            type=float,
+            default=1.0,
+            help='Replay speed factor. 0 replays the requests without delay')
+        parser.add_argument(
+            '--root',
+            dest='django_root',
+            default=None,
+            help='Root path stripped from the URLs, as for the winfcgi command')
+        parser.add_argument(
+            '--shared-stores',
+            action='store_true',
+            dest='shared_stores',
+            default=False,
+            help='Use the host-wide response cache, coalescing, rate limiting and recycling files of the '
+                 'settings instead of temporary ones. The replay then changes the state of the running processes')
+
+    def handle(self, *args, **options):
+        try:
+            sessions = read_sessions(options['capture'])
+        except (IOError, ValueError) as e:
+            raise CommandError('Cannot read the capture file: %s' % e)
+        if not sessions:
+            raise CommandError('The capture file does not contain any complete request')
+
+        location = None if options['shared_stores'] else tempfile.mkdtemp(prefix='winfcgi_replay_')
+        try:
+            self.replay(sessions, location, options)
+        finally:
+            if location is not None:
+                shutil.rmtree(location, ignore_errors=True)
+
+    def replay(self, sessions, location, options):
+        server = FCGIServer(get_application(), app_root=options['django_root'], debug=settings.DEBUG,
+                            **get_server_options(capture=False, location=location))
+
+        speed = options['speed']
+        first = sessions[0].start
+        started = time.time()
+        original, replayed, statuses = [], [], {}
+        for session in sessions:
+            if speed > 0:
+                delay = (session.start - first) / speed - (time.time() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            output = io.BytesIO()
+            conn = Connection(io.BytesIO(session.input.getvalue()), output, server)
+            start = time.time()
+            try:
+                conn.run()
+            except EOFError:
+                pass
+            replayed.append(time.time() - start)
+            original.append(session.duration())
+            status = response_status(output.getvalue())
+            statuses[status] = statuses.get(status, 0) + 1
+
+        self.stdout.write('%d requests replayed in %.2f s' % (len(sessions), time.time() - started))
+        self.stdout.write('statuses: %s' % ', '.join('%s: %d' % item for item in sorted(statuses.items())))
+        self.stdout.write('%-10s %10s %10s %10s' % ('', 'mean', 'p50', 'p99'))
+        for name, values in (('original', original), ('replayed', replayed)):
+            self.stdout.write('%-10s %8.1fms %8.1fms %8.1fms' % (
+                name, sum(values) / len(values) * 1000, percentile(values, 0.5) * 1000,
+                percentile(values, 0.99) * 1000))
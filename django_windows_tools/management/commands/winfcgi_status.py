@@ -0,0 +1,116 @@
+# encoding: utf-8
+
+# Live view of the scoreboard shared by the winfcgi processes
+#
+# Copyright (c) 2012 Openance SARL
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+import os
+import time
+import struct
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+
+from django_windows_tools.sharedmem import Scoreboard, process_alive
+
+__author__ = 'Antoine Martin <antoine@openance.com>'
+
+
+def format_duration(seconds):
+    if seconds < 60:
+        return '%.1fs' % seconds
+    if seconds < 3600:
+        return '%dm%02ds' % (seconds // 60, seconds % 60)
+    return '%dh%02dm' % (seconds // 3600, seconds % 3600 // 60)
+
+
+class Command(BaseCommand):
+    help = '''Displays the state of all the winfcgi processes of the host.
+
+    The processes publish their state in the scoreboard file configured with
+    the FCGI_SCOREBOARD setting.
+    '''
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--location',
+            dest='location',
+            default=(getattr(settings, 'FCGI_SCOREBOARD', None) or {}).get('LOCATION'),
+            help='Scoreboard file (defaults to the FCGI_SCOREBOARD LOCATION setting)')
+        parser.add_argument(
+            '--interval',
+            dest='interval',
+            type=float,
+            default=0,
+            help='Refreshes the display every interval seconds until interrupted')
+
+    def open_scoreboard(self, location):
+        # take the number of slots from the file, so that it is not reinitialized
+        try:
+            with open(location, 'rb') as f:
+                magic, slots = struct.unpack(Scoreboard.HEADER, f.read(Scoreboard.HEADER_LEN))
+        except (IOError, OSError, struct.error) as e:
+            raise CommandError('Cannot read the scoreboard %s: %s' % (location, e))
+        if magic != Scoreboard.magic:
+            raise CommandError('%s is not a scoreboard file' % location)
+        return Scoreboard(location, slots=slots)
+
+    def display(self, scoreboard):
+        now = time.time()
+        workers = scoreboard.read()
+        for slot, status in workers:
+            if not process_alive(status['pid']):
+                # killed before releasing its slot
+                status['state'] = 'dead'
+        states = [status['state'] for slot, status in workers]
+        self.stdout.write('%s - %d processes, %d busy, %d idle' % (
+            time.strftime('%Y-%m-%d %H:%M:%S'), len(workers), states.count('busy'), states.count('idle')))
+        self.stdout.write('%4s %7s %5s %9s %8s %8s %9s  %s' % (
+            'slot', 'pid', 'state', 'requests', 'rss', 'uptime', 'current', 'path / last error'))
+        for slot, status in workers:
+            current = format_duration(now - status['request_start']) if status['state'] == 'busy' else ''
+            self.stdout.write('%4d %7d %5s %9d %7.1fM %8s %9s  %s' % (
+                slot, status['pid'], status['state'], status['requests'], status['rss'] / 1048576.0,
+                format_duration(now - status['started']), current, status['path']))
+            if status['error']:
+                self.stdout.write('%56s  ! %s' % ('', status['error']))
+
+    def handle(self, *args, **options):
+        if not options['location']:
+            raise CommandError('No scoreboard: set FCGI_SCOREBOARD or use --location')
+        scoreboard = self.open_scoreboard(options['location'])
+        try:
+            while True:
+                if options['interval'] and os.name == 'nt':
+                    os.system('cls')
+                elif options['interval']:
+                    self.stdout.write('\x1b[H\x1b[2J', ending='')
+                self.display(scoreboard)
+                if not options['interval']:
+                    break
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            scoreboard.close()
@@ -26,19 +26,25 @@
 # OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
 # SUCH DAMAGE.
 #
-import win32serviceutil
-import os, os.path, sys, platform
+import os, os.path, sys, platform, time
 from os.path import abspath, dirname
 
-import win32service
-import win32event
-import win32con
-import win32file
-from multiprocessing import Process
+from multiprocessing import Process, cpu_count
 from multiprocessing.util import get_logger
 
 import ctypes
 import traceback
+import warnings
+
+from django_windows_tools.watcher import ConfigWatcher
+
+try:
+    import win32serviceutil
+    import win32service
+    import win32event
+except ImportError:
+    # Outside of Windows, only the ServiceSupervisor part of the service is available
+    win32serviceutil = None
 
 try:
     import ConfigParser
@@ -51,7 +57,11 @@ except ImportError:
 if hasattr(sys, 'real_prefix') and sys.platform == 'win32':
     sys.exec_prefix = os.path.join(sys.exec_prefix, 'Scripts')
 
-GenerateConsoleCtrlEvent = ctypes.windll.kernel32.GenerateConsoleCtrlEvent
+if sys.platform == 'win32':
+    GenerateConsoleCtrlEvent = ctypes.windll.kernel32.GenerateConsoleCtrlEvent
+
+# Limit of the number of handles waited by WaitForMultipleObjects
+MAXIMUM_WAIT_OBJECTS = 64
 
 try:
     import multiprocessing.forking as forking
@@ -102,13 +112,21 @@ except:
 
 def log(msg):
     '''Log a message in the Event Viewer as an informational message'''
-    import servicemanager
+    try:
+        import servicemanager
+    except ImportError:
+        get_logger().info(str(msg))
+        return
     servicemanager.LogInfoMsg(str(msg))
 
 
 def error(msg):
     '''Log a message in the Event Viewer as an error message'''
-    import servicemanager
+    try:
+        import servicemanager
+    except ImportError:
+        get_logger().error(str(msg))
+        return
     servicemanager.LogErrorMsg(str(msg))
 
 
@@ -142,14 +160,27 @@ def initialize_logger(config):
         sys.stderr = StdErrWrapper()
 
 
-def start_django_command(config, args):
+def set_affinity(cpu):
+    '''Bind the current process to a CPU.'''
+    from ctypes import wintypes
+    kernel32 = ctypes.windll.kernel32
+    kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+    kernel32.SetProcessAffinityMask.argtypes = [wintypes.HANDLE, ctypes.c_size_t]
+    if not kernel32.SetProcessAffinityMask(kernel32.GetCurrentProcess(), 1 << cpu):
+        error('Cannot bind the process to CPU %d' % cpu)
+
+
+def start_django_command(config, args, cpu=None):
     '''
     Start a Django management command.
     
     This commands is supposed to start in a spawned (child process).
     It tries to import the settings of the project before handling the command.
+    If cpu is not None, the process is bound to that CPU.
     '''
     initialize_logger(config)
+    if cpu is not None:
+        set_affinity(cpu)
 
     log('Starting command : %s' % ' '.join(args))
     get_logger().info('Starting command : %s' % ' '.join(args))
@@ -161,28 +192,85 @@ def start_django_command(config, args):
         error('Exception occured : %s' % traceback.format_exc())
 
 
-def spawn_command(config, server_name):
+def get_command_args(config, server_name, index=0):
     '''
-    Spawn a command specified in a configuration file and return the process object.
+    Return the command line of a command specified in a configuration file.
+
+    index is the number of the replica of the command, substituted for
+    %(index)s in its parameters.
     '''
     args = [getattr(sys.modules['__main__'], '__file__', __file__)]
     args.append(config.get(server_name, 'command'))
-    args += config.get(server_name, 'parameters').split()
-    process = Process(target=start_django_command, args=(config, args,))
+    args += config.get(server_name, 'parameters', vars={'index': str(index)}).split()
+    return args
+
+
+def spawn_command(config, server_name, index=0, cpu=None):
+    '''
+    Spawn a command specified in a configuration file and return the process object.
+    '''
+    args = get_command_args(config, server_name, index)
+    process = Process(target=start_django_command, args=(config, args, cpu))
     process.start()
     log('Spawned %s' % ' '.join(args))
     return process
 
 
+def get_services(config):
+    '''
+    Return the names of the commands to run on this machine.
+    '''
+    node_name = platform.node()
+    services = config.get(node_name, 'run') if config.has_section(node_name) else config.get('services', 'run')
+    return services.split()
+
+
+def get_replicas(config, server_name):
+    '''
+    Return the number of processes to run for a command, auto meaning one per CPU core.
+    '''
+    if not config.has_option(server_name, 'replicas'):
+        return 1
+    replicas = config.get(server_name, 'replicas').strip()
+    if replicas.lower() == 'auto':
+        return cpu_count()
+    return int(replicas)
+
+
+def get_affinity(config, server_name, index):
+    '''
+    Return the CPU the index-th replica of a command is bound to, or None.
+
+    The affinity option is either auto (one CPU per replica) or a list of
+    CPUs shared in turn by the replicas.
+    '''
+    if not config.has_option(server_name, 'affinity'):
+        return None
+    affinity = config.get(server_name, 'affinity').strip()
+    if affinity.lower() == 'auto':
+        return index % cpu_count()
+    cpus = [int(cpu) for cpu in affinity.replace(',', ' ').split()]
+    return cpus[index % len(cpus)]
+
+
+def get_instances(config):
+    '''
+    Return the (command name, replica index, cpu) of each process to run on this machine.
+    '''
+    instances = []
+    for server_name in get_services(config):
+        for index in range(get_replicas(config, server_name)):
+            instances.append((server_name, index, get_affinity(config, server_name, index)))
+    return instances
+
+
 def start_commands(config):
     '''
     Spawn all the commands specified in a configuration file and return an array containing all the processes.
     '''
     processes = []
-    node_name = platform.node()
-    services = config.get(node_name, 'run') if config.has_section(node_name) else config.get('services', 'run')
-    for server_name in services.split():
-        processes.append(spawn_command(config, server_name))
+    for server_name, index, cpu in get_instances(config):
+        processes.append(spawn_command(config, server_name, index, cpu))
 
     return processes
 
@@ -197,6 +285,104 @@ def end_commands(processes):
         process.join()
 
 
+def get_supervisor_options(config):
+    '''
+    Return the restart options of the supervisor section of the configuration file.
+    '''
+    values = dict(
+        backoff=1.0,
+        max_backoff=300.0,
+        stable=60.0,
+        crash_loop=5,
+    )
+    if config and config.has_section('supervisor'):
+        for (name, value) in config.items('supervisor'):
+            if name in values:
+                values[name] = type(values[name])(value)
+    return values
+
+
+class SupervisedCommand(object):
+    '''
+    A command of the configuration file run in a child process that is
+    restarted when it dies.
+
+    The restart is delayed by backoff seconds, doubled at each consecutive
+    crash up to max_backoff. A process that exits before running for
+    stable seconds has crashed, and crash_loop consecutive crashes are
+    reported as a crash loop and delay the restart by max_backoff.
+    '''
+
+    def __init__(self, config, server_name, index=0, cpu=None, backoff=1.0, max_backoff=300.0, stable=60.0,
+                 crash_loop=5):
+        self.config = config
+        self.server_name = server_name
+        self.index = index
+        self.cpu = cpu
+        self.name = '%s:%d' % (server_name, index) if index else server_name
+        self.args = get_command_args(config, server_name, index)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stable = stable
+        self.crash_loop = crash_loop
+        self.process = None
+        self.started = None
+        self.restart_at = None
+        self.restarts = 0
+        self.crashes = 0
+
+    @property
+    def sentinel(self):
+        '''Handle of the running process, signaled when it exits.'''
+        if self.process is None or self.restart_at is not None:
+            return None
+        try:
+            return self.process.sentinel
+        except AttributeError:
+            # Python 2
+            return self.process._popen._handle
+
+    def start(self):
+        self.process = spawn_command(self.config, self.server_name, self.index, self.cpu)
+        self.started = time.time()
+        self.restart_at = None
+
+    def stop(self):
+        if self.process is not None and self.restart_at is None:
+            end_commands([self.process])
+        self.process = None
+        self.restart_at = None
+
+    def check(self, now):
+        '''
+        Schedule the restart of the process if it has exited and restart it when due.
+
+        Return the time of the pending restart, if any.
+        '''
+        if self.process is None:
+            return None
+        if self.restart_at is None:
+            exitcode = self.process.exitcode
+            if exitcode is None:
+                return None
+            if now - self.started < self.stable:
+                self.crashes += 1
+            else:
+                self.crashes = 1
+            delay = min(self.backoff * 2 ** (self.crashes - 1), self.max_backoff)
+            if self.crashes >= self.crash_loop:
+                delay = self.max_backoff
+                error('%s is in a crash loop: %d consecutive crashes' % (self.name, self.crashes))
+            self.restart_at = now + delay
+            log('%s exited with code %s, restart #%d in %d seconds' % (self.name, exitcode, self.restarts + 1,
+                                                                       delay))
+        if now < self.restart_at:
+            return self.restart_at
+        self.restarts += 1
+        self.start()
+        return None
+
+
 def test_commands(base_path=None, timeout=10):
     '''
     Method to test the spawn and termination of commands present in the configuration file.
@@ -209,22 +395,21 @@ def test_commands(base_path=None, timeout=10):
     end_commands(processes)
 
 
-def get_config_modification_handle(path=None):
-    '''Returns a Directory change handle on the configuration directory.
-    
-    This handle will be used to restart the Django commands child processes
-    in case the configuration file has changed in the directory.
+
+def get_config_modification_handle(path=None, filename='service.ini'):
     '''
+    Deprecated: use ServiceSupervisor.watch_config().
+
+    Returns a ConfigWatcher of the configuration file in the directory path.
+    Previous versions returned a FindFirstChangeNotification handle on the
+    whole directory: wait on the handle attribute of the watcher instead and
+    call its changed() method where FindNextChangeNotification was called.
+    '''
+    warnings.warn('get_config_modification_handle() is deprecated, use ServiceSupervisor.watch_config()',
+                  DeprecationWarning, stacklevel=2)
     if not path:
         path = dirname(abspath(__file__))
-
-    change_handle = win32file.FindFirstChangeNotification(
-        path,
-        0,
-        win32con.FILE_NOTIFY_CHANGE_LAST_WRITE
-    )
-    return change_handle
-
+    return ConfigWatcher(os.path.join(path, filename))
 
 def read_config(base_path=None, filename='service.ini'):
     '''
@@ -240,83 +425,93 @@ def read_config(base_path=None, filename='service.ini'):
     return config
 
 
-class DjangoService(win32serviceutil.ServiceFramework):
-    """NT Service."""
-
-    _svc_name_ = "django-service"
-    _svc_display_name_ = "Django Background Processes"
-    _svc_description_ = "Run the Django background Processes"
-    _config_filename = 'service.ini'
-
-    def __init__(self, args):
-        win32serviceutil.ServiceFramework.__init__(self, args)
-        log('Initialization')
-        # create an event that SvcDoRun can wait on and SvcStop
-        # can set.
-        self.config = read_config(self._base_path, self._config_filename)
-        initialize_logger(self.config)
-        if not self._base_path in sys.path:
-            sys.path.append(self._base_path)
-
-        parent_path = dirname(self._base_path)
-        if not parent_path in sys.path:
-            sys.path.append(parent_path)
-        self.stop_event = win32event.CreateEvent(None, 0, 0, None)
-
-    def SvcDoRun(self):
-        self.ReportServiceStatus(win32service.SERVICE_START_PENDING)
-        log('starting')
-        self.ReportServiceStatus(win32service.SERVICE_RUNNING)
-
-        self.modification_handle = get_config_modification_handle(self._base_path)
-        self.configuration_mtime = os.stat(os.path.join(self._base_path, self._config_filename)).st_mtime
-
-        keep_running = True
-        do_start = True
-        while keep_running:
-
-            # do the actual start
-            if do_start:
-                self.start()
-
-            log('Started. Waiting for stop')
-            index = win32event.WaitForMultipleObjects([self.stop_event, self.modification_handle], False,
-                                                      win32event.INFINITE)
-            if index == 0:
-                # The stop event has been signaled. Stop execution.
-                keep_running = False
-            else:
-                # re-initialise handle
-                win32file.FindNextChangeNotification(self.modification_handle)
-
-                new_mtime = os.stat(os.path.join(self._base_path, self._config_filename)).st_mtime
-                if new_mtime != self.configuration_mtime:
-                    self.configuration_mtime = new_mtime
-                    do_start = True
-                    log('Restarting child processes as the configuration has changed')
-                    self.stop()
-                    self.config = read_config(self._base_path, self._config_filename)
-                else:
-                    do_start = False
+class ServiceSupervisor(object):
+    '''
+    Runs the commands of a configuration file in child processes, restarts
+    the ones that die and applies the changes of the configuration.
 
-        win32file.FindCloseChangeNotification(self.modification_handle)
+    This is the part of DjangoService that does not depend on Windows.
+    '''
 
-    def SvcStop(self):
-        self.ReportServiceStatus(win32service.SERVICE_STOP_PENDING)
-        log('Stopping')
-        # Do the actual stop 
-        self.stop()
-        log('Stopped')
-        win32event.SetEvent(self.stop_event)
-        self.ReportServiceStatus(win32service.SERVICE_STOPPED)
+    def __init__(self, base_path, config_filename='service.ini'):
+        self.base_path = base_path
+        self.config_filename = config_filename
+        self.config = read_config(base_path, config_filename)
+        self.commands = []
+        self.stopping = False
+
+    def watch_config(self, **kwargs):
+        '''Return a ConfigWatcher of the configuration file.'''
+        return ConfigWatcher(os.path.join(self.base_path, self.config_filename), **kwargs)
 
     def start(self):
-        self.processes = start_commands(self.config)
+        options = get_supervisor_options(self.config)
+        self.commands = [SupervisedCommand(self.config, server_name, index, cpu, **options)
+                         for server_name, index, cpu in get_instances(self.config)]
+        for command in self.commands:
+            command.start()
+
+    def reload_config(self):
+        '''Reread the configuration file and apply it.'''
+        log('Reloading the configuration as it has changed')
+        self.config = read_config(self.base_path, self.config_filename)
+        self.reload()
+
+    def reload(self):
+        '''
+        Apply a new configuration, restarting only the processes whose command line or CPU has changed.
+
+        The new processes are started before the old ones are stopped, so
+        that the commands keep running during the reload.
+        '''
+        options = get_supervisor_options(self.config)
+        running = dict(((command.server_name, command.index), command) for command in self.commands)
+        commands = []
+        stale = []
+        started = 0
+        for server_name, index, cpu in get_instances(self.config):
+            command = running.pop((server_name, index), None)
+            if command is not None and command.cpu == cpu and \
+                    command.args == get_command_args(self.config, server_name, index):
+                command.config = self.config
+                commands.append(command)
+                continue
+            if command is not None:
+                stale.append(command)
+            command = SupervisedCommand(self.config, server_name, index, cpu, **options)
+            command.start()
+            commands.append(command)
+            started += 1
+        stale += running.values()
+        for command in stale:
+            command.stop()
+        log('Reloaded: %d processes started, %d stopped, %d unchanged' % (started, len(stale),
+                                                                          len(commands) - started))
+        self.commands = commands
+
+    def sentinels(self):
+        '''Return the handles of the running child processes.'''
+        return [command.sentinel for command in self.commands if command.sentinel is not None]
+
+    def supervise(self):
+        '''
+        Restart the dead child processes when due.
+
+        Return the number of seconds until the next pending restart, or None.
+        '''
+        if self.stopping:
+            return None
+        now = time.time()
+        pending = [command.check(now) for command in self.commands]
+        pending = [restart_at for restart_at in pending if restart_at is not None]
+        if not pending:
+            return None
+        return max(0, min(pending) - now)
 
     def stop(self):
-        if self.processes:
-            end_commands(self.processes)
-            self.processes = []
+        for command in self.commands:
+            command.stop()
+        self.commands = []
         node_name = platform.node()
         clean = self.config.get(node_name, 'clean') if self.config.has_section(node_name) else self.config.get(
             'services', 'clean')
@@ -328,6 +523,80 @@ class DjangoService(win32serviceutil.ServiceFramework):
                     error("Error while removing %s\n%s" % (file, traceback.format_exc()))
 
 
+if win32serviceutil is not None:
+    class DjangoService(win32serviceutil.ServiceFramework, ServiceSupervisor):
+        """NT Service."""
+
+        _svc_name_ = "django-service"
+        _svc_display_name_ = "Django Background Processes"
+        _svc_description_ = "Run the Django background Processes"
+        _config_filename = 'service.ini'
+
+        def __init__(self, args):
+            win32serviceutil.ServiceFramework.__init__(self, args)
+            log('Initialization')
+            ServiceSupervisor.__init__(self, self._base_path, self._config_filename)
+            initialize_logger(self.config)
+            if not self._base_path in sys.path:
+                sys.path.append(self._base_path)
+
+            parent_path = dirname(self._base_path)
+            if not parent_path in sys.path:
+                sys.path.append(parent_path)
+            # create an event that SvcDoRun can wait on and SvcStop
+            # can set.
+            self.stop_event = win32event.CreateEvent(None, 0, 0, None)
+
+        def SvcDoRun(self):
+            self.ReportServiceStatus(win32service.SERVICE_START_PENDING)
+            log('starting')
+            self.ReportServiceStatus(win32service.SERVICE_RUNNING)
+
+            self.watcher = self.watch_config()
+
+            keep_running = True
+            do_start = True
+            while keep_running:
+
+                # do the actual start
+                if do_start:
+                    self.start()
+                    log('Started. Waiting for stop')
+
+                # restart the dead child processes and wait for the next one to exit
+                delay = self.supervise()
+                timeout = win32event.INFINITE if delay is None else int(delay * 1000)
+                handles = [self.stop_event, self.watcher.handle] + self.sentinels()
+                if len(handles) > MAXIMUM_WAIT_OBJECTS:
+                    # the other processes are checked every second
+                    handles = handles[:MAXIMUM_WAIT_OBJECTS]
+                    timeout = min(timeout, 1000)
+                index = win32event.WaitForMultipleObjects(handles, False, timeout)
+                if index == 0:
+                    # The stop event has been signaled. Stop execution.
+                    keep_running = False
+                elif index != 1:
+                    # A child process has exited or a restart is due
+                    do_start = False
+                else:
+                    # A file of the configuration directory has changed
+                    do_start = False
+                    if self.watcher.changed():
+                        self.reload_config()
+
+            self.watcher.close()
+
+        def SvcStop(self):
+            self.ReportServiceStatus(win32service.SERVICE_STOP_PENDING)
+            log('Stopping')
+            self.stopping = True
+            # Do the actual stop
+            self.stop()
+            log('Stopped')
+            win32event.SetEvent(self.stop_event)
+            self.ReportServiceStatus(win32service.SERVICE_STOPPED)
+
+
 if __name__ == '__main__':
     if len(sys.argv) > 1 and sys.argv[1] == 'test':
         test_commands()
@@ -0,0 +1,558 @@
+# encoding: utf-8
+
+# Memory-mapped structures shared by the processes of a host
+#
+# Copyright (c) 2012 Openance SARL
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+'''
+Memory-mapped structures shared by all the processes of a host.
+
+IIS starts several winfcgi processes for the same application. The classes
+of this module keep their state in a memory-mapped file so that every
+process works on the same (single) copy. Writers are serialized with a
+lock on a companion ``.lock`` file, and with a thread lock between the
+threads of a process.
+'''
+import os
+import sys
+import mmap
+import time
+import random
+import struct
+import hashlib
+import threading
+from contextlib import contextmanager
+
+if sys.platform == 'win32':
+    import msvcrt
+    import pywintypes
+    import win32con
+    import win32file
+
+    # msvcrt.locking polls the lock once per second and fails after 10 s: LockFileEx waits for it.
+
+    def lock_file(f):
+        win32file.LockFileEx(msvcrt.get_osfhandle(f.fileno()), win32con.LOCKFILE_EXCLUSIVE_LOCK, 1, 0,
+                             pywintypes.OVERLAPPED())
+
+    def unlock_file(f):
+        win32file.UnlockFileEx(msvcrt.get_osfhandle(f.fileno()), 1, 0, pywintypes.OVERLAPPED())
+else:
+    import fcntl
+
+    def lock_file(f):
+        fcntl.lockf(f.fileno(), fcntl.LOCK_EX, 1, 0)
+
+    def unlock_file(f):
+        fcntl.lockf(f.fileno(), fcntl.LOCK_UN, 1, 0)
+
+
+class SharedFile(object):
+    '''
+    A fixed size memory-mapped file protected by a lock file.
+
+    The file is (re)initialized by the first process opening it when its
+    size or its magic header do not match.
+
+    File locks belong to the process, so the lock is also held by a thread
+    lock while a thread of the process owns it.
+    '''
+
+    magic = b'DWTSHM00'
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self._thread_lock = threading.Lock()
+        self._lock_file = open(path + '.lock', 'a+b')
+        with self.lock():
+            f = open(path, 'a+b')
+            f.seek(0, os.SEEK_END)
+            resized = f.tell() != size
+            if resized:
+                f.truncate(size)
+            f.close()
+            self._file = open(path, 'r+b')
+            self.map = mmap.mmap(self._file.fileno(), size)
+            if resized or not self.is_valid():
+                self.initialize()
+
+    def is_valid(self):
+        '''Returns True if the file content has the expected layout.'''
+        return self.map[:len(self.magic)] == self.magic
+
+    def initialize(self):
+        '''Called with the lock held when the file content is not valid. Zeroes the file.'''
+        chunk = b'\x00' * 65536
+        for offset in range(0, self.size, len(chunk)):
+            end = min(offset + len(chunk), self.size)
+            self.map[offset:end] = chunk[:end - offset]
+        self.map[:len(self.magic)] = self.magic
+
+    @contextmanager
+    def lock(self):
+        with self._thread_lock:
+            lock_file(self._lock_file)
+            try:
+                yield
+            finally:
+                unlock_file(self._lock_file)
+
+    def close(self):
+        self.map.close()
+        self._file.close()
+        self._lock_file.close()
+
+
+def key_hash(key):
+    '''Returns a non zero 64 bits hash of key (bytes).'''
+    return struct.unpack('<Q', hashlib.md5(key).digest()[:8])[0] or 1
+
+
+class SharedCache(SharedFile):
+    '''
+    Key/value store in a memory-mapped file shared by several processes.
+
+    Values are stored in fixed size chunks grouped in slab classes (1 KB,
+    4 KB, ... up to max_chunk by default), each class receiving an equal
+    share of the file. A set-associative hash index maps keys to chunks.
+    When a class is full, the least recently used of a few randomly sampled
+    chunks is evicted (expired chunks are reused first).
+
+    Reads are lock-free: every chunk has a sequence number that writers make
+    odd while they update it, and readers retry when it changed while they
+    were copying the value. Writes are serialized with the file lock.
+
+    Keys and values are bytes. Expiration times are absolute timestamps
+    (0 means never).
+    '''
+
+    magic = b'DWTSHC01'
+
+    HEADER = '<8sIIII'  # magic, classes, buckets, ways, reserved
+    CLASS = '<III'  # chunk size, chunk count, next never used chunk
+    WAY = '<QII'  # key hash, class + 1 (0 for empty), chunk
+    CHUNK = '<IQddII'  # sequence, key hash, expires, last access, key length, value length
+
+    HEADER_LEN = struct.calcsize(HEADER)
+    CLASS_LEN = struct.calcsize(CLASS)
+    WAY_LEN = struct.calcsize(WAY)
+    CHUNK_LEN = struct.calcsize(CHUNK)
+    ACCESS_OFFSET = struct.calcsize('<IQd')
+
+    ways = 8
+    eviction_samples = 8
+
+    def __init__(self, path, size=64 * 1024 * 1024, min_chunk=1024, max_chunk=1024 * 1024, growth=4):
+        chunk_sizes = []
+        chunk_size = min_chunk
+        while chunk_size < max_chunk:
+            chunk_sizes.append(chunk_size)
+            chunk_size *= growth
+        chunk_sizes.append(max_chunk)
+
+        share = size // len(chunk_sizes)
+        self.classes = [(chunk_size, max(share // chunk_size, 1)) for chunk_size in chunk_sizes]
+        chunk_count = sum(count for chunk_size, count in self.classes)
+        self.buckets = max(chunk_count * 2 // self.ways, 1)
+
+        self.index_offset = self.HEADER_LEN + self.CLASS_LEN * len(self.classes)
+        offset = self.index_offset + self.buckets * self.ways * self.WAY_LEN
+        self.class_offsets = []
+        for chunk_size, count in self.classes:
+            self.class_offsets.append(offset)
+            offset += chunk_size * count
+
+        self.hits = 0
+        self.misses = 0
+        SharedFile.__init__(self, path, offset)
+
+    def is_valid(self):
+        if struct.unpack_from(self.HEADER, self.map, 0) != (self.magic, len(self.classes), self.buckets,
+                                                             self.ways, 0):
+            return False
+        for i, (chunk_size, count) in enumerate(self.classes):
+            if struct.unpack_from(self.CLASS, self.map, self.HEADER_LEN + i * self.CLASS_LEN)[:2] != \
+                    (chunk_size, count):
+                return False
+        return True
+
+    def initialize(self):
+        SharedFile.initialize(self)
+        struct.pack_into(self.HEADER, self.map, 0, self.magic, len(self.classes), self.buckets, self.ways, 0)
+        for i, (chunk_size, count) in enumerate(self.classes):
+            struct.pack_into(self.CLASS, self.map, self.HEADER_LEN + i * self.CLASS_LEN, chunk_size, count, 0)
+
+    def _way_offset(self, bucket, way):
+        return self.index_offset + (bucket * self.ways + way) * self.WAY_LEN
+
+    def _chunk_offset(self, cls, chunk):
+        return self.class_offsets[cls] + chunk * self.classes[cls][0]
+
+    def _read(self, cls, chunk, h, key, now):
+        offset = self._chunk_offset(cls, chunk)
+        for attempt in range(3):
+            sequence, chunk_hash, expires, access, key_len, value_len = \
+                struct.unpack_from(self.CHUNK, self.map, offset)
+            if sequence & 1:
+                continue
+            if chunk_hash != h or (expires and expires <= now):
+                return None
+            start = offset + self.CHUNK_LEN
+            stored_key = self.map[start:start + key_len]
+            value = self.map[start + key_len:start + key_len + value_len]
+            if struct.unpack_from('<I', self.map, offset)[0] != sequence:
+                continue
+            if stored_key != key:
+                return None
+            struct.pack_into('<d', self.map, offset + self.ACCESS_OFFSET, now)
+            return value
+        return None
+
+    def get(self, key):
+        '''Returns the value stored for key, or None.'''
+        h = key_hash(key)
+        bucket = h % self.buckets
+        now = time.time()
+        for way in range(self.ways):
+            way_hash, cls, chunk = struct.unpack_from(self.WAY, self.map, self._way_offset(bucket, way))
+            if cls and way_hash == h:
+                value = self._read(cls - 1, chunk, h, key, now)
+                if value is not None:
+                    self.hits += 1
+                    return value
+        self.misses += 1
+        return None
+
+    def _write_chunk(self, cls, chunk, h=0, expires=0.0, key=b'', value=b''):
+        offset = self._chunk_offset(cls, chunk)
+        sequence = struct.unpack_from('<I', self.map, offset)[0]
+        if sequence & 1:
+            # a writer died in the middle of an update
+            sequence += 1
+        struct.pack_into('<I', self.map, offset, (sequence + 1) & 0xffffffff)
+        start = offset + self.CHUNK_LEN
+        self.map[start:start + len(key) + len(value)] = key + value
+        struct.pack_into(self.CHUNK, self.map, offset, (sequence + 1) & 0xffffffff, h, expires, time.time(),
+                         len(key), len(value))
+        struct.pack_into('<I', self.map, offset, (sequence + 2) & 0xffffffff)
+
+    def _chunk_state(self, cls, chunk):
+        '''Returns the (key hash, expires, last access) of a chunk.'''
+        return struct.unpack_from('<Qdd', self.map, self._chunk_offset(cls, chunk) + 4)
+
+    def _find(self, h, key):
+        '''Returns the (way, class, chunk) holding key in its bucket, or None. Must be called with the lock held.'''
+        bucket = h % self.buckets
+        for way in range(self.ways):
+            way_hash, cls, chunk = struct.unpack_from(self.WAY, self.map, self._way_offset(bucket, way))
+            if cls and way_hash == h and self._chunk_state(cls - 1, chunk)[0] == h:
+                start = self._chunk_offset(cls - 1, chunk) + self.CHUNK_LEN
+                if self.map[start:start + len(key)] == key:
+                    return way, cls - 1, chunk
+        return None
+
+    def _allocate(self, cls, now):
+        '''Returns a chunk of class cls that can be overwritten. Must be called with the lock held.'''
+        class_offset = self.HEADER_LEN + cls * self.CLASS_LEN
+        chunk_size, count, next_chunk = struct.unpack_from(self.CLASS, self.map, class_offset)
+        if next_chunk < count:
+            struct.pack_into(self.CLASS, self.map, class_offset, chunk_size, count, next_chunk + 1)
+            return next_chunk
+
+        victim, victim_access = None, None
+        for chunk in random.sample(range(count), min(self.eviction_samples, count)):
+            chunk_hash, expires, access = self._chunk_state(cls, chunk)
+            if not chunk_hash or (expires and expires <= now):
+                return chunk
+            if victim is None or access < victim_access:
+                victim, victim_access = chunk, access
+        return victim
+
+    def _store(self, key, value, expires):
+        '''Stores a value. Must be called with the lock held.'''
+        need = self.CHUNK_LEN + len(key) + len(value)
+        for cls, (chunk_size, count) in enumerate(self.classes):
+            if need <= chunk_size:
+                break
+        else:
+            return False
+
+        now = time.time()
+        h = key_hash(key)
+        bucket = h % self.buckets
+        found = self._find(h, key)
+        if found is not None:
+            way, old_cls, old_chunk = found
+            self._write_chunk(old_cls, old_chunk)
+        else:
+            # use an empty or stale way, or the way of the least recently used entry
+            way, way_access = None, None
+            for candidate in range(self.ways):
+                way_hash, way_cls, way_chunk = struct.unpack_from(self.WAY, self.map,
+                                                                  self._way_offset(bucket, candidate))
+                if not way_cls:
+                    way = candidate
+                    break
+                chunk_hash, chunk_expires, access = self._chunk_state(way_cls - 1, way_chunk)
+                if chunk_hash != way_hash or (chunk_expires and chunk_expires <= now):
+                    way = candidate
+                    break
+                if way is None or access < way_access:
+                    way, way_access = candidate, access
+            else:
+                way_hash, way_cls, way_chunk = struct.unpack_from(self.WAY, self.map,
+                                                                  self._way_offset(bucket, way))
+                self._write_chunk(way_cls - 1, way_chunk)
+
+        chunk = self._allocate(cls, now)
+        self._write_chunk(cls, chunk, h, float(expires or 0), key, value)
+        struct.pack_into(self.WAY, self.map, self._way_offset(bucket, way), h, cls + 1, chunk)
+        return True
+
+    def set(self, key, value, expires=0):
+        '''Stores value for key. Returns False if the value is too large to be stored.'''
+        with self.lock():
+            return self._store(key, value, expires)
+
+    def add(self, key, value, expires=0):
+        '''Stores value for key only if there is no fresh value for it. Returns True if stored.'''
+        with self.lock():
+            found = self._find(key_hash(key), key)
+            if found is not None:
+                chunk_expires = self._chunk_state(found[1], found[2])[1]
+                if not chunk_expires or chunk_expires > time.time():
+                    return False
+            return self._store(key, value, expires)
+
+    def delete(self, key):
+        '''Removes the value stored for key. Returns True if there was one.'''
+        with self.lock():
+            h = key_hash(key)
+            found = self._find(h, key)
+            if found is None:
+                return False
+            way, cls, chunk = found
+            self._write_chunk(cls, chunk)
+            struct.pack_into(self.WAY, self.map, self._way_offset(h % self.buckets, way), 0, 0, 0)
+            return True
+
+    def delete_prefix(self, prefix):
+        '''Removes all the values whose key starts with prefix. Scans the whole store.'''
+        with self.lock():
+            for cls, (chunk_size, count) in enumerate(self.classes):
+                for chunk in range(count):
+                    offset = self._chunk_offset(cls, chunk)
+                    if struct.unpack_from('<Q', self.map, offset + 4)[0]:
+                        start = offset + self.CHUNK_LEN
+                        if self.map[start:start + len(prefix)] == prefix:
+                            self._write_chunk(cls, chunk)
+
+    def clear(self):
+        '''Removes all the values.'''
+        with self.lock():
+            self.initialize()
+
+
+if sys.platform == 'win32':
+    def process_alive(pid):
+        '''Returns True if the process pid is running.'''
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return False
+        try:
+            code = ctypes.c_ulong()
+            return bool(kernel32.GetExitCodeProcess(handle, ctypes.byref(code))) and code.value == 259
+        finally:
+            kernel32.CloseHandle(handle)
+else:
+    def process_alive(pid):
+        '''Returns True if the process pid is running.'''
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            return e.errno == 1  # EPERM: running under another user
+        return True
+
+
+class Scoreboard(SharedFile):
+    '''
+    Fixed size table in which each process of a host publishes its state,
+    like the Apache scoreboard.
+
+    A process claims a free slot (or the slot of a dead process) when it
+    starts and is the only writer of its slot afterwards. As for the
+    SharedCache chunks, a sequence number made odd during updates lets the
+    readers retry instead of reading a half written slot.
+    '''
+
+    magic = b'DWTSCB01'
+
+    HEADER = '<8sI'  # magic, slots
+    SLOT = '<IIcxxxQQddd200s200s'  # sequence, pid, state, requests, rss, started, request start, updated, path, error
+
+    HEADER_LEN = struct.calcsize(HEADER)
+    SLOT_LEN = struct.calcsize(SLOT)
+
+    FREE = b'\x00'
+    IDLE = b'I'
+    BUSY = b'B'
+    STATES = {IDLE: 'idle', BUSY: 'busy'}
+
+    FIELDS = ('pid', 'state', 'requests', 'rss', 'started', 'request_start', 'updated', 'path', 'error')
+
+    def __init__(self, path, slots=64):
+        self.slots = slots
+        SharedFile.__init__(self, path, self.HEADER_LEN + slots * self.SLOT_LEN)
+
+    def is_valid(self):
+        return struct.unpack_from(self.HEADER, self.map, 0) == (self.magic, self.slots)
+
+    def initialize(self):
+        SharedFile.initialize(self)
+        struct.pack_into(self.HEADER, self.map, 0, self.magic, self.slots)
+
+    def _slot_offset(self, slot):
+        return self.HEADER_LEN + slot * self.SLOT_LEN
+
+    def _write(self, slot, values):
+        offset = self._slot_offset(slot)
+        sequence = struct.unpack_from('<I', self.map, offset)[0] | 1
+        struct.pack_into('<I', self.map, offset, sequence & 0xffffffff)
+        struct.pack_into(self.SLOT, self.map, offset, sequence & 0xffffffff, *values)
+        struct.pack_into('<I', self.map, offset, (sequence + 1) & 0xffffffff)
+
+    def read_slot(self, slot):
+        '''Returns the fields of a slot as a dictionary, or None if it is free.'''
+        offset = self._slot_offset(slot)
+        for attempt in range(3):
+            values = struct.unpack_from(self.SLOT, self.map, offset)
+            if values[0] & 1 or struct.unpack_from('<I', self.map, offset)[0] != values[0]:
+                continue
+            if values[2] == self.FREE:
+                return None
+            status = dict(zip(self.FIELDS, values[1:]))
+            status['state'] = self.STATES.get(status['state'], '?')
+            status['path'] = status['path'].rstrip(b'\x00').decode('utf-8', 'replace')
+            status['error'] = status['error'].rstrip(b'\x00').decode('utf-8', 'replace')
+            return status
+        return None
+
+    def claim(self):
+        '''Claims a slot for the current process. Returns its number, or None if the table is full.'''
+        pid = os.getpid()
+        now = time.time()
+        with self.lock():
+            for slot in range(self.slots):
+                values = struct.unpack_from(self.SLOT, self.map, self._slot_offset(slot))
+                if values[2] == self.FREE or values[1] == pid or not process_alive(values[1]):
+                    self._write(slot, (pid, self.IDLE, 0, 0, now, 0.0, now, b'', b''))
+                    return slot
+        return None
+
+    def update(self, slot, **fields):
+        '''Changes some fields (see FIELDS) of the slot of the current process.'''
+        values = list(struct.unpack_from(self.SLOT, self.map, self._slot_offset(slot))[1:])
+        for name, value in fields.items():
+            if name in ('path', 'error'):
+                value = value.encode('utf-8')[:200]
+            values[self.FIELDS.index(name)] = value
+        values[self.FIELDS.index('updated')] = time.time()
+        self._write(slot, values)
+
+    def release(self, slot):
+        '''Frees the slot of the current process.'''
+        self._write(slot, (0, self.FREE, 0, 0, 0.0, 0.0, 0.0, b'', b''))
+
+    def read(self):
+        '''Returns the (slot, status dictionary) of the slots in use.'''
+        result = []
+        for slot in range(self.slots):
+            status = self.read_slot(slot)
+            if status is not None:
+                result.append((slot, status))
+        return result
+
+
+class TokenBuckets(SharedFile):
+    '''
+    Token buckets shared by the processes of a host, used for rate limiting.
+
+    Buckets are kept in a set-associative table indexed by the hash of
+    their key. When the ways of an index bucket are all used, the bucket
+    updated the longest time ago (the most likely to be full again) is
+    replaced. Operations are serialized with the file lock.
+    '''
+
+    magic = b'DWTTKB01'
+
+    HEADER = '<8sII'  # magic, buckets, ways
+    ENTRY = '<Qdd'  # key hash (0 for empty), tokens, updated
+
+    HEADER_LEN = struct.calcsize(HEADER)
+    ENTRY_LEN = struct.calcsize(ENTRY)
+
+    ways = 8
+
+    def __init__(self, path, entries=65536):
+        self.buckets = max(entries // self.ways, 1)
+        SharedFile.__init__(self, path, self.HEADER_LEN + self.buckets * self.ways * self.ENTRY_LEN)
+
+    def is_valid(self):
+        return struct.unpack_from(self.HEADER, self.map, 0) == (self.magic, self.buckets, self.ways)
+
+    def initialize(self):
+        SharedFile.initialize(self)
+        struct.pack_into(self.HEADER, self.map, 0, self.magic, self.buckets, self.ways)
+
+    def take(self, key, rate, burst, cost=1.0):
+        '''
+        Takes cost tokens from the bucket of key, refilled with rate tokens
+        per second up to burst. Returns 0 if they were available, or else
+        the number of seconds after which they will be (nothing is taken).
+        '''
+        h = key_hash(key)
+        base = self.HEADER_LEN + (h % self.buckets) * self.ways * self.ENTRY_LEN
+        now = time.time()
+        with self.lock():
+            offset, oldest = None, None
+            for way in range(self.ways):
+                entry_offset = base + way * self.ENTRY_LEN
+                entry_hash, tokens, updated = struct.unpack_from(self.ENTRY, self.map, entry_offset)
+                if entry_hash == h:
+                    tokens = min(burst, tokens + (now - updated) * rate)
+                    offset = entry_offset
+                    break
+                if oldest is None or updated < oldest:
+                    offset, oldest = entry_offset, updated
+            else:
+                tokens = burst
+            if tokens < cost:
+                struct.pack_into(self.ENTRY, self.map, offset, h, tokens, now)
+                return (cost - tokens) / rate if rate else float('inf')
+            struct.pack_into(self.ENTRY, self.map, offset, h, tokens - cost, now)
+            return 0
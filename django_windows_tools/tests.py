@@ -5,6 +5,14 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+from io import BytesIO
+
 from django.test import TestCase
 
 
@@ -14,3 +22,1648 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class FakeStream(object):
+    """Collects what the bridge writes to a request stream."""
+
+    def __init__(self):
+        self.data = b''
+
+    def write(self, data):
+        self.data += data
+
+    def flush(self):
+        pass
+
+
+class FakeRequest(object):
+    def __init__(self, params=None):
+        from django_windows_tools.management.commands.winfcgi import FCGI_RESPONDER
+
+        self.role = FCGI_RESPONDER
+        self.params = params
+        self.stdin = BytesIO()
+        self.errors = FakeStream()
+        self.stdout = FakeStream()
+
+
+def parse_response(data):
+    """Returns the status, headers and body written by the bridge."""
+    head, body = data.split(b'\r\n\r\n', 1)
+    lines = head.decode('latin-1').split('\r\n')
+    headers = dict(line.split(': ', 1) for line in lines)
+    return headers.pop('Status'), headers, body
+
+
+def run_handler(application, req, **options):
+    """Runs a FakeRequest through an FCGIServer."""
+    from django_windows_tools.management.commands.winfcgi import FCGIServer
+
+    FCGIServer(application, **options).handler(req)
+    return req
+
+
+def request_environ(**extra):
+    environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/media/report.pdf', 'QUERY_STRING': '',
+               'SERVER_NAME': 'testserver', 'SERVER_PORT': '80', 'HTTP_HOST': 'testserver',
+               'REMOTE_ADDR': '10.0.0.1', 'wsgi.input': BytesIO()}
+    environ.update(extra)
+    return environ
+
+
+def fcgi_record(type, requestId, content=b''):
+    """Returns the bytes of a record sent by the web server."""
+    from django_windows_tools.management.commands.winfcgi import Record
+
+    rec = Record(type, requestId)
+    rec.contentData = content
+    rec.contentLength = len(content)
+    stream = BytesIO()
+    rec.write(stream)
+    return stream.getvalue()
+
+
+def fcgi_request(params, body=b'', requestId=1, keepConn=False, chunkSize=1000):
+    """Returns the records of a request, as sent by the web server."""
+    from django_windows_tools.management.commands.winfcgi import encode_pair, FCGI_BEGIN_REQUEST, \
+        FCGI_PARAMS, FCGI_STDIN, FCGI_RESPONDER, FCGI_KEEP_CONN, FCGI_BeginRequestBody
+
+    data = fcgi_record(FCGI_BEGIN_REQUEST, requestId,
+                       struct.pack(FCGI_BeginRequestBody, FCGI_RESPONDER, FCGI_KEEP_CONN if keepConn else 0))
+    data += fcgi_record(FCGI_PARAMS, requestId, b''.join(encode_pair(name, value) for name, value in params.items()))
+    data += fcgi_record(FCGI_PARAMS, requestId)
+    for pos in range(0, len(body), chunkSize):
+        data += fcgi_record(FCGI_STDIN, requestId, body[pos:pos + chunkSize])
+    return data + fcgi_record(FCGI_STDIN, requestId)
+
+
+def fcgi_stdout(data):
+    """Returns the FCGI_STDOUT content of the records written by the bridge."""
+    from django_windows_tools.management.commands.winfcgi import FCGI_Header, FCGI_HEADER_LEN, FCGI_STDOUT
+
+    content = []
+    pos = 0
+    while pos < len(data):
+        version, type, requestId, contentLength, paddingLength = \
+            struct.unpack(FCGI_Header, data[pos:pos + FCGI_HEADER_LEN])
+        pos += FCGI_HEADER_LEN
+        if type == FCGI_STDOUT:
+            content.append(data[pos:pos + contentLength])
+        pos += contentLength + paddingLength
+    return b''.join(content)
+
+
+def upload_params(path='/upload', body=b''):
+    return {'REQUEST_METHOD': 'POST', 'PATH_INFO': path, 'QUERY_STRING': '', 'SERVER_NAME': 'testserver',
+            'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1', 'REMOTE_ADDR': '10.0.0.1',
+            'CONTENT_LENGTH': str(len(body))}
+
+
+def echo(environ, start_response):
+    """Answers with the body of /upload requests, without reading the others."""
+    body = environ['wsgi.input'].read(int(environ['CONTENT_LENGTH'])) if environ['PATH_INFO'] == '/upload' else b''
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [b'got ' + body]
+
+
+class AuthorizerTest(TestCase):
+    def setUp(self):
+        from django_windows_tools.management.commands.winfcgi import Authorizer
+
+        self.calls = 0
+
+        def authorize(request):
+            self.calls += 1
+            return request.META.get('HTTP_AUTHORIZATION') == 'Bearer secret' or \
+                   request.GET.get('token') == 'secret'
+
+        self.authorizer = Authorizer(authorize, cookie='sessionid')
+
+    def status(self, environ):
+        req = FakeRequest()
+        self.authorizer.handle(req, environ)
+        return req.stdout.data.split(b'\r\n')[0]
+
+    def test_allowed_decision_is_cached(self):
+        environ = request_environ(HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(self.status(environ), b'Status: 200 OK')
+        self.assertEqual(self.status(dict(environ)), b'Status: 200 OK')
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.authorizer.hits, 1)
+
+    def test_authorization_header_is_part_of_the_key(self):
+        self.assertEqual(self.status(request_environ(HTTP_AUTHORIZATION='Bearer secret')), b'Status: 200 OK')
+        self.assertEqual(self.status(request_environ()), b'Status: 403 Forbidden')
+        self.assertEqual(self.calls, 2)
+
+    def test_query_string_is_part_of_the_key(self):
+        self.assertEqual(self.status(request_environ(QUERY_STRING='token=secret')), b'Status: 200 OK')
+        self.assertEqual(self.status(request_environ()), b'Status: 403 Forbidden')
+
+    def test_client_address_is_part_of_the_key(self):
+        environ = request_environ(HTTP_AUTHORIZATION='Bearer secret')
+        key = self.authorizer.key(environ)
+        self.assertNotEqual(key, self.authorizer.key(dict(environ, REMOTE_ADDR='10.0.0.2')))
+
+    def test_only_the_configured_cookie_is_part_of_the_key(self):
+        environ = request_environ(HTTP_COOKIE='sessionid=abc; theme=dark')
+        key = self.authorizer.key(environ)
+        self.assertEqual(key, self.authorizer.key(dict(environ, HTTP_COOKIE='theme=light; sessionid=abc')))
+        self.assertNotEqual(key, self.authorizer.key(dict(environ, HTTP_COOKIE='sessionid=def')))
+        self.assertNotEqual(key, self.authorizer.key(request_environ()))
+
+
+
+class ResponseCacheTest(TestCase):
+    def setUp(self):
+        from django_windows_tools.management.commands.winfcgi import ResponseCache
+
+        self.calls = 0
+        self.status = '200 OK'
+        self.headers = [('Content-Type', 'text/html'), ('Cache-Control', 'max-age=60')]
+        self.cache = ResponseCache(vary=('Host', 'Accept-Language'))
+
+    def page(self, environ, start_response):
+        self.calls += 1
+        start_response(self.status, list(self.headers))
+        return [b'page ', str(self.calls).encode('ascii')]
+
+    def get(self, cache=None, **extra):
+        req = run_handler(self.page, FakeRequest(request_environ(PATH_INFO='/page', **extra)),
+                          response_cache=self.cache if cache is None else cache)
+        return parse_response(req.stdout.data)
+
+    def test_miss_then_hit(self):
+        status, headers, body = self.get()
+        self.assertNotIn('Age', headers)
+        status, headers, body = self.get()
+        self.assertEqual((status, body), ('200 OK', b'page 1'))
+        self.assertEqual(headers['Age'], '0')
+        self.assertEqual(self.calls, 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_age(self):
+        self.get()
+        for entry in self.cache._entries.values():
+            entry.stored -= 30
+        self.assertEqual(self.get()[1]['Age'], '30')
+
+    def test_query_string_and_vary_headers_separated(self):
+        self.headers.append(('Vary', 'Accept-Language'))
+        self.assertEqual(self.get(HTTP_ACCEPT_LANGUAGE='fr')[2], b'page 1')
+        self.assertEqual(self.get(HTTP_ACCEPT_LANGUAGE='en')[2], b'page 2')
+        self.assertEqual(self.get(HTTP_ACCEPT_LANGUAGE='fr')[2], b'page 1')
+        self.assertEqual(self.get(HTTP_ACCEPT_LANGUAGE='fr', QUERY_STRING='p=2')[2], b'page 3')
+
+    def test_varying_on_other_header_not_stored(self):
+        self.headers.append(('Vary', 'Cookie'))
+        self.get(HTTP_COOKIE='sessionid=abc')
+        self.assertEqual(self.get(HTTP_COOKIE='sessionid=def')[2], b'page 2')
+        self.assertEqual(len(self.cache), 0)
+
+    def test_cookie_in_vary_separates_users(self):
+        from django_windows_tools.management.commands.winfcgi import ResponseCache
+
+        cache = ResponseCache(vary=('Host', 'Cookie'))
+        self.headers.append(('Vary', 'Cookie'))
+        self.assertEqual(self.get(cache, HTTP_COOKIE='sessionid=abc')[2], b'page 1')
+        self.assertEqual(self.get(cache, HTTP_COOKIE='sessionid=def')[2], b'page 2')
+        self.assertEqual(self.get(cache, HTTP_COOKIE='sessionid=abc')[2], b'page 1')
+
+    def test_set_cookie_not_stored(self):
+        self.headers.append(('Set-Cookie', 'sessionid=abc'))
+        self.get()
+        self.assertEqual(self.get()[2], b'page 2')
+
+    def test_head_not_stored(self):
+        self.assertEqual(self.get(REQUEST_METHOD='HEAD')[0], '200 OK')
+        self.assertEqual(self.get()[2], b'page 2')
+        status, headers, body = self.get(REQUEST_METHOD='HEAD')
+        self.assertEqual((status, body, self.calls), ('200 OK', b'', 2))
+
+    def test_not_modified_not_stored(self):
+        self.status = '304 Not Modified'
+        self.get(HTTP_IF_NONE_MATCH='"v1"')
+        self.status = '200 OK'
+        self.assertEqual(self.get()[0], '200 OK')
+        self.assertEqual(self.calls, 2)
+
+    def test_invalidated_by_unsafe_methods(self):
+        self.get()
+        self.status = '403 Forbidden'
+        self.get(REQUEST_METHOD='POST')
+        self.assertEqual(self.get()[2], b'page 1')
+        self.status = '200 OK'
+        self.get(REQUEST_METHOD='POST')
+        self.assertEqual(self.get()[2], b'page 4')
+
+    def test_shared_by_processes(self):
+        from django_windows_tools.management.commands.winfcgi import SharedResponseCache
+
+        directory = tempfile.mkdtemp()
+        try:
+            location = os.path.join(directory, 'responses.bin')
+            caches = [SharedResponseCache(location, maxSize=1024 * 1024) for i in range(2)]
+            self.get(caches[0])
+            status, headers, body = self.get(caches[1])
+            self.assertEqual((body, headers['Age'], self.calls), (b'page 1', '0', 1))
+            for cache in caches:
+                cache._shared.close()
+        finally:
+            shutil.rmtree(directory)
+
+
+class StaticFilesTest(TestCase):
+    def setUp(self):
+        from django_windows_tools.management.commands.winfcgi import StaticFiles
+
+        self.directory = tempfile.mkdtemp()
+        root = os.path.join(self.directory, 'static')
+        os.makedirs(os.path.join(root, 'css'))
+        with open(os.path.join(root, 'css', 'site.css'), 'wb') as f:
+            f.write(b'body {}')
+        with open(os.path.join(self.directory, 'secret.txt'), 'wb') as f:
+            f.write(b'secret')
+        os.makedirs(os.path.join(self.directory, 'static2'))
+        with open(os.path.join(self.directory, 'static2', 'other.txt'), 'wb') as f:
+            f.write(b'other')
+        self.static_files = StaticFiles({'/static/': root}, maxAge=3600)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def application(self, environ, start_response):
+        start_response('404 Not Found', [('Content-Type', 'text/plain')])
+        return [b'application']
+
+    def get(self, path, **extra):
+        req = run_handler(self.application, FakeRequest(request_environ(PATH_INFO=path, **extra)),
+                          static_files=self.static_files)
+        return parse_response(req.stdout.data)
+
+    def test_file_served(self):
+        status, headers, body = self.get('/static/css/site.css')
+        self.assertEqual((status, body), ('200 OK', b'body {}'))
+        self.assertEqual(headers['Content-Type'], 'text/css')
+        self.assertEqual(headers['Content-Length'], '7')
+        self.assertEqual(headers['Cache-Control'], 'max-age=3600')
+        self.assertIn('ETag', headers)
+        self.assertIn('Last-Modified', headers)
+
+    def test_head(self):
+        status, headers, body = self.get('/static/css/site.css', REQUEST_METHOD='HEAD')
+        self.assertEqual((status, headers['Content-Length'], body), ('200 OK', '7', b''))
+
+    def test_not_modified(self):
+        headers = self.get('/static/css/site.css')[1]
+        status, headers304, body = self.get('/static/css/site.css', HTTP_IF_NONE_MATCH=headers['ETag'])
+        self.assertEqual((status, body), ('304 Not Modified', b''))
+        self.assertEqual(headers304['ETag'], headers['ETag'])
+        status = self.get('/static/css/site.css', HTTP_IF_MODIFIED_SINCE=headers['Last-Modified'])[0]
+        self.assertEqual(status, '304 Not Modified')
+        status = self.get('/static/css/site.css', HTTP_IF_NONE_MATCH='"other"')[0]
+        self.assertEqual(status, '200 OK')
+
+    def test_range_answered_with_the_whole_file(self):
+        status, headers, body = self.get('/static/css/site.css', HTTP_RANGE='bytes=0-3')
+        self.assertEqual((status, body), ('200 OK', b'body {}'))
+
+    def test_traversal(self):
+        for path in ('/static/../secret.txt', '/static/%2e%2e/secret.txt', '/static/%2E%2E%2Fsecret.txt',
+                     '/static/css/../../secret.txt', '/static/' + os.path.join(self.directory, 'secret.txt'),
+                     '/static/../static2/other.txt'):
+            self.assertEqual(self.get(path)[2], b'application', path)
+
+    def test_missing_files_and_directories_passed_to_the_application(self):
+        for path in ('/static/css/missing.css', '/static/css', '/static/', '/other/site.css'):
+            self.assertEqual(self.get(path)[2], b'application', path)
+
+    def test_post_passed_to_the_application(self):
+        self.assertEqual(self.get('/static/css/site.css', REQUEST_METHOD='POST')[2], b'application')
+
+class ConditionalGetTest(TestCase):
+    def setUp(self):
+        from django_windows_tools.management.commands.winfcgi import ConditionalGet
+
+        self.conditional_get = ConditionalGet()
+
+    def page(self, environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/html')])
+        return [b'<html>', b'hello', b'</html>']
+
+    def get(self, application, **extra):
+        req = run_handler(application, FakeRequest(request_environ(PATH_INFO='/', **extra)),
+                          conditional_get=self.conditional_get)
+        return parse_response(req.stdout.data)
+
+    def test_etag_added(self):
+        status, headers, body = self.get(self.page)
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(body, b'<html>hello</html>')
+        self.assertEqual(headers['ETag'], self.conditional_get.etag(body))
+        self.assertEqual(headers['Content-Length'], str(len(body)))
+
+    def test_not_modified(self):
+        etag = self.get(self.page)[1]['ETag']
+        status, headers, body = self.get(self.page, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status, '304 Not Modified')
+        self.assertEqual(body, b'')
+        self.assertEqual(headers['ETag'], etag)
+        self.assertNotIn('Content-Type', headers)
+        self.assertEqual(self.conditional_get.notModified, 1)
+        self.assertEqual(self.conditional_get.bytesSaved, len(b'<html>hello</html>'))
+
+    def test_other_etags_do_not_match(self):
+        status, headers, body = self.get(self.page, HTTP_IF_NONE_MATCH='"other", W/"older"')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(self.get(self.page, HTTP_IF_NONE_MATCH='*')[0], '304 Not Modified')
+
+    def test_post_ignored(self):
+        status, headers, body = self.get(self.page, REQUEST_METHOD='POST')
+        self.assertEqual(status, '200 OK')
+        self.assertNotIn('ETag', headers)
+
+    def test_streamed_responses_not_buffered(self):
+        for content_type in ('text/csv', 'text/event-stream'):
+            holder = {}
+
+            def stream(environ, start_response):
+                start_response('200 OK', [('Content-Type', content_type)])
+                yield b'first'
+                # the first chunk must be sent before the second one is produced
+                holder['sent'] = holder['req'].stdout.data
+                yield b'second'
+
+            req = holder['req'] = FakeRequest(request_environ(PATH_INFO='/'))
+            run_handler(stream, req, conditional_get=self.conditional_get)
+            self.assertTrue(holder['sent'].endswith(b'first'), content_type)
+            status, headers, body = parse_response(req.stdout.data)
+            self.assertEqual(body, b'firstsecond')
+            self.assertNotIn('ETag', headers)
+
+    def test_django_response(self):
+        from django.http import HttpResponse, StreamingHttpResponse
+
+        def page(environ, start_response):
+            response = HttpResponse(b'complete')
+            start_response('200 OK', list(response.items()))
+            return response
+
+        def streamed(environ, start_response):
+            response = StreamingHttpResponse(iter([b'a', b'b']))
+            start_response('200 OK', list(response.items()))
+            return response
+
+        self.assertIn('ETag', self.get(page)[1])
+        self.assertNotIn('ETag', self.get(streamed)[1])
+
+
+class StreamBatchTest(TestCase):
+    def setUp(self):
+        from django_windows_tools.management.commands.winfcgi import StreamBatching
+
+        self.batching = StreamBatching(maxSize=1024, maxDelay=0.05)
+
+    def stream(self, content_type, chunks, pause=0):
+        """Streams chunks and returns the FakeRequest and the data sent before each chunk was produced."""
+        sent = []
+        req = FakeRequest(request_environ(PATH_INFO='/'))
+
+        def application(environ, start_response):
+            start_response('200 OK', [('Content-Type', content_type)])
+            for chunk in chunks:
+                time.sleep(pause)
+                sent.append(parse_response(req.stdout.data)[2] if req.stdout.data else None)
+                yield chunk
+
+        run_handler(application, req, stream_batching=self.batching)
+        return req, sent
+
+    def test_small_chunks_coalesced(self):
+        rows = [('row %d\n' % i).encode('ascii') for i in range(1000)]
+        req, sent = self.stream('text/csv', rows)
+        self.assertEqual(parse_response(req.stdout.data)[2], b''.join(rows))
+        self.assertEqual(self.batching.chunks, 1000)
+        self.assertTrue(self.batching.writes < 20, self.batching.writes)
+
+    def test_first_chunk_sent_right_away(self):
+        req, sent = self.stream('text/plain', [b'first', b'second'])
+        self.assertEqual(sent, [None, b'first'])
+
+    def test_held_chunks_sent_after_max_delay(self):
+        req, sent = self.stream('text/plain', [b'a', b'b', b'c'], pause=0.3)
+        # b is sent by the flusher thread while the application sleeps
+        self.assertEqual(sent, [None, b'a', b'ab'])
+        self.assertEqual(parse_response(req.stdout.data)[2], b'abc')
+
+    def test_event_stream_never_held(self):
+        events = [('data: %d\n\n' % i).encode('ascii') for i in range(3)]
+        req, sent = self.stream('text/event-stream', events)
+        self.assertEqual(sent, [None, events[0], events[0] + events[1]])
+        self.assertEqual(self.batching.writes, 3)
+
+
+
+
+class ReadAheadTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def server(self, application=echo, **options):
+        from django_windows_tools.management.commands.winfcgi import FCGIServer, make_connection_class
+
+        return FCGIServer(application, connection_class=make_connection_class(True), **options)
+
+    def run_connection(self, server, data):
+        output = BytesIO()
+        server._connectionClass(BytesIO(data), output, server).run()
+        return output.getvalue()
+
+    def test_body_read_by_the_application(self):
+        body = b'x' * 5000
+        output = self.run_connection(self.server(), fcgi_request(upload_params(body=body), body))
+        self.assertEqual(parse_response(fcgi_stdout(output))[2], b'got ' + body)
+
+    def test_unread_body_before_next_request(self):
+        body = b'x' * 5000
+        data = fcgi_request(upload_params('/ignore', body), body, keepConn=True) + \
+            fcgi_request(upload_params(body=b'next'), b'next', requestId=2)
+        output = self.run_connection(self.server(), data)
+        self.assertEqual(fcgi_stdout(output).count(b'Status: 200 OK'), 2)
+        self.assertTrue(fcgi_stdout(output).endswith(b'got next'))
+
+    def test_request_starts_before_its_body(self):
+        from django_windows_tools.management.commands.winfcgi import FCGI_PARAMS
+
+        started = threading.Event()
+
+        def application(environ, start_response):
+            started.set()
+            return echo(environ, start_response)
+
+        server = self.server(application)
+        body = b'x' * 3000
+        data = fcgi_request(upload_params(body=body), body)
+        end = fcgi_record(FCGI_PARAMS, 1)
+        head = data.index(end) + len(end)  # up to the end of the FCGI_PARAMS records
+        r, w = os.pipe()
+        stdin = os.fdopen(r, 'rb', 0)
+        output = BytesIO()
+        runner = threading.Thread(target=lambda: server._connectionClass(stdin, output, server).run())
+        runner.start()
+        with os.fdopen(w, 'wb', 0) as pipe:
+            pipe.write(data[:head])
+            self.assertTrue(started.wait(2))
+            pipe.write(data[head:])
+        runner.join(2)
+        stdin.close()
+        self.assertEqual(parse_response(fcgi_stdout(output.getvalue()))[2], b'got ' + body)
+
+    def test_access_log_counts_the_whole_body(self):
+        import json
+        from django_windows_tools.management.commands.winfcgi import AccessLog
+
+        path = os.path.join(self.directory, 'access.log')
+        access_log = AccessLog(path)
+        body = b'x' * 5000
+        data = fcgi_request(upload_params(body=body), body, keepConn=True) + \
+            fcgi_request(upload_params('/ignore', body), body, requestId=2)
+        self.run_connection(self.server(access_log=access_log), data)
+        access_log.flush()
+        with open(path) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual([line['bytes_in'] for line in lines], [5000, 5000])
+
+    def test_capture_replayable(self):
+        from django_windows_tools.management.commands.winfcgi import TrafficCapture, Connection
+        from django_windows_tools.management.commands.winfcgi_replay import read_sessions, response_status
+
+        path = os.path.join(self.directory, 'capture.bin')
+        capture = TrafficCapture(path)
+        body = b'x' * 5000
+        data = fcgi_request(upload_params(body=body), body, keepConn=True) + \
+            fcgi_request(upload_params('/ignore', body), body, requestId=2)
+        self.run_connection(self.server(capture=capture), data)
+        capture.close()
+
+        sessions = read_sessions(path)
+        self.assertEqual(len(sessions), 2)
+        self.assertEqual(sessions[0].input.getvalue(), fcgi_request(upload_params(body=body), body, keepConn=True))
+        self.assertEqual(sessions[1].input.getvalue(), fcgi_request(upload_params('/ignore', body), body, requestId=2))
+        server = self.server()
+        output = BytesIO()
+        try:
+            # as in winfcgi_replay: the connection is kept for a next request
+            Connection(BytesIO(sessions[0].input.getvalue()), output, server).run()
+        except EOFError:
+            pass
+        self.assertEqual(response_status(output.getvalue()), '200')
+        self.assertEqual(parse_response(fcgi_stdout(output.getvalue()))[2], b'got ' + body)
+
+
+def page_params(path, **extra):
+    params = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': '', 'SERVER_NAME': 'testserver',
+              'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1', 'REMOTE_ADDR': '10.0.0.1'}
+    params.update(extra)
+    return params
+
+
+def run_requests(server, *params):
+    """Runs requests through a Connection, as sent by the web server."""
+    from django_windows_tools.management.commands.winfcgi import Connection
+
+    data = b''.join(fcgi_request(p, requestId=i + 1, keepConn=i + 1 < len(params)) for i, p in enumerate(params))
+    output = BytesIO()
+    Connection(BytesIO(data), output, server).run()
+    return output.getvalue()
+
+
+
+class RequestPoolTest(TestCase):
+    def test_reused_requests_do_not_leak(self):
+        from django_windows_tools.management.commands.winfcgi import Connection, FCGIServer
+
+        requests = []
+
+        def application(environ, start_response):
+            # only the first 5 bytes of the body are read
+            requests.append((environ['wsgi.input'], environ.get('HTTP_X_SECRET'), environ['wsgi.input'].read(5)))
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [b'ok']
+
+        data = fcgi_request(dict(upload_params(body=b'first body'), HTTP_X_SECRET='s3cr3t'), b'first body',
+                            keepConn=True)
+        data += fcgi_request(upload_params(body=b'other'), b'other')
+        output = BytesIO()
+        Connection(BytesIO(data), output, FCGIServer(application)).run()
+
+        self.assertEqual(fcgi_stdout(output.getvalue()).count(b'Status: 200 OK'), 2)
+        (first_input, first_secret, first_body), (second_input, second_secret, second_body) = requests
+        # the second request runs in the pooled Request of the first one
+        self.assertIs(first_input, second_input)
+        self.assertEqual((first_secret, first_body), ('s3cr3t', b'first'))
+        self.assertEqual((second_secret, second_body), (None, b'other'))
+
+
+class AccessLogTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'access.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_upload(self, access_log, body=b'hello', flush=True):
+        from django_windows_tools.management.commands.winfcgi import Connection, FCGIServer
+
+        output = BytesIO()
+        server = FCGIServer(echo, access_log=access_log)
+        Connection(BytesIO(fcgi_request(upload_params(body=body), body)), output, server).run()
+        if flush:
+            access_log.flush()
+        return fcgi_stdout(output.getvalue())
+
+    def read_lines(self, filename=None):
+        with open(filename or self.filename) as f:
+            return f.read().splitlines()
+
+    def test_json(self):
+        import json
+        from django_windows_tools.management.commands.winfcgi import AccessLog
+
+        stdout = self.run_upload(AccessLog(self.filename), b'x' * 3000)
+        lines = self.read_lines()
+        self.assertEqual(len(lines), 1)
+        line = json.loads(lines[0])
+        self.assertEqual(sorted(line), sorted(AccessLog.FIELDS))
+        self.assertEqual((line['method'], line['path'], line['status'], line['pid']),
+                         ('POST', '/upload', 200, os.getpid()))
+        self.assertEqual(line['bytes_in'], 3000)
+        # headers included
+        self.assertEqual(line['bytes_out'], len(stdout))
+        self.assertGreater(line['bytes_out'], 3004)
+        self.assertTrue(0 <= line['ttfb_ms'] <= line['total_ms'])
+
+    def test_csv(self):
+        from django_windows_tools.management.commands.winfcgi import AccessLog
+
+        access_log = AccessLog(self.filename, format='csv')
+        stdout = self.run_upload(access_log)
+        self.run_upload(access_log, b'')
+        lines = self.read_lines()
+        self.assertEqual(lines[0], ','.join(AccessLog.FIELDS))
+        self.assertEqual(len(lines), 3)
+        fields = lines[1].split(',')
+        self.assertEqual(fields[1:7], [str(os.getpid()), 'POST', '/upload', '200', '5', str(len(stdout))])
+        self.assertEqual(lines[2].split(',')[5], '0')
+
+    def test_buffered(self):
+        from django_windows_tools.management.commands.winfcgi import AccessLog
+
+        access_log = AccessLog(self.filename, flushInterval=3600)
+        access_log.endRequest({})  # no request: nothing is logged
+        self.run_upload(access_log, flush=False)
+        self.run_upload(access_log, flush=False)
+        self.assertFalse(os.path.exists(self.filename))
+        access_log.flush()
+        self.assertEqual(len(self.read_lines()), 2)
+
+    def test_rotation(self):
+        from django_windows_tools.management.commands.winfcgi import AccessLog
+
+        access_log = AccessLog(self.filename, maxBytes=300, backupCount=2)
+        for i in range(8):
+            self.run_upload(access_log)
+        self.assertEqual(sorted(os.listdir(self.directory)), ['access.log', 'access.log.1', 'access.log.2'])
+        total = sum(len(self.read_lines(os.path.join(self.directory, name))) for name in os.listdir(self.directory))
+        self.assertLess(total, 8)
+        for name in os.listdir(self.directory):
+            self.assertLessEqual(os.path.getsize(os.path.join(self.directory, name)), 300)
+
+
+class RequestTracerTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_traced(self, tracer, *params):
+        from django_windows_tools.management.commands.winfcgi import FCGIServer
+
+        def application(environ, start_response):
+            trace = environ.get('fcgi.trace')
+            if trace is not None:
+                with trace.span('view'):
+                    pass
+            return echo(environ, start_response)
+
+        return run_requests(FCGIServer(application, tracer=tracer), *params)
+
+    def read_traces(self):
+        import json
+
+        traces = []
+        for name in sorted(os.listdir(self.directory)):
+            self.assertTrue(name.startswith('fcgi_trace_%d_' % os.getpid()))
+            with open(os.path.join(self.directory, name)) as f:
+                traces.append(json.load(f)['traceEvents'])
+        return traces
+
+    def test_timeline(self):
+        from django_windows_tools.management.commands.winfcgi import RequestTracer
+
+        self.run_traced(RequestTracer(self.directory, rate=1), page_params('/first', QUERY_STRING='a=1'))
+        events, = self.read_traces()
+        names = [event['name'] for event in events]
+        for name in ('read BEGIN_REQUEST', 'read PARAMS', 'decode params', 'read STDIN', 'view', 'application',
+                     'response', 'write STDOUT', 'end_request', 'write END_REQUEST'):
+            self.assertIn(name, names)
+        request = events[-1]
+        self.assertEqual(request['name'], 'request')
+        self.assertEqual(request['args'], {'method': 'GET', 'path': '/first', 'query': 'a=1'})
+        for event in events:
+            self.assertEqual(event['ph'], 'X')
+            self.assertGreaterEqual(event['ts'], request['ts'])
+            self.assertLessEqual(event['ts'] + event['dur'], request['ts'] + request['dur'] + 1)
+
+    def test_sampling(self):
+        from django_windows_tools.management.commands.winfcgi import RequestTracer
+
+        self.run_traced(RequestTracer(self.directory, rate=0), page_params('/first'), page_params('/second'))
+        self.assertEqual(self.read_traces(), [])
+
+    def test_max_files(self):
+        from django_windows_tools.management.commands.winfcgi import RequestTracer
+
+        tracer = RequestTracer(self.directory, rate=1, maxFiles=2)
+        self.run_traced(tracer, *[page_params('/page%d' % i) for i in range(4)])
+        self.assertEqual(tracer.written, 2)
+        self.assertEqual([events[-1]['args']['path'] for events in self.read_traces()], ['/page0', '/page1'])
+
+class RequestProfilerTest(TestCase):
+    def setUp(self):
+        from django_windows_tools.management.commands.winfcgi import FCGIServer, RequestProfiler
+
+        self.directory = tempfile.mkdtemp()
+        self.profiler = RequestProfiler(self.directory, every=0, pattern=r'^/reports/')
+        self.server = FCGIServer(echo, app_root='/site', profiler=self.profiler)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_pattern_matches_the_application_path(self):
+        run_requests(self.server, page_params('/site/reports/monthly'), page_params('/site/other'),
+                     page_params('', REQUEST_URI='/site/reports/%79early?x=1'))
+        self.assertEqual(sorted(self.profiler._stats), ['/reports/monthly', '/reports/yearly'])
+
+    def test_dump(self):
+        run_requests(self.server, page_params('/site/reports/monthly'))
+        self.profiler.dump()
+        self.assertEqual(os.listdir(self.directory), ['fcgi_profile_%d_reports_monthly.pstats' % os.getpid()])
+
+
+class StackTracerTest(TestCase):
+    def setUp(self):
+        from django_windows_tools.management.commands.winfcgi import FCGIServer, StackTracer
+
+        self.directory = tempfile.mkdtemp()
+        self.stack_tracer = StackTracer(self.directory, threshold=0.1, interval=10)
+        self.server = FCGIServer(self.slow, app_root='/site', stack_tracer=self.stack_tracer)
+
+    def tearDown(self):
+        self.stack_tracer.endRequest()
+        shutil.rmtree(self.directory)
+
+    def slow(self, environ, start_response):
+        if environ['PATH_INFO'] == '/reports/monthly':
+            time.sleep(0.5)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [b'ok']
+
+    def test_slow_request_reported(self):
+        run_requests(self.server, page_params('/site/fast'), page_params('/site/reports/monthly'))
+        self.assertEqual(self.stack_tracer.reports, 1)
+        with open(self.stack_tracer.filename) as f:
+            report = f.read()
+        self.assertIn('  PATH_INFO=/reports/monthly\n', report)
+        self.assertIn('in slow: time.sleep(0.5)', report)
+
+
+class SoftTimeoutTest(TestCase):
+    def setUp(self):
+        from django_windows_tools.management.commands.winfcgi import SoftTimeout
+
+        self.soft_timeout = SoftTimeout(0.3)
+
+    def slow(self, environ, start_response):
+        if environ['PATH_INFO'] == '/slow':
+            for i in range(100):
+                time.sleep(0.05)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [b'ok']
+
+    def streamed(self, environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        chunk = b'x' * 1000
+        while True:
+            sum(range(10000))
+            yield chunk
+
+    def records(self, output):
+        """Returns the (type, content) of the records of output, checking that they are complete."""
+        from django_windows_tools.management.commands.winfcgi import FCGI_Header, FCGI_HEADER_LEN
+
+        records = []
+        pos = 0
+        while pos < len(output):
+            version, type, requestId, contentLength, paddingLength = \
+                struct.unpack(FCGI_Header, output[pos:pos + FCGI_HEADER_LEN])
+            self.assertEqual((version, requestId), (1, 1))
+            pos += FCGI_HEADER_LEN
+            records.append((type, output[pos:pos + contentLength]))
+            pos += contentLength + paddingLength
+        self.assertEqual(pos, len(output))
+        return records
+
+    def run_request(self, application, path):
+        from django_windows_tools.management.commands.winfcgi import FCGIServer
+
+        server = FCGIServer(application, soft_timeout=self.soft_timeout)
+        start = time.time()
+        output = run_requests(server, page_params(path))
+        return output, time.time() - start
+
+    def test_gateway_timeout(self):
+        from django_windows_tools.management.commands.winfcgi import FCGI_END_REQUEST, FCGI_STDOUT, \
+            FCGI_EndRequestBody, FCGI_REQUEST_COMPLETE
+
+        output, elapsed = self.run_request(self.slow, '/slow')
+        self.assertTrue(elapsed < 2, elapsed)
+        self.assertEqual(parse_response(fcgi_stdout(output))[0], '504 Gateway Timeout')
+        records = self.records(output)
+        self.assertEqual(records[-2], (FCGI_STDOUT, b''))
+        self.assertEqual(records[-1], (FCGI_END_REQUEST, struct.pack(FCGI_EndRequestBody, 0, FCGI_REQUEST_COMPLETE)))
+        self.assertEqual(self.soft_timeout.timeouts, 1)
+
+    def test_fast_request_not_interrupted(self):
+        output, elapsed = self.run_request(self.slow, '/fast')
+        self.assertEqual(parse_response(fcgi_stdout(output))[2], b'ok')
+        self.assertEqual(self.soft_timeout.timeouts, 0)
+
+    def test_no_partial_record(self):
+        from django_windows_tools.management.commands.winfcgi import FCGI_END_REQUEST
+
+        for i in range(3):
+            output, elapsed = self.run_request(self.streamed, '/stream')
+            records = self.records(output)
+            self.assertEqual(records[-1][0], FCGI_END_REQUEST)
+            self.assertTrue(parse_response(fcgi_stdout(output))[2].strip(b'x') == b'')
+
+    def test_asgi_tasks_cancelled(self):
+        import asyncio
+        from django_windows_tools.asgi import ASGIBridge
+
+        cancelled = []
+
+        async def application(scope, receive, send):
+            async def child():
+                try:
+                    await asyncio.sleep(60)
+                except asyncio.CancelledError:
+                    cancelled.append('child')
+                    raise
+            asyncio.ensure_future(child())
+            try:
+                for i in range(100):
+                    await asyncio.sleep(0.05)
+            except asyncio.CancelledError:
+                cancelled.append('application')
+                raise
+
+        bridge = ASGIBridge(application)
+        try:
+            output, elapsed = self.run_request(bridge, '/slow')
+            self.assertTrue(elapsed < 2, elapsed)
+            self.assertEqual(parse_response(fcgi_stdout(output))[0], '504 Gateway Timeout')
+            self.assertEqual(sorted(cancelled), ['application', 'child'])
+            self.assertEqual([task for task in asyncio.all_tasks(bridge.loop) if not task.done()], [])
+        finally:
+            bridge.loop.close()
+
+
+class MemoryWatchdogTest(TestCase):
+    def setUp(self):
+        from django_windows_tools.management.commands import winfcgi
+
+        self.winfcgi = winfcgi
+        self.rss = 100
+        self.measures = 0
+
+        def get_rss():
+            self.measures += 1
+            return self.rss
+
+        self.get_rss = winfcgi.get_rss
+        winfcgi.get_rss = get_rss
+        self.watchdog = winfcgi.MemoryWatchdog(1000, checkEvery=10, sampleEvery=100)
+
+    def tearDown(self):
+        self.winfcgi.get_rss = self.get_rss
+
+    def test_checked_every_check_every_requests(self):
+        self.assertEqual([self.watchdog.check(requests) for requests in range(1, 31)], [False] * 30)
+        self.assertEqual(self.measures, 4)  # first request, 10, 20 and 30
+        self.assertEqual(list(self.watchdog.samples), [(1, 100)])
+
+    def test_soft_limit_exceeded(self):
+        self.assertFalse(self.watchdog.check(10))
+        self.rss = 2000
+        self.assertFalse(self.watchdog.check(11))
+        self.assertTrue(self.watchdog.check(20))
+        self.assertEqual(list(self.watchdog.samples), [(20, 2000)])
+
+    def test_connection_stopped(self):
+        from django_windows_tools.management.commands.winfcgi import FCGIServer, MemoryWatchdog
+
+        self.rss = 2000
+        server = FCGIServer(echo, memory_watchdog=MemoryWatchdog(1000))
+        output = run_requests(server, page_params('/first'), page_params('/second'))
+        self.assertEqual(fcgi_stdout(output).count(b'Status: 200 OK'), 1)
+
+
+class GCPolicyTest(TestCase):
+    def setUp(self):
+        import gc
+
+        self.gc = gc
+        self.thresholds = gc.get_threshold()
+
+    def tearDown(self):
+        self.gc.set_threshold(*self.thresholds)
+        if hasattr(self.gc, 'unfreeze'):
+            self.gc.unfreeze()
+
+    def policy(self, **options):
+        from django_windows_tools.management.commands.winfcgi import GCPolicy
+
+        return GCPolicy(**options)
+
+    def test_thresholds(self):
+        policy = self.policy(freeze=False)
+        policy.beginRequest()
+        self.assertEqual(self.gc.get_threshold(), (100000,) + self.thresholds[1:])
+        policy.endRequest(1)
+        self.assertEqual(self.gc.get_threshold()[0], 0)
+
+    def test_collected_between_requests(self):
+        policy = self.policy(freeze=False, idleThreshold=10)
+        policy.beginRequest()
+        garbage = [[] for i in range(100)]
+        policy.endRequest(1)
+        self.assertEqual(policy.collections, 1)
+        self.assertLess(self.gc.get_count()[0], 10)
+        # few allocations: nothing is collected
+        policy.beginRequest()
+        policy.endRequest(2)
+        self.assertEqual(policy.collections, 1)
+
+    def test_freeze(self):
+        if not hasattr(self.gc, 'freeze'):
+            self.skipTest('gc.freeze requires Python 3.7')
+        policy = self.policy(freezeAfter=2)
+        policy.beginRequest()
+        policy.endRequest(1)
+        self.assertEqual(self.gc.get_freeze_count(), 0)
+        policy.beginRequest()
+        policy.endRequest(2)
+        self.assertGreater(self.gc.get_freeze_count(), 0)
+
+
+class RecyclerTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.location = os.path.join(self.directory, 'recycling.bin')
+        self.recyclers = []
+
+    def tearDown(self):
+        for recycler in self.recyclers:
+            if recycler._shared is not None:
+                recycler._shared.close()
+        shutil.rmtree(self.directory)
+
+    def recycler(self, **options):
+        from django_windows_tools.management.commands.winfcgi import Recycler
+
+        recycler = Recycler(**options)
+        self.recyclers.append(recycler)
+        return recycler
+
+    def test_request_limit(self):
+        recycler = self.recycler(maxRequests=100, jitter=0)
+        self.assertEqual(recycler.requestLimit, 100)
+        self.assertFalse(recycler.check(99))
+        self.assertTrue(recycler.check(100))
+
+    def test_jitter(self):
+        limits = set(self.recycler(maxRequests=1000, maxUptime=3600, jitter=0.5).requestLimit for i in range(20))
+        self.assertGreater(len(limits), 1)
+        for limit in limits:
+            self.assertTrue(500 <= limit <= 1000)
+        recycler = self.recycler(maxRequests=1000, maxUptime=3600, jitter=0.5)
+        self.assertAlmostEqual(recycler.uptimeLimit / 3600, recycler.requestLimit / 1000.0, places=2)
+
+    def test_uptime_limit(self):
+        recycler = self.recycler(maxUptime=60, jitter=0)
+        self.assertFalse(recycler.check(1))
+        recycler.started -= 60
+        self.assertTrue(recycler.check(2))
+
+    def test_stagger(self):
+        first = self.recycler(maxRequests=10, jitter=0, location=self.location, stagger=0.2)
+        second = self.recycler(maxRequests=10, jitter=0, location=self.location, stagger=0.2)
+        self.assertTrue(first.check(10))
+        # the slot is taken by the first process
+        self.assertFalse(second.check(10))
+        self.assertFalse(second.check(11))
+        time.sleep(0.3)
+        self.assertTrue(second.check(12))
+
+    def test_warm(self):
+        from django_windows_tools.management.commands.winfcgi import FCGIServer
+
+        paths = []
+
+        def application(environ, start_response):
+            paths.append((environ['PATH_INFO'], environ['QUERY_STRING'], environ['HTTP_HOST']))
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [b'ok']
+
+        recycler = self.recycler(warmup=('/', '/search?q=x'), warmupHost='www.example.com')
+        recycler.warm(FCGIServer(application))
+        self.assertEqual(paths, [('/', '', 'www.example.com'), ('/search', 'q=x', 'www.example.com')])
+
+    def test_warm_after_first_request(self):
+        from django_windows_tools.management.commands.winfcgi import FCGIServer
+
+        paths = []
+
+        def application(environ, start_response):
+            paths.append(environ['PATH_INFO'])
+            return echo(environ, start_response)
+
+        server = FCGIServer(application, recycler=self.recycler(warmup=('/warm',)))
+        output = run_requests(server, page_params('/first'), page_params('/second'))
+        self.assertEqual(paths, ['/first', '/warm', '/second'])
+        self.assertEqual(fcgi_stdout(output).count(b'Status: 200 OK'), 2)
+
+class RequestCoalescerTest(TestCase):
+    def setUp(self):
+        from django_windows_tools.management.commands.winfcgi import RequestCoalescer
+
+        self.directory = tempfile.mkdtemp()
+        location = os.path.join(self.directory, 'flights.bin')
+        self.leader = RequestCoalescer(location, timeout=2, size=1024 * 1024)
+        self.follower = RequestCoalescer(location, timeout=2, size=1024 * 1024)
+        self.flight = self.leader.key(request_environ(PATH_INFO='/'))
+
+    def tearDown(self):
+        self.leader._shared.close()
+        self.follower._shared.close()
+        shutil.rmtree(self.directory)
+
+    def follow(self, status):
+        """Returns what the follower receives while the leader answers with status."""
+        self.assertTrue(self.leader.lead(self.flight))
+        self.assertFalse(self.follower.lead(self.flight))
+        received = []
+        follower = threading.Thread(target=lambda: received.append(self.follower.wait(self.flight)))
+        follower.start()
+        time.sleep(0.05)
+        self.leader.publish(self.flight, status, [('Content-Type', 'text/html')], b'page')
+        self.leader.release(self.flight)
+        follower.join()
+        return received[0]
+
+    def test_success_shared(self):
+        entry = self.follow('200 OK')
+        self.assertEqual(entry.status, '200 OK')
+        self.assertEqual(entry.body, b'page')
+        self.assertEqual(self.follower.coalesced, 1)
+
+    def test_server_error_not_shared(self):
+        start = time.time()
+        self.assertIsNone(self.follow('503 Service Unavailable'))
+        # the follower runs the request as soon as the leader is done, not after the timeout
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(self.follower.timeouts, 0)
+
+    def test_not_modified_not_shared(self):
+        self.assertIsNone(self.follow('304 Not Modified'))
+
+
+
+class SharedCacheTest(TestCase):
+    def setUp(self):
+        from django_windows_tools.sharedmem import SharedCache
+
+        self.directory = tempfile.mkdtemp()
+        self.location = os.path.join(self.directory, 'cache.bin')
+        self.cache = SharedCache(self.location, size=64 * 1024, max_chunk=4096)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.directory)
+
+    def test_set_and_get(self):
+        self.assertIsNone(self.cache.get(b'page'))
+        self.assertTrue(self.cache.set(b'page', b'hello'))
+        self.assertEqual(self.cache.get(b'page'), b'hello')
+        self.assertTrue(self.cache.set(b'page', b'x' * 2000))
+        self.assertEqual(self.cache.get(b'page'), b'x' * 2000)
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 1))
+
+    def test_too_large(self):
+        self.assertFalse(self.cache.set(b'page', b'x' * 8192))
+        self.assertIsNone(self.cache.get(b'page'))
+
+    def test_expiration(self):
+        self.cache.set(b'page', b'hello', time.time() - 1)
+        self.assertIsNone(self.cache.get(b'page'))
+        self.assertTrue(self.cache.add(b'page', b'again', time.time() + 60))
+        self.assertFalse(self.cache.add(b'page', b'other', time.time() + 60))
+        self.assertEqual(self.cache.get(b'page'), b'again')
+
+    def test_delete(self):
+        for key in (b'a:1', b'a:2', b'b:1'):
+            self.cache.set(key, key)
+        self.assertTrue(self.cache.delete(b'b:1'))
+        self.assertFalse(self.cache.delete(b'b:1'))
+        self.cache.delete_prefix(b'a:')
+        self.assertEqual([self.cache.get(key) for key in (b'a:1', b'a:2', b'b:1')], [None, None, None])
+
+    def test_clear(self):
+        self.cache.set(b'page', b'hello')
+        self.cache.clear()
+        self.assertIsNone(self.cache.get(b'page'))
+
+    def test_eviction(self):
+        for i in range(200):
+            self.assertTrue(self.cache.set(('page %d' % i).encode('ascii'), b'x' * 100))
+        self.assertEqual(self.cache.get(b'page 199'), b'x' * 100)
+        # the 1 KB class has 32 chunks (full index buckets can evict a few more values)
+        kept = [i for i in range(200) if self.cache.get(('page %d' % i).encode('ascii')) is not None]
+        self.assertTrue(16 < len(kept) <= 32, kept)
+
+    def test_lock_excludes_the_threads_of_the_process(self):
+        done = threading.Event()
+        writer = threading.Thread(target=lambda: (self.cache.set(b'page', b'hello'), done.set()))
+        with self.cache.lock():
+            writer.start()
+            self.assertFalse(done.wait(0.1))
+        writer.join()
+        self.assertEqual(self.cache.get(b'page'), b'hello')
+
+    def test_shared_by_processes(self):
+        from django_windows_tools.sharedmem import SharedCache
+
+        self.cache.set(b'page', b'hello')
+        other = SharedCache(self.location, size=64 * 1024, max_chunk=4096)
+        try:
+            self.assertEqual(other.get(b'page'), b'hello')
+            other.delete(b'page')
+            self.assertIsNone(self.cache.get(b'page'))
+        finally:
+            other.close()
+
+
+class ScoreboardTest(TestCase):
+    def setUp(self):
+        from django_windows_tools.sharedmem import Scoreboard
+
+        self.directory = tempfile.mkdtemp()
+        self.location = os.path.join(self.directory, 'scoreboard.bin')
+        self.scoreboard = Scoreboard(self.location, slots=4)
+
+    def tearDown(self):
+        self.scoreboard.close()
+        shutil.rmtree(self.directory)
+
+    def dead_pid(self):
+        import subprocess
+        import sys
+
+        process = subprocess.Popen([sys.executable, '-c', 'pass'])
+        process.wait()
+        return process.pid
+
+    def test_claim_and_update(self):
+        slot = self.scoreboard.claim()
+        self.assertEqual(slot, 0)
+        self.scoreboard.update(slot, state=self.scoreboard.BUSY, path=u'/caf\xe9', requests=3)
+        (read_slot, status), = self.scoreboard.read()
+        self.assertEqual(read_slot, slot)
+        self.assertEqual((status['pid'], status['state'], status['path'], status['requests']),
+                         (os.getpid(), 'busy', u'/caf\xe9', 3))
+        # a process restarting with the same pid reuses its slot
+        self.assertEqual(self.scoreboard.claim(), slot)
+        self.scoreboard.release(slot)
+        self.assertEqual(self.scoreboard.read(), [])
+
+    def test_dead_process_slot_reclaimed(self):
+        from django_windows_tools.sharedmem import Scoreboard
+
+        pid, alive = self.dead_pid(), os.getppid()
+        for slot in range(4):
+            self.scoreboard._write(slot, (pid if slot == 2 else alive, Scoreboard.IDLE, 0, 0, 0.0, 0.0, 0.0, b'', b''))
+        self.assertEqual(self.scoreboard.claim(), 2)
+        # full table of live processes
+        self.scoreboard._write(2, (alive, Scoreboard.IDLE, 0, 0, 0.0, 0.0, 0.0, b'', b''))
+        self.assertIsNone(self.scoreboard.claim())
+
+    def test_shared_between_instances(self):
+        from django_windows_tools.sharedmem import Scoreboard
+
+        other = Scoreboard(self.location, slots=4)
+        try:
+            self.scoreboard.update(self.scoreboard.claim(), error='boom')
+            (slot, status), = other.read()
+            self.assertEqual(status['error'], 'boom')
+        finally:
+            other.close()
+
+    def test_worker_status(self):
+        from django_windows_tools.management.commands.winfcgi import FCGIServer, WorkerStatus
+
+        def application(environ, start_response):
+            if environ['PATH_INFO'] == '/fail':
+                raise ValueError('failed')
+            (slot, status), = self.scoreboard.read()
+            self.assertEqual((status['state'], status['path']), ('busy', environ['PATH_INFO']))
+            return echo(environ, start_response)
+
+        worker_status = WorkerStatus(self.scoreboard, rssEvery=2)
+        worker_status.start()
+        server = FCGIServer(application, worker_status=worker_status)
+        run_requests(server, page_params('/first'), page_params('/fail'), page_params('/third'))
+        (slot, status), = self.scoreboard.read()
+        self.assertEqual((status['pid'], status['state'], status['requests']), (os.getpid(), 'idle', 3))
+        self.assertIn('/fail', status['error'])
+        self.assertGreater(status['rss'], 0)
+        worker_status.stop()
+        self.assertEqual(self.scoreboard.read(), [])
+
+class TokenBucketsTest(TestCase):
+    def setUp(self):
+        from django_windows_tools.sharedmem import TokenBuckets
+
+        self.directory = tempfile.mkdtemp()
+        self.location = os.path.join(self.directory, 'ratelimit.bin')
+        self.buckets = TokenBuckets(self.location, entries=64)
+
+    def tearDown(self):
+        self.buckets.close()
+        shutil.rmtree(self.directory)
+
+    def test_burst_then_rate(self):
+        self.assertEqual([self.buckets.take(b'10.0.0.1', 1, 3) for i in range(3)], [0, 0, 0])
+        wait = self.buckets.take(b'10.0.0.1', 1, 3)
+        self.assertTrue(0 < wait <= 1, wait)
+
+    def test_refill(self):
+        self.assertEqual(self.buckets.take(b'10.0.0.1', 20, 1), 0)
+        self.assertTrue(self.buckets.take(b'10.0.0.1', 20, 1) > 0)
+        time.sleep(0.1)
+        self.assertEqual(self.buckets.take(b'10.0.0.1', 20, 1), 0)
+
+    def test_clients_have_their_own_bucket(self):
+        self.assertEqual(self.buckets.take(b'10.0.0.1', 1, 1), 0)
+        self.assertTrue(self.buckets.take(b'10.0.0.1', 1, 1) > 0)
+        self.assertEqual(self.buckets.take(b'10.0.0.2', 1, 1), 0)
+
+    def test_buckets_shared_by_processes(self):
+        from django_windows_tools.sharedmem import TokenBuckets
+
+        other = TokenBuckets(self.location, entries=64)
+        try:
+            self.assertEqual(self.buckets.take(b'10.0.0.1', 1, 1), 0)
+            self.assertTrue(other.take(b'10.0.0.1', 1, 1) > 0)
+        finally:
+            other.close()
+
+
+class RateLimiterTest(TestCase):
+    def setUp(self):
+        from django_windows_tools.management.commands.winfcgi import RateLimiter
+
+        self.directory = tempfile.mkdtemp()
+        self.limiter = RateLimiter(os.path.join(self.directory, 'ratelimit.bin'), rate=1, burst=1,
+                                   key='HTTP_X_FORWARDED_FOR', entries=64)
+
+    def tearDown(self):
+        self.limiter._buckets.close()
+        shutil.rmtree(self.directory)
+
+    def status(self, environ):
+        req = FakeRequest()
+        if not self.limiter.handle(req, environ):
+            return None
+        return parse_response(req.stdout.data)[0]
+
+    def test_over_limit(self):
+        environ = request_environ(HTTP_X_FORWARDED_FOR='192.0.2.1')
+        self.assertIsNone(self.status(environ))
+        self.assertEqual(self.status(environ), '429 Too Many Requests')
+        self.assertEqual(self.limiter.limited, 1)
+
+    def test_zero_rate_rejected(self):
+        from django.core.exceptions import ImproperlyConfigured
+        from django_windows_tools.management.commands.winfcgi import make_rate_limiter
+
+        with self.assertRaises(ImproperlyConfigured):
+            make_rate_limiter({'LOCATION': os.path.join(self.directory, 'ratelimit.bin'), 'RATE': 0})
+
+    def test_requests_without_key_limited_on_address(self):
+        self.assertIsNone(self.status(request_environ()))
+        self.assertEqual(self.status(request_environ()), '429 Too Many Requests')
+
+class ASGIScopeTest(TestCase):
+    def setUp(self):
+        from django_windows_tools.asgi import ASGIBridge
+
+        self.bridge = ASGIBridge(None)
+
+    def tearDown(self):
+        self.bridge.loop.close()
+
+    def test_headers(self):
+        scope = self.bridge.scope(request_environ(CONTENT_TYPE='text/plain', HTTP_ACCEPT_LANGUAGE='fr'))
+        headers = dict(scope['headers'])
+        self.assertEqual(headers[b'content-type'], b'text/plain')
+        self.assertEqual(headers[b'accept-language'], b'fr')
+        self.assertEqual(headers[b'host'], b'testserver')
+        self.assertNotIn(b'content-length', headers)
+        self.assertEqual(scope['client'], ('10.0.0.1', 0))
+
+    def test_non_latin_header(self):
+        referer = u'http://example.com/привет'
+        scope = self.bridge.scope(request_environ(HTTP_REFERER=referer))
+        self.assertEqual(dict(scope['headers'])[b'referer'], referer.encode('utf-8'))
+
+    def test_path_and_query_string(self):
+        scope = self.bridge.scope(request_environ(PATH_INFO=u'/caf\xe9', QUERY_STRING='q=1',
+                                                  REQUEST_URI='/caf%C3%A9?q=1'))
+        self.assertEqual(scope['path'], u'/caf\xe9')
+        self.assertEqual(scope['raw_path'], b'/caf%C3%A9')
+        self.assertEqual(scope['query_string'], b'q=1')
+
+    def test_non_latin_query_string(self):
+        scope = self.bridge.scope(request_environ(PATH_INFO=u'/search', QUERY_STRING=u'q=привет',
+                                                  REQUEST_URI=u'/search?q=привет'))
+        self.assertEqual(scope['query_string'], u'q=привет'.encode('utf-8'))
+
+
+class ASGIBridgeTest(TestCase):
+    def setUp(self):
+        from django_windows_tools.asgi import ASGIBridge
+
+        self.events = []
+        self.bridge = ASGIBridge(self.application)
+
+    def tearDown(self):
+        self.bridge.loop.close()
+
+    async def application(self, scope, receive, send):
+        body = b''
+        while True:
+            message = await receive()
+            self.events.append((message['type'], len(message['body']), message['more_body']))
+            body += message['body']
+            if not message['more_body']:
+                break
+        await send({'type': 'http.response.start', 'status': 201,
+                    'headers': [(b'content-type', b'text/plain'), (b'x-length', str(len(body)).encode('ascii'))]})
+        await send({'type': 'http.response.body', 'body': b'got ', 'more_body': True})
+        await send({'type': 'http.response.body', 'body': body[:10]})
+        self.events.append((await receive())['type'])
+
+    def test_request_and_response(self):
+        body = b'x' * 100000
+        req = FakeRequest(request_environ(REQUEST_METHOD='POST', PATH_INFO='/upload',
+                                          CONTENT_LENGTH=str(len(body))))
+        req.stdin = BytesIO(body)
+        status, headers, content = parse_response(run_handler(self.bridge, req).stdout.data)
+        self.assertEqual(status, '201 Created')
+        self.assertEqual(headers['content-type'], 'text/plain')
+        self.assertEqual(headers['x-length'], '100000')
+        self.assertEqual(content, b'got xxxxxxxxxx')
+        self.assertEqual(self.events, [('http.request', 65536, True), ('http.request', 34464, False),
+                                       'http.disconnect'])
+
+    def test_empty_body(self):
+        req = FakeRequest(request_environ())
+        status, headers, content = parse_response(run_handler(self.bridge, req).stdout.data)
+        self.assertEqual(status, '201 Created')
+        self.assertEqual(content, b'got ')
+        self.assertEqual(self.events, [('http.request', 0, False), 'http.disconnect'])
+
+
+
+class TrafficCaptureTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def capture(self, params, **options):
+        from django_windows_tools.management.commands.winfcgi import TrafficCapture, Record, read_capture, \
+            encode_pair, decode_pair, FCGI_BEGIN_REQUEST, FCGI_PARAMS
+
+        path = os.path.join(self.directory, 'capture.bin')
+        capture = TrafficCapture(path, **options)
+        begin = Record(FCGI_BEGIN_REQUEST, 1)
+        begin.contentData = b'\x00\x01\x01\x00\x00\x00\x00\x00'
+        begin.contentLength = 8
+        capture.recordIn(begin)
+        rec = Record(FCGI_PARAMS, 1)
+        rec.contentData = b''.join(encode_pair(name, value) for name, value in params)
+        rec.contentLength = len(rec.contentData)
+        capture.recordIn(rec)
+        capture.close()
+        with open(path, 'rb') as f:
+            entries = list(read_capture(f))
+        content, contentLength = entries[1][5], entries[1][4]
+        self.assertEqual(contentLength, len(content))
+        captured = []
+        pos = 0
+        while pos < len(content):
+            pos, pair = decode_pair(content, pos)
+            captured.append(pair)
+        return captured
+
+    def test_credentials_scrubbed(self):
+        params = [('PATH_INFO', '/'), ('HTTP_COOKIE', 'sessionid=abc'), ('HTTP_AUTHORIZATION', 'Bearer secret')]
+        self.assertEqual(self.capture(params, scrub=('HTTP_COOKIE', 'HTTP_AUTHORIZATION')), [('PATH_INFO', '/')])
+
+    def test_params_kept_without_scrub(self):
+        params = [('PATH_INFO', '/'), ('HTTP_COOKIE', 'sessionid=abc')]
+        self.assertEqual(self.capture(params), params)
+
+    def test_replay_stores_relocated(self):
+        from django_windows_tools.management.commands.winfcgi import relocate
+
+        options = {'LOCATION': os.path.join('sites', 'ratelimit.bin'), 'RATE': 10}
+        self.assertEqual(relocate(options, self.directory),
+                         {'LOCATION': os.path.join(self.directory, 'ratelimit.bin'), 'RATE': 10})
+        self.assertEqual(relocate(options, None), options)
+        self.assertEqual(relocate(True, self.directory), True)
+
+SERVICE_CONFIG = '''
+[services]
+run=celeryd
+clean=
+
+[celeryd]
+command=celeryd
+parameters=-l %s -f celery%%(index)s.log
+replicas=2
+'''
+
+
+
+class ServiceConfigTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def config(self, text):
+        from django_windows_tools import service
+
+        with open(os.path.join(self.directory, 'service.ini'), 'w') as f:
+            f.write(text)
+        return service.read_config(self.directory)
+
+    def test_command_args(self):
+        from django_windows_tools.service import get_command_args
+
+        config = self.config(SERVICE_CONFIG % 'info')
+        self.assertEqual(get_command_args(config, 'celeryd')[1:], ['celeryd', '-l', 'info', '-f', 'celery0.log'])
+        self.assertEqual(get_command_args(config, 'celeryd', 3)[1:], ['celeryd', '-l', 'info', '-f', 'celery3.log'])
+
+    def test_replicas(self):
+        from multiprocessing import cpu_count
+        from django_windows_tools.service import get_replicas
+
+        config = self.config('''
+[single]
+command=runfcgi
+parameters=
+
+[many]
+command=runfcgi
+parameters=
+replicas= 3
+
+[auto]
+command=runfcgi
+parameters=
+replicas=Auto
+''')
+        self.assertEqual(get_replicas(config, 'single'), 1)
+        self.assertEqual(get_replicas(config, 'many'), 3)
+        self.assertEqual(get_replicas(config, 'auto'), cpu_count())
+
+    def test_deprecated_modification_handle(self):
+        import warnings
+        from django_windows_tools.service import get_config_modification_handle
+        from django_windows_tools.watcher import ConfigWatcher
+
+        self.config(SERVICE_CONFIG % 'info')
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            watcher = get_config_modification_handle(self.directory)
+        try:
+            self.assertIsInstance(watcher, ConfigWatcher)
+            self.assertEqual(watcher.path, os.path.join(self.directory, 'service.ini'))
+            self.assertEqual([warning.category for warning in caught], [DeprecationWarning])
+        finally:
+            watcher.close()
+
+    def test_instances(self):
+        import platform
+        from django_windows_tools.service import get_instances
+
+        config = self.config('''
+[services]
+run=celeryd
+
+[%s]
+run=celeryd celerybeat
+
+[celeryd]
+command=celeryd
+parameters=--hostname=worker%%(index)s
+replicas=3
+affinity=2, 5
+
+[celerybeat]
+command=celerybeat
+parameters=
+''' % platform.node())
+        self.assertEqual(get_instances(config), [('celeryd', 0, 2), ('celeryd', 1, 5), ('celeryd', 2, 2),
+                                                 ('celerybeat', 0, None)])
+
+class FakeProcess(object):
+    def __init__(self, args):
+        self.args = args
+        self.exitcode = None
+        self.sentinel = None
+        self.terminated = False
+
+    def terminate(self):
+        self.terminated = True
+        self.exitcode = -15
+
+    def join(self):
+        pass
+
+
+class ServiceSupervisorTest(TestCase):
+    def setUp(self):
+        from django_windows_tools import service
+
+        self.service = service
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'service.ini')
+        self.write('info')
+        self.spawned = []
+
+        def spawn_command(config, server_name, index=0, cpu=None):
+            process = FakeProcess(service.get_command_args(config, server_name, index))
+            self.spawned.append(process)
+            return process
+
+        self.spawn_command = service.spawn_command
+        service.spawn_command = spawn_command
+        self.supervisor = service.ServiceSupervisor(self.directory)
+        self.supervisor.start()
+
+    def tearDown(self):
+        self.service.spawn_command = self.spawn_command
+        shutil.rmtree(self.directory)
+
+    def write(self, level):
+        with open(self.path, 'w') as f:
+            f.write(SERVICE_CONFIG % level)
+
+    def watch(self, writes):
+        """Runs the writes in a thread and returns the number of reloads triggered."""
+        from django_windows_tools.watcher import PollingBackend
+
+        watcher = self.supervisor.watch_config(debounce=0.2, backend=PollingBackend(self.path, interval=0.02))
+        thread = threading.Thread(target=writes)
+        thread.start()
+        reloads = 0
+        deadline = time.time() + 1.5
+        while time.time() < deadline:
+            if watcher.wait(0.1):
+                self.supervisor.reload_config()
+                reloads += 1
+        thread.join()
+        watcher.close()
+        return reloads
+
+    def test_start(self):
+        self.assertEqual([process.args[1:] for process in self.spawned],
+                         [['celeryd', '-l', 'info', '-f', 'celery0.log'],
+                          ['celeryd', '-l', 'info', '-f', 'celery1.log']])
+
+    def test_burst_of_writes_reloads_once(self):
+        def writes():
+            for level in ('warning', 'error', 'debug'):
+                time.sleep(0.05)
+                self.write(level)
+
+        self.assertEqual(self.watch(writes), 1)
+        self.assertEqual(len(self.spawned), 4)
+        self.assertTrue(all(process.terminated for process in self.spawned[:2]))
+        self.assertEqual([command.args[2:4] for command in self.supervisor.commands],
+                         [['-l', 'debug'], ['-l', 'debug']])
+
+    def test_unchanged_save_does_not_reload(self):
+        def writes():
+            time.sleep(0.05)
+            self.write('info')
+            stat = os.stat(self.path)
+            os.utime(self.path, (stat.st_atime, stat.st_mtime + 10))
+
+        self.assertEqual(self.watch(writes), 0)
+        self.assertEqual(len(self.spawned), 2)
+
+    def test_reload_keeps_unchanged_commands(self):
+        with open(self.path, 'a') as f:
+            f.write('affinity=0\n')
+        self.supervisor.reload_config()
+        self.assertEqual(len(self.spawned), 4)
+        with open(self.path, 'a') as f:
+            f.write('\n[log]\nlevel=INFO\n')
+        self.supervisor.reload_config()
+        self.assertEqual(len(self.spawned), 4)
+        self.assertFalse(any(process.terminated for process in self.spawned[2:]))
+
+    def test_dead_process_restarted(self):
+        command = self.supervisor.commands[0]
+        command.process.exitcode = 1
+        delay = self.supervisor.supervise()
+        self.assertEqual(delay, 1.0)
+        command.restart_at = time.time()
+        self.assertEqual(self.supervisor.supervise(), None)
+        self.assertEqual(len(self.spawned), 3)
+        self.assertEqual(command.restarts, 1)
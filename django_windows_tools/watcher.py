@@ -0,0 +1,298 @@
+# encoding: utf-8
+
+# Watcher of the changes of a configuration file
+#
+# Copyright (c) 2012 Openance SARL
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+'''
+Watcher of the changes of a configuration file.
+
+A backend reports the changes of the files of the directory of the watched
+file. ConfigWatcher keeps the ones concerning the file, waits for the end
+of a burst of writes and compares a hash of the content of the file, so
+that saving it without modification does not count as a change.
+
+The Windows backend uses ReadDirectoryChangesW and exposes an event handle
+that can be waited on with WaitForMultipleObjects. The inotify (Linux) and
+polling backends allow testing the reload logic on other systems.
+'''
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import hashlib
+
+
+def file_digest(path):
+    '''Return a hash of the content of a file, or None if it cannot be read.'''
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).digest()
+    except (IOError, OSError):
+        return None
+
+
+class PollingBackend(object):
+    '''
+    Reports the changes of the size or modification time of a file, checked
+    every interval seconds.
+    '''
+
+    handle = None
+
+    def __init__(self, path, interval=1.0):
+        self.path = path
+        self.interval = interval
+        self.signature = self._signature()
+
+    def _signature(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size
+
+    def check(self):
+        signature = self._signature()
+        if signature == self.signature:
+            return False
+        self.signature = signature
+        return True
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while not self.check():
+            delay = self.interval if deadline is None else min(self.interval, deadline - time.time())
+            if delay <= 0:
+                return False
+            time.sleep(delay)
+        return True
+
+    def close(self):
+        pass
+
+
+class InotifyBackend(object):
+    '''
+    Reports the changes of a file with the inotify API of Linux.
+    '''
+
+    handle = None
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_NONBLOCK = 0x800
+    IN_CLOEXEC = 0x80000
+
+    _Event = struct.Struct('iIII')
+
+    def __init__(self, path):
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.filename = os.path.basename(path).encode(sys.getfilesystemencoding())
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        directory = os.path.dirname(os.path.abspath(path)).encode(sys.getfilesystemencoding())
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        if libc.inotify_add_watch(self.fd, directory, mask) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+
+    def check(self):
+        changed = False
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    return changed
+                raise
+            pos = 0
+            while pos < len(data):
+                wd, mask, cookie, length = self._Event.unpack_from(data, pos)
+                pos += self._Event.size
+                name = data[pos:pos + length].rstrip(b'\0')
+                pos += length
+                if name == self.filename:
+                    changed = True
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            delay = None if deadline is None else max(0, deadline - time.time())
+            if not select.select([self.fd], [], [], delay)[0]:
+                return False
+            if self.check():
+                return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class WindowsBackend(object):
+    '''
+    Reports the changes of a file with ReadDirectoryChangesW.
+
+    handle is signaled when a file of the directory changes. check() must
+    then be called to get the notifications and watch for the next ones.
+    '''
+
+    FILE_LIST_DIRECTORY = 0x0001
+
+    def __init__(self, path):
+        import pywintypes
+        import win32con
+        import win32event
+        import win32file
+        self.filename = os.path.basename(path).lower()
+        self.dir_handle = win32file.CreateFile(
+            os.path.dirname(os.path.abspath(path)),
+            self.FILE_LIST_DIRECTORY,
+            win32con.FILE_SHARE_READ | win32con.FILE_SHARE_WRITE | win32con.FILE_SHARE_DELETE,
+            None,
+            win32con.OPEN_EXISTING,
+            win32con.FILE_FLAG_BACKUP_SEMANTICS | win32con.FILE_FLAG_OVERLAPPED,
+            None
+        )
+        self.overlapped = pywintypes.OVERLAPPED()
+        self.overlapped.hEvent = win32event.CreateEvent(None, True, False, None)
+        self.handle = self.overlapped.hEvent
+        self.buffer = win32file.AllocateReadBuffer(8192)
+        self._read()
+
+    def _read(self):
+        import win32con
+        import win32file
+        win32file.ReadDirectoryChangesW(
+            self.dir_handle,
+            self.buffer,
+            False,
+            win32con.FILE_NOTIFY_CHANGE_LAST_WRITE | win32con.FILE_NOTIFY_CHANGE_FILE_NAME |
+            win32con.FILE_NOTIFY_CHANGE_SIZE,
+            self.overlapped
+        )
+
+    def check(self):
+        import win32event
+        import win32file
+        if win32event.WaitForSingleObject(self.handle, 0) != win32event.WAIT_OBJECT_0:
+            return False
+        size = win32file.GetOverlappedResult(self.dir_handle, self.overlapped, True)
+        win32event.ResetEvent(self.handle)
+        if size:
+            names = [name for action, name in win32file.FILE_NOTIFY_INFORMATION(self.buffer, size)]
+            changed = self.filename in [name.lower() for name in names]
+        else:
+            # the buffer has overflowed: the file may have changed
+            changed = True
+        self._read()
+        return changed
+
+    def wait(self, timeout=None):
+        import win32event
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            delay = win32event.INFINITE if deadline is None else int(max(0, deadline - time.time()) * 1000)
+            if win32event.WaitForSingleObject(self.handle, delay) != win32event.WAIT_OBJECT_0:
+                return False
+            if self.check():
+                return True
+
+    def close(self):
+        import win32file
+        win32file.CancelIo(self.dir_handle)
+        self.dir_handle.Close()
+        self.handle.Close()
+
+
+def get_backend(path):
+    '''Return the backend watching path on the current system.'''
+    if sys.platform == 'win32':
+        return WindowsBackend(path)
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyBackend(path)
+        except (OSError, AttributeError):
+            pass
+    return PollingBackend(path)
+
+
+class ConfigWatcher(object):
+    '''
+    Watches the content of a configuration file.
+
+    A change is reported once no write to the file happened for debounce
+    seconds and if its content differs from the last one seen.
+    '''
+
+    def __init__(self, path, debounce=0.5, backend=None):
+        self.path = path
+        self.debounce = debounce
+        self.backend = backend or get_backend(path)
+        self.digest = file_digest(path)
+
+    @property
+    def handle(self):
+        '''Handle signaled by the Windows backend when changed() should be called.'''
+        return self.backend.handle
+
+    def changed(self):
+        '''
+        Return True if the content of the file has changed.
+
+        To be called once the handle has been signaled.
+        '''
+        if not self.backend.check():
+            return False
+        return self._settle()
+
+    def wait(self, timeout=None):
+        '''
+        Wait for a notification about the file during at most timeout seconds.
+
+        Return True if the content of the file has changed.
+        '''
+        if not self.backend.wait(timeout):
+            return False
+        return self._settle()
+
+    def _settle(self):
+        # wait for the end of the burst of writes
+        while self.backend.wait(self.debounce):
+            pass
+        digest = file_digest(self.path)
+        if digest == self.digest:
+            return False
+        self.digest = digest
+        return True
+
+    def close(self):
+        self.backend.close()